@@ -0,0 +1,381 @@
+"""
+非同步模式：/api/data/{table_name} 這一組 API 改用 asyncpg (asyncio 原生的 PostgreSQL driver)
+
+main.py 在 DB_ASYNC=1 時會把這裡的 router 掛在同步版之前，
+同一個 uvicorn worker 就能同時等好幾百個查詢，不會卡在 threadpool。
+回傳的 JSON 格式跟同步版完全一樣。讀取一樣會分到唯讀副本 (見 read_replicas.py)。
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import asyncpg
+from fastapi import APIRouter, HTTPException, Request
+from psycopg2 import sql
+
+from db_pool import DB_CONFIG
+from read_replicas import replicas, served_lsn
+# record 只動記憶體 (寫進資料庫在背景執行緒)，不會擋住 event loop
+from index_advisor import workload
+from models import CreatePayload, UpdatePayload
+import query_metrics
+from response_cache import response_cache
+from filters import FilterError, parse_filters, compile_filters, filter_columns, filters_signature
+from pagination import (
+    CursorError, PAGE_PARAMS, resolve_page_request, page_query, finish_page,
+    build_pagination
+)
+from row_counts import (
+    ESTIMATE_QUERY, FILTERED_COUNT_LIMIT, exact_count_query, filtered_count_query, filtered_estimate_query,
+    plan_rows, row_counts
+)
+from serialization import RESPONSE_FORMATS, encode_rows, page_payload, temporal_indexes
+# 表格 / 欄位檢查跟同步版共用同一份結構快取；快取命中時只讀記憶體，不會擋住 event loop
+from schema_cache import schema, check_table
+from compact_schema import ADD_RETRIES, ADD_VALUE, FIND_VALUE, dictionary
+
+ASYNC_POOL_MIN = int(os.getenv("DB_ASYNC_POOL_MIN", "5"))
+ASYNC_POOL_MAX = int(os.getenv("DB_ASYNC_POOL_MAX", "50"))
+
+router = APIRouter()
+
+_async_pool = None
+_async_pool_lock = None
+# 唯讀副本名稱 -> asyncpg pool (第一次分到才建立，見 read_replicas.py)
+_replica_pools = {}
+
+
+async def open_async_pool():
+    global _async_pool, _async_pool_lock
+    if _async_pool is None:
+        if _async_pool_lock is None:
+            _async_pool_lock = asyncio.Lock()
+        async with _async_pool_lock:
+            if _async_pool is None:
+                try:
+                    _async_pool = await asyncpg.create_pool(
+                        min_size=ASYNC_POOL_MIN,
+                        max_size=ASYNC_POOL_MAX,
+                        init=_init_connection,
+                        **DB_CONFIG
+                    )
+                except (OSError, asyncpg.PostgresError) as e:
+                    print("DB Connection Error:", e)
+                    raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+    return _async_pool
+
+
+async def _init_connection(conn):
+    # 每個 SQL 的時間記到目前的請求上 (跟同步版的 TimedCursor 一樣，見 query_metrics.py)
+    if query_metrics.QUERY_METRICS:
+        conn.add_query_logger(query_metrics.log_asyncpg_query)
+
+
+def _busy(replica):
+    pool = _replica_pools.get(replica.name)
+    return pool.get_size() - pool.get_idle_size() if pool is not None else 0
+
+
+async def open_read_pool():
+    """讀取用的 pool：挑得到唯讀副本就用副本的，沒有就用主資料庫的"""
+    global _async_pool_lock
+    replica = replicas.choose(_busy)
+    if replica is not None:
+        pool = _replica_pools.get(replica.name)
+        if pool is None:
+            if _async_pool_lock is None:
+                _async_pool_lock = asyncio.Lock()
+            async with _async_pool_lock:
+                pool = _replica_pools.get(replica.name)
+                if pool is None:
+                    try:
+                        pool = await asyncpg.create_pool(
+                            min_size=0,
+                            max_size=ASYNC_POOL_MAX,
+                            init=_init_connection,
+                            **replica.config
+                        )
+                        _replica_pools[replica.name] = pool
+                    except (OSError, asyncpg.PostgresError) as e:
+                        replica.mark_down(f"連不上：{e}")
+                        pool = None
+        if pool is not None:
+            replicas.record_read(replica)
+            return pool
+    replicas.record_read(None)
+    return await open_async_pool()
+
+
+@asynccontextmanager
+async def acquire(pool):
+    """pool.acquire()，另外記下借到連線花的時間"""
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        query_metrics.record_acquire(time.perf_counter() - started)
+        yield conn
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+    while _replica_pools:
+        await _replica_pools.popitem()[1].close()
+
+
+def quote_ident(name):
+    """跟 psycopg2 sql.Identifier 一樣，一律加雙引號"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class _Params:
+    """
+    產生 $1, $2 ... 參數。
+
+    asyncpg 走 binary protocol，參數型別要跟欄位完全一致 (字串 '2' 不能直接塞進 INT)。
+    前端送來的值大多是字串，所以一律先轉成 text 再由 PostgreSQL cast 成欄位型別，
+    行為跟 psycopg2 把值當字面值送出去時一樣。
+    """
+
+    def __init__(self, column_types):
+        self.column_types = column_types
+        self.values = []
+
+    def add(self, column, value):
+        self.values.append(None if value is None else str(value))
+        return f"${len(self.values)}::text::{self.column_types[column]}"
+
+
+def _assignments(params, data, sep):
+    return sep.join(f"{quote_ident(k)} = {params.add(k, v)}" for k, v in data.items())
+
+
+def render(composable):
+    """
+    把 psycopg2.sql 組好的查詢轉成 asyncpg 用的字串 (%s 佔位符改成 $1, $2 ...)，
+    這樣分頁等查詢只要在 pagination.py 寫一份，同步 / 非同步兩邊共用。
+    """
+    counter = [0]
+
+    def walk(obj):
+        if isinstance(obj, sql.Composed):
+            return "".join(walk(part) for part in obj.seq)
+        if isinstance(obj, sql.Identifier):
+            return ".".join(quote_ident(s) for s in obj.strings)
+        if isinstance(obj, sql.Placeholder):
+            counter[0] += 1
+            return f"${counter[0]}"
+        if isinstance(obj, sql.SQL):
+            return obj.string
+        raise TypeError(f"不支援的 SQL 物件: {obj!r}")
+
+    return walk(composable)
+
+
+async def _encode_for_write(conn, table_name, data):
+    """同 compact_schema.ValueDictionary.encode_for_write：代碼表沒有的值先新增，再換成代碼"""
+    encoded = schema.encoded_columns(table_name)
+    added = {}
+    for column, value in dictionary.missing(data, encoded):
+        for _ in range(ADD_RETRIES):
+            code = await conn.fetchval(render(ADD_VALUE), column, value, column)
+            if code is None:
+                code = await conn.fetchval(render(FIND_VALUE), column, value)
+            if code is not None:
+                added[(column, value)] = code
+                break
+        else:
+            raise RuntimeError(f"無法新增 {column} = {value!r} 到代碼表")
+    return dictionary.encode_values(data, encoded, added)
+
+
+async def _cache_call(fn, *args):
+    """
+    記憶體快取直接呼叫；共用快取 (Redis) 要走網路、有唯讀副本時作廢要查主資料庫的 WAL 位置，
+    丟到 thread 裡才不會擋住 event loop
+    """
+    if response_cache.shared or response_cache.write_lsn is not None:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def _check_table(table_name, columns=()):
+    """
+    同 schema_cache.check_table；快取裡沒有這張表 (或還沒載入) 時會用 DBPool 連線查 pg_catalog 重讀結構，
+    丟到 thread 裡才不會擋住 event loop。通過之後這張表已經在快取裡，後面的 schema.* 都只讀記憶體
+    """
+    await asyncio.to_thread(check_table, table_name, columns)
+
+
+async def count_rows(conn, table_name):
+    """同 row_counts.count_rows，共用同一份快取"""
+    cached = row_counts.get(table_name)
+    if cached is not None:
+        return cached
+    estimate = await conn.fetchval(render(ESTIMATE_QUERY), table_name)
+    if row_counts.use_estimate(estimate):
+        row_counts.put(table_name, estimate, False)
+        return estimate, False
+    count = await conn.fetchval(render(exact_count_query(table_name)))
+    row_counts.put(table_name, count, True)
+    return count, True
+
+
+async def count_filtered(conn, table_name, where, params):
+    """同 row_counts.count_filtered"""
+    count = await conn.fetchval(render(filtered_count_query(table_name, where)), *params, FILTERED_COUNT_LIMIT + 1)
+    if count <= FILTERED_COUNT_LIMIT:
+        return count, True
+    plan = await conn.fetchval(render(filtered_estimate_query(table_name, where)), *params)
+    return max(plan_rows([plan]), count), False
+
+
+# 3. 取得表格資料 (async 版)
+@router.get("/api/data/{table_name}")
+async def get_data(
+    table_name: str,
+    request: Request,
+    sort_by: Optional[str] = None,
+    order: str = "ASC",
+    page: int = 1,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    format: str = "rows"
+):
+    await _check_table(table_name)
+    if format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format 只能是 {' / '.join(RESPONSE_FORMATS)}")
+    cache_key = response_cache.key(request, schema.version)
+    cached, generation = await _cache_call(response_cache.lookup, table_name, cache_key)
+    if cached is not None:
+        return response_cache.respond(request, *cached)
+
+    try:
+        filters = parse_filters(request.query_params.multi_items(), schema.column_types(table_name), PAGE_PARAMS)
+    except FilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        req = resolve_page_request(sort_by, order, page, limit, cursor, filters_signature(filters))
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    await _check_table(table_name, [c for c, _ in req["sort"]])
+    key_info = schema.key_info(table_name)
+    encoded = schema.encoded_columns(table_name)
+    where, where_params = compile_filters(dictionary.encode_filters(filters, encoded))
+
+    started = time.perf_counter()
+    pool = await open_read_pool()
+    try:
+        async with acquire(pool) as conn:
+            if where is None:
+                real_count, count_exact = await count_rows(conn, table_name)
+            else:
+                real_count, count_exact = await count_filtered(conn, table_name, where, where_params)
+
+            query, params = page_query(table_name, key_info, req, where, where_params)
+            records = await conn.fetch(render(query), *params)
+            # SELECT * 的欄位順序跟結構快取一樣 (依 attnum)
+            columns = list(records[0].keys()) if records else key_info["columns"]
+            rows, next_cursor, prev_cursor = finish_page([tuple(r) for r in records], key_info, req, columns)
+            rows = dictionary.decode_rows(columns, rows, encoded)
+        workload.record(table_name, "page", req["sort_by"], filter_columns(filters),
+                        (time.perf_counter() - started) * 1000)
+
+        with query_metrics.timer("serialize"):
+            rows = encode_rows(columns, rows, temporal_indexes(columns, schema.column_types(table_name)), format)
+            pagination = build_pagination(req["page"], req["limit"], real_count, next_cursor, prev_cursor, count_exact)
+            result = page_payload(columns, rows, pagination, format)
+            body, etag = await _cache_call(response_cache.store, table_name, cache_key, result, generation,
+                                           served_lsn())
+        return response_cache.respond(request, body, etag)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        query_metrics.record_error(e)
+        return {"data": [], "pagination": {"current_page": 1, "total_count": 0, "total_pages": 0}}
+
+
+# 4. 通用新增功能 (async 版)
+@router.post("/api/data/{table_name}")
+async def create_data(table_name: str, payload: CreatePayload):
+    data = payload.data
+    await _check_table(table_name, list(data))
+    pool = await open_async_pool()
+    try:
+        async with acquire(pool) as conn:
+            data = await _encode_for_write(conn, table_name, data)
+            params = _Params(schema.storage_types(table_name))
+            placeholders = ", ".join(params.add(k, v) for k, v in data.items())
+            columns = ", ".join(quote_ident(k) for k in data)
+            await conn.execute(
+                f"INSERT INTO {quote_ident(table_name)} ({columns}) VALUES ({placeholders})",
+                *params.values
+            )
+            row_counts.invalidate(table_name)
+            await _cache_call(response_cache.invalidate, table_name)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "新增成功"}
+
+
+# 5. 通用更新功能 (async 版)
+@router.put("/api/data/{table_name}")
+async def update_data(table_name: str, payload: UpdatePayload):
+    new_data = payload.data
+    conditions = payload.conditions
+
+    if not conditions:
+        raise HTTPException(status_code=400, detail="無法更新：找不到原始資料對應條件")
+    await _check_table(table_name, list(new_data) + list(conditions))
+
+    pool = await open_async_pool()
+    try:
+        async with acquire(pool) as conn:
+            new_data = await _encode_for_write(conn, table_name, new_data)
+            conditions = dictionary.encode_values(conditions, schema.encoded_columns(table_name))
+            params = _Params(schema.storage_types(table_name))
+            set_clause = _assignments(params, new_data, ", ")
+            where_clause = _assignments(params, conditions, " AND ")
+            started = time.perf_counter()
+            status = await conn.execute(
+                f"UPDATE {quote_ident(table_name)} SET {set_clause} WHERE {where_clause}",
+                *params.values
+            )
+            workload.record(table_name, "update", None, conditions, (time.perf_counter() - started) * 1000)
+            row_counts.invalidate(table_name)
+            await _cache_call(response_cache.invalidate, table_name)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # asyncpg 回傳的是 command tag，例如 "UPDATE 0"
+    if status.split()[-1] == "0":
+        return {"message": "更新失敗：找不到原始資料或資料未變動", "status": "failed"}
+    return {"message": "更新成功"}
+
+
+# 6. 通用刪除功能 (async 版)
+@router.post("/api/data/{table_name}/delete")
+async def delete_data(table_name: str, payload: CreatePayload):
+    conditions = payload.data
+    await _check_table(table_name, list(conditions))
+    pool = await open_async_pool()
+    try:
+        async with acquire(pool) as conn:
+            conditions = dictionary.encode_values(conditions, schema.encoded_columns(table_name))
+            params = _Params(schema.storage_types(table_name))
+            where_clause = _assignments(params, conditions, " AND ")
+            started = time.perf_counter()
+            await conn.execute(
+                f"DELETE FROM {quote_ident(table_name)} WHERE {where_clause}",
+                *params.values
+            )
+            workload.record(table_name, "delete", None, conditions, (time.perf_counter() - started) * 1000)
+            row_counts.invalidate(table_name)
+            await _cache_call(response_cache.invalidate, table_name)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "刪除成功"}
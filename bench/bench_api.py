@@ -0,0 +1,360 @@
+"""
+API 與匯入流程的效能測試 (可以存成 JSON，跟之前的結果比較有沒有變慢)
+
+流程：
+1. (--generate) 用 bench/gen_oulad.py 產生 --scale 大小的 OULAD 格式 CSV
+2. (--import)   用 import.py 匯入到測試用的資料庫 (--db-name，預設 final_project_bench，不存在就建立)，
+                記下匯入花的時間與每秒筆數
+3. 啟動 uvicorn (連到同一個測試資料庫)，每個端點在每個併發數下各送 --requests 個請求，
+   回報 req/s、p50 / p95 / p99 延遲，以及資料庫花的時間
+   (資料庫有裝 pg_stat_statements 時，每個請求平均在 PostgreSQL 裡執行了多久；
+   沒裝時用回應的 Server-Timing 標頭裡 API 自己量的 db 時間，見 query_metrics.py)
+4. 結果存成 JSON (--output，預設 bench/results/api-時間.json)；有 --baseline 時逐項比較，
+   req/s 掉超過或 p95 多超過 --threshold % 的標成變慢 (加 --fail-on-regression 時 exit code = 1)
+
+寫入端點 (create / update / delete) 用 id_student 從 9000000 開始的測試資料，跑完會刪掉。
+端點依序測 (不會同時打)，所以每個端點的資料庫時間不會混在一起。
+
+用法 (在專案根目錄執行)：
+    python bench/bench_api.py --generate --import --scale 0.01
+    python bench/bench_api.py --concurrency 1 20 --requests 500 --baseline bench/results/api-20250101-120000.json
+    python bench/bench_api.py --endpoints data_vle_filtered stats_clicks --async --no-cache
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+import httpx
+import psycopg2
+from tabulate import tabulate
+
+from bench_async import ROOT, percentile, start_server
+from gen_oulad import generate
+
+sys.path.insert(0, ROOT)
+
+from db_pool import DB_CONFIG  # noqa: E402
+
+SERVER_TIMING_DB = re.compile(r"(?:^|,)\s*db;dur=([\d.]+)")
+
+FIRST_STUDENT = 9000000
+WRITE_TABLE = "student_assessment"
+# 寫入端點要照這個順序測：update / delete 的對象是 create 新增的資料
+WRITES = ("create", "update", "delete")
+
+
+def endpoints(ctx):
+    """名稱 → 第 i 個請求的 (method, path, params, json)；ctx 是從 API 讀到的課程 / 評量編號"""
+    courses, assessments = ctx["courses"], ctx["assessments"]
+
+    def course(i):
+        return courses[i % len(courses)]
+
+    def write_key(i):
+        return {"id_student": FIRST_STUDENT + i, "id_assessment": assessments[i % len(assessments)][0]}
+
+    def write_course(i):
+        # 分區時 (import.py --partition) student_assessment 新增一定要有 code_presentation
+        _, code_module, code_presentation = assessments[i % len(assessments)]
+        return {"code_module": code_module, "code_presentation": code_presentation}
+
+    return {
+        "tables": lambda i: ("GET", "/api/tables", None, None),
+        "columns": lambda i: ("GET", "/api/columns/student_vle", None, None),
+        "data_courses": lambda i: ("GET", "/api/data/courses", None, None),
+        "data_student_info_sorted": lambda i: ("GET", "/api/data/student_info",
+                                               {"sort_by": "final_result", "page": i % 10 + 1}, None),
+        "data_vle_page": lambda i: ("GET", "/api/data/student_vle", {"page": i % 50 + 1, "limit": 100}, None),
+        "data_vle_filtered": lambda i: ("GET", "/api/data/student_vle", {
+            "code_module": course(i)[0], "code_presentation": course(i)[1],
+            "sum_click[gte]": i % 5 + 1, "sort_by": "date:desc"}, None),
+        "data_vle_prefix": lambda i: ("GET", "/api/data/student_vle", {
+            "code_presentation[prefix]": course(i)[1][:4], "sort_by": "sum_click:desc"}, None),
+        "data_assessment_sorted": lambda i: ("GET", "/api/data/student_assessment",
+                                             {"sort_by": "score:desc", "page": i % 20 + 1}, None),
+        "stats_scores": lambda i: ("GET", "/api/stats/scores", {"group_by": "module"}, None),
+        "stats_clicks": lambda i: ("GET", "/api/stats/clicks", {"by": "week", "code_module": course(i)[0]}, None),
+        "create": lambda i: ("POST", f"/api/data/{WRITE_TABLE}", None, {"data": dict(
+            write_key(i), **write_course(i), date_submitted=1, is_banked=0, score=50)}),
+        "update": lambda i: ("PUT", f"/api/data/{WRITE_TABLE}", None, {
+            "data": {"score": 60}, "conditions": write_key(i)}),
+        "delete": lambda i: ("POST", f"/api/data/{WRITE_TABLE}/delete", None, {"data": write_key(i)}),
+    }
+
+
+def connect(dbname=None):
+    return psycopg2.connect(**dict(DB_CONFIG, database=dbname or DB_CONFIG["database"]))
+
+
+def ensure_database(name):
+    conn = connect("postgres")
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+            if cur.fetchone() is None:
+                # 跟正式資料庫一樣用 UTF8 (init.sql 的註解、資料裡有非 ASCII 字元)
+                cur.execute(f'CREATE DATABASE "{name}" ENCODING \'UTF8\' TEMPLATE template0')
+                print(f"🆕 已建立測試資料庫 {name}")
+    finally:
+        conn.close()
+
+
+def run_import(data_dir, import_args):
+    """用 import.py 匯入 (跟平常一樣的流程)，回傳秒數與筆數"""
+    command = [sys.executable, "import.py", "--data-dir", os.path.abspath(data_dir)] + shlex.split(import_args)
+    print("⏳ 匯入中:", " ".join(command))
+    start = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            rows = {}
+            for table in ("courses", "student_info", "vle", "assessments", "student_registration",
+                          "student_vle", "student_assessment"):
+                cur.execute(f"SELECT count(*) FROM {table}")
+                rows[table] = cur.fetchone()[0]
+    finally:
+        conn.close()
+    total = sum(rows.values())
+    return {"seconds": round(seconds, 3), "rows": total, "rows_per_sec": round(total / seconds, 1), "tables": rows}
+
+
+class DbTime:
+    """pg_stat_statements 有裝才量得到，沒裝時回傳 None"""
+
+    QUERY = """
+        SELECT COALESCE(sum(total_exec_time), 0) FROM pg_stat_statements
+        WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    """
+
+    def __init__(self):
+        self.conn = connect()
+        self.conn.autocommit = True
+        try:
+            self.read()
+            self.enabled = True
+        except psycopg2.Error:
+            self.enabled = False
+
+    def read(self):
+        with self.conn.cursor() as cur:
+            cur.execute(self.QUERY)
+            return float(cur.fetchone()[0])
+
+    def snapshot(self):
+        return self.read() if self.enabled else None
+
+    def close(self):
+        self.conn.close()
+
+
+async def run_endpoint(base_url, make_request, concurrency, total):
+    latencies = []
+    db_ms = []
+    errors = 0
+    next_index = iter(range(total))
+
+    async def worker(client):
+        nonlocal errors
+        for i in next_index:
+            method, path, params, body = make_request(i)
+            start = time.perf_counter()
+            try:
+                r = await client.request(method, base_url + path, params=params, json=body)
+                if r.status_code >= 400:
+                    errors += 1
+                match = SERVER_TIMING_DB.search(r.headers.get("server-timing", ""))
+                if match:
+                    db_ms.append(float(match.group(1)))
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "server_db_ms": round(sum(db_ms) / len(db_ms), 3) if db_ms else None,
+    }
+
+
+def load_context(base_url):
+    courses = httpx.get(f"{base_url}/api/data/courses", params={"limit": 100}).json()["data"]
+    assessments = httpx.get(f"{base_url}/api/data/assessments", params={"limit": 1000}).json()["data"]
+    if not courses or not assessments:
+        raise SystemExit("❌ 資料庫裡沒有資料，請加 --generate --import")
+    return {
+        "courses": [(c["code_module"], c["code_presentation"]) for c in courses],
+        "assessments": [(a["id_assessment"], a["code_module"], a["code_presentation"]) for a in assessments],
+    }
+
+
+def cleanup_writes():
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {WRITE_TABLE} WHERE id_student >= %s", (FIRST_STUDENT,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """跟 baseline 比，回傳 (表格, 變慢的項目)"""
+    rows, regressions = [], []
+    for key, r in results.items():
+        old = baseline.get("endpoints", {}).get(key)
+        if old is None:
+            continue
+        rps_change = (r["rps"] - old["rps"]) / old["rps"] * 100 if old["rps"] else 0.0
+        p95_change = (r["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+        slower = rps_change < -threshold or p95_change > threshold
+        if slower:
+            regressions.append(key)
+        rows.append([key, old["rps"], r["rps"], f"{rps_change:+.1f}%", old["p95_ms"], r["p95_ms"],
+                     f"{p95_change:+.1f}%", "⚠️ 變慢" if slower else ""])
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API 與匯入流程效能測試")
+    parser.add_argument("--generate", action="store_true", help="先產生測試 CSV (bench/gen_oulad.py)")
+    parser.add_argument("--import", dest="do_import", action="store_true", help="用 import.py 匯入測試資料庫")
+    parser.add_argument("--scale", type=float, default=0.01, help="測試資料大小，1 = 原始 OULAD 資料集")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench", "data"))
+    parser.add_argument("--import-args", default="", help='傳給 import.py 的參數，例如 "--fast --workers 4"')
+    parser.add_argument("--db-name", default="final_project_bench", help="測試用的資料庫 (會被 import.py 清空)")
+    parser.add_argument("--endpoints", nargs="+", default=None, help="只測這些端點 (預設全部)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--requests", type=int, default=300, help="每個端點、每個併發數送幾個請求")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="server 用 DB_ASYNC=1")
+    parser.add_argument("--no-cache", action="store_true", help="關掉回應快取 (RESPONSE_CACHE=0)")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None, help="之前存的結果 JSON")
+    parser.add_argument("--threshold", type=float, default=10.0, help="變慢多少 %% 算退步")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    # import.py、uvicorn、這裡的連線都用同一個資料庫
+    os.environ["DB_NAME"] = DB_CONFIG["database"] = args.db_name
+    if args.no_cache:
+        os.environ["RESPONSE_CACHE"] = "0"
+    ensure_database(args.db_name)
+
+    report = {
+        "meta": {
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "db_name": args.db_name,
+            "scale": args.scale,
+            "async": args.async_mode,
+            "response_cache": not args.no_cache,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+        },
+        "import": None,
+        "endpoints": {},
+    }
+
+    if args.generate:
+        counts = generate(args.data_dir, args.scale, args.seed)
+        print(f"📄 已產生測試資料 ({sum(counts.values())} 筆) 在 {args.data_dir}")
+    if args.do_import:
+        report["import"] = run_import(args.data_dir, args.import_args)
+        r = report["import"]
+        print(f"✅ 匯入 {r['rows']} 筆，{r['seconds']:.1f} 秒 ({r['rows_per_sec']:.0f} 筆/秒)")
+
+    proc = start_server(args.port, args.async_mode)
+    db_time = DbTime()
+    if not db_time.enabled:
+        print("ℹ️ 沒有 pg_stat_statements，資料庫時間改用 Server-Timing 標頭")
+    rows = []
+    try:
+        base_url = f"http://127.0.0.1:{args.port}"
+        cleanup_writes()
+        available = endpoints(load_context(base_url))
+        names = args.endpoints or list(available)
+        if any(name in WRITES for name in names) and "create" not in names:
+            print("⚠️ update / delete 的對象是 create 新增的資料，沒一起測的話都會找不到資料 (測到的不是真的寫入)")
+        unknown = [n for n in names if n not in available]
+        if unknown:
+            raise SystemExit(f"❌ 沒有這些端點：{', '.join(unknown)} (可用 {', '.join(available)})")
+
+        for concurrency in args.concurrency:
+            for name in names:
+                if name not in WRITES:
+                    # 暖機 (連線池、schema 快取)
+                    asyncio.run(run_endpoint(base_url, available[name], 1, 5))
+                before = db_time.snapshot()
+                r = asyncio.run(run_endpoint(base_url, available[name], concurrency, args.requests))
+                after = db_time.snapshot()
+                r["db_ms_per_request"] = (r["server_db_ms"] if before is None
+                                          else round((after - before) / args.requests, 3))
+                key = f"{name} c={concurrency}"
+                report["endpoints"][key] = r
+                rows.append([key, r["rps"], r["p50_ms"], r["p95_ms"], r["p99_ms"],
+                             "-" if r["db_ms_per_request"] is None else r["db_ms_per_request"], r["errors"]])
+                print(f"{key:36s} {r['rps']:8.1f} req/s  p95={r['p95_ms']:.1f}ms")
+            cleanup_writes()
+    finally:
+        db_time.close()
+        proc.terminate()
+        proc.wait()
+
+    print()
+    print(tabulate(rows, headers=["endpoint", "req/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "DB ms/req", "errors"],
+                   tablefmt="psql"))
+
+    output = args.output or os.path.join(
+        ROOT, "bench", "results", f"api-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 結果已存到 {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        table, regressions = compare(report["endpoints"], baseline, args.threshold)
+        print(f"\n跟 {args.baseline} 比較 (commit {baseline.get('meta', {}).get('commit')})：")
+        print(tabulate(table, headers=["endpoint", "req/s (舊)", "req/s", "變化", "p95 (舊)", "p95", "變化", ""],
+                       tablefmt="psql"))
+        if regressions:
+            print(f"⚠️ {len(regressions)} 項變慢超過 {args.threshold}%")
+            if args.fail_on_regression:
+                raise SystemExit(1)
+        else:
+            print("✅ 沒有變慢")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+同步模式 vs 非同步模式 (DB_ASYNC=1) 壓力測試
+
+分別用兩種模式啟動 uvicorn (單一 worker)，在不同併發數下打 /api/data/{table}，
+比較 requests/sec 與 p50 / p99 延遲。
+
+用法 (在專案根目錄執行，資料庫要先匯入好)：
+    python bench/bench_async.py
+    python bench/bench_async.py --table student_vle --concurrency 1 10 50 200 --requests 2000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+from tabulate import tabulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def start_server(port, async_mode):
+    env = dict(os.environ, DB_ASYNC="1" if async_mode else "0")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+    # 等 server 起來
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/tables", timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("uvicorn 啟動失敗")
+
+
+async def run_load(url, concurrency, total, params=None):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker(client):
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # 換頁讓每個請求的 OFFSET 不一樣
+            page = i % 10 + 1
+            start = time.perf_counter()
+            try:
+                r = await client.get(url, params={**(params or {}), "page": page, "limit": 100})
+                if r.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "rps": total / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sync vs async 模式壓力測試")
+    parser.add_argument("--table", default="student_info")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--requests", type=int, default=1000, help="每個併發數送出的請求總數")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = []
+    for async_mode in (False, True):
+        mode = "async" if async_mode else "sync"
+        proc = start_server(args.port, async_mode)
+        try:
+            url = f"http://127.0.0.1:{args.port}/api/data/{args.table}"
+            asyncio.run(run_load(url, 1, 20))  # 暖機
+            for c in args.concurrency:
+                r = asyncio.run(run_load(url, c, args.requests))
+                results.append([mode, c, f"{r['rps']:.1f}", f"{r['p50_ms']:.1f}", f"{r['p99_ms']:.1f}", r["errors"]])
+                print(f"{mode:5s} c={c:<4d} {r['rps']:8.1f} req/s  p99={r['p99_ms']:.1f}ms")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print()
+    print(tabulate(results, headers=["mode", "concurrency", "req/s", "p50 (ms)", "p99 (ms)", "errors"], tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+批次寫入 (/api/data/{table}/bulk) vs 一筆一個 request 的速度比較
+
+對 student_assessment 依序做 新增 → 更新分數 → 刪除，
+每種筆數 (預設 1k / 10k / 100k) 各跑一次批次版，再用單筆 API 跑前 --single-max 筆估算單筆版的速度
+(單筆版跑 10 萬筆要很久，所以只抽前面一段)。
+測試資料的 id_student 從 9000000 開始，跑完會刪掉，不會動到原本的資料。
+
+用法 (在專案根目錄執行，assessments 要先匯入好)：
+    python bench/bench_bulk.py
+    python bench/bench_bulk.py --sizes 1000 10000 100000 --single-max 2000
+"""
+import argparse
+import time
+
+import httpx
+from tabulate import tabulate
+
+from bench_async import start_server
+
+TABLE = "student_assessment"
+FIRST_STUDENT = 9000000
+
+
+def make_rows(assessments, n):
+    return [{
+        "id_assessment": assessments[i % len(assessments)],
+        "id_student": FIRST_STUDENT + i,
+        "date_submitted": 1,
+        "is_banked": 0,
+        "score": 50,
+    } for i in range(n)]
+
+
+def key(row):
+    return {"id_student": row["id_student"], "id_assessment": row["id_assessment"]}
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run_bulk(client, base, rows):
+    def check(r):
+        r.raise_for_status()
+        body = r.json()
+        if not body["committed"]:
+            raise RuntimeError(body["errors"][:5])
+
+    updates = [{"data": {"score": 80}, "conditions": key(row)} for row in rows]
+    return {
+        "insert": timed(lambda: check(client.post(f"{base}/bulk", json={"rows": rows}))),
+        "update": timed(lambda: check(client.put(f"{base}/bulk", json={"rows": updates}))),
+        "delete": timed(lambda: check(client.post(f"{base}/bulk/delete", json={"rows": [key(r) for r in rows]}))),
+    }
+
+
+def run_single(client, base, rows):
+    def each(send):
+        for row in rows:
+            send(row).raise_for_status()
+
+    return {
+        "insert": timed(lambda: each(lambda row: client.post(base, json={"data": row}))),
+        "update": timed(lambda: each(lambda row: client.put(base, json={"data": {"score": 80}, "conditions": key(row)}))),
+        "delete": timed(lambda: each(lambda row: client.post(f"{base}/delete", json={"data": key(row)}))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次寫入速度測試")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--single-max", type=int, default=1000, help="單筆版最多實際跑幾筆，其餘用速度推算")
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    proc = start_server(args.port, async_mode=False)
+    results = []
+    try:
+        client = httpx.Client(timeout=None)
+        base = f"http://127.0.0.1:{args.port}/api/data/{TABLE}"
+        assessments = [r["id_assessment"] for r in
+                       client.get(f"http://127.0.0.1:{args.port}/api/data/assessments?limit=1000").json()["data"]]
+        if not assessments:
+            raise SystemExit("assessments 是空的，請先匯入資料")
+
+        for n in args.sizes:
+            rows = make_rows(assessments, n)
+            bulk = run_bulk(client, base, rows)
+            sample = rows[:min(n, args.single_max)]
+            single = run_single(client, base, sample)
+            for op in ("insert", "update", "delete"):
+                single_rate = len(sample) / single[op]
+                bulk_rate = n / bulk[op]
+                results.append([n, op, f"{bulk[op]:.2f}", f"{bulk_rate:,.0f}",
+                                f"{n / single_rate:.1f}" + ("" if len(sample) == n else " (推算)"),
+                                f"{single_rate:,.0f}", f"{bulk_rate / single_rate:.0f}x"])
+                print(f"{n:>7} rows {op:6s} bulk {bulk[op]:.2f}s  single {n / single_rate:.1f}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print()
+    print(tabulate(results, headers=["rows", "op", "bulk (s)", "bulk rows/s", "single (s)", "single rows/s", "speedup"],
+                   tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
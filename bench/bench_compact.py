@@ -0,0 +1,196 @@
+"""
+一般格式 vs 精簡格式 (import.py --compact，見 compact_schema.py) 的大小與查詢時間比較
+
+流程：
+1. (--generate) 用 bench/gen_oulad.py 產生 --scale 大小的 OULAD 格式 CSV
+2. (--import)   同一份 CSV 分別匯入兩個測試資料庫 (--db-name 一般格式、--compact-db-name 精簡格式，不存在就建立)
+3. 比較每張表的 heap / 索引 / 合計大小
+4. 幾個常見的查詢在兩邊各跑 --repeat 次，比較中位數 / 最快的時間；
+   精簡格式那邊的參數先用代碼表換成代碼 (跟 API 做的一樣)，兩邊回傳的筆數要一樣
+
+用法 (在專案根目錄執行)：
+    python bench/bench_compact.py --generate --import --scale 0.01
+    python bench/bench_compact.py --repeat 50
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from tabulate import tabulate
+
+from bench_api import connect, ensure_database
+from bench_async import ROOT
+from gen_oulad import generate
+
+sys.path.insert(0, ROOT)
+
+from compact_schema import DICTIONARY_TABLE, ValueDictionary  # noqa: E402
+
+TABLES = ["courses", "student_info", "vle", "assessments", "student_registration", "student_vle",
+          "student_assessment", DICTIONARY_TABLE]
+
+# 名稱 → (SQL, 參數)；參數是 (欄位, 值)，欄位有編碼時精簡格式那邊換成代碼，None = 不用換
+QUERIES = {
+    "presentation_filter": (
+        "SELECT count(*), sum(sum_click) FROM student_vle WHERE code_module = %s AND code_presentation = %s",
+        [("code_module", "module"), ("code_presentation", "presentation")],
+    ),
+    "join_student_info": (
+        "SELECT si.final_result, sum(sv.sum_click) FROM student_vle sv "
+        "JOIN student_info si USING (code_module, code_presentation, id_student) "
+        "WHERE sv.code_module = %s GROUP BY si.final_result",
+        [("code_module", "module")],
+    ),
+    "group_by_module": (
+        "SELECT code_module, code_presentation, count(*) FROM student_vle GROUP BY 1, 2 ORDER BY 1, 2",
+        [],
+    ),
+    "pk_page": (
+        "SELECT * FROM student_vle ORDER BY code_module, code_presentation, id_student, id_site, date LIMIT 100",
+        [],
+    ),
+    "imd_band_group": (
+        "SELECT imd_band, age_band, count(*) FROM student_info WHERE imd_band = %s GROUP BY 1, 2",
+        [("imd_band", "imd_band")],
+    ),
+}
+
+
+def run_import(data_dir, db_name, compact):
+    """用 import.py 匯入 (DB_NAME 指到 db_name)，回傳秒數"""
+    command = [sys.executable, "import.py", "--data-dir", os.path.abspath(data_dir)]
+    if compact:
+        command.append("--compact")
+    print(f"⏳ 匯入 {db_name}:", " ".join(command))
+    start = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+                   env=dict(os.environ, DB_NAME=db_name))
+    return time.perf_counter() - start
+
+
+def table_sizes(db_name):
+    """{表: (heap, 索引, 合計)} (bytes)，不存在的表不列"""
+    conn = connect(db_name)
+    try:
+        with conn.cursor() as cur:
+            sizes = {}
+            for table in TABLES:
+                cur.execute("SELECT to_regclass(%s)", (table,))
+                if cur.fetchone()[0] is None:
+                    continue
+                cur.execute("SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass), "
+                            "pg_total_relation_size(%s::regclass)", (table, table, table))
+                sizes[table] = cur.fetchone()
+            return sizes
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def sample_values(db_name):
+    """查詢參數用的值：student_vle 筆數最多的 module-presentation、最常見的 imd_band"""
+    conn = connect(db_name)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT code_module, code_presentation FROM student_vle "
+                        "GROUP BY 1, 2 ORDER BY count(*) DESC LIMIT 1")
+            module, presentation = cur.fetchone()
+            cur.execute("SELECT imd_band FROM student_info WHERE imd_band IS NOT NULL "
+                        "GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+            return {"module": module, "presentation": presentation, "imd_band": cur.fetchone()[0]}
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def time_queries(db_name, values, compact, repeat):
+    """{名稱: (筆數, 中位數 ms, 最快 ms)}"""
+    conn = connect(db_name)
+    results = {}
+    try:
+        with conn.cursor() as cur:
+            dictionary = ValueDictionary()
+            if compact:
+                dictionary.load(cur)
+            for name, (query, params) in QUERIES.items():
+                args = [dictionary.encode(column, values[key]) if compact else values[key] for column, key in params]
+                times = []
+                for _ in range(repeat + 1):
+                    start = time.perf_counter()
+                    cur.execute(query, args)
+                    rows = cur.fetchall()
+                    times.append((time.perf_counter() - start) * 1000)
+                # 第一次是暖機 (冷快取)，不算
+                times = times[1:]
+                results[name] = (len(rows), statistics.median(times), min(times))
+    finally:
+        conn.rollback()
+        conn.close()
+    return results
+
+
+def mb(size):
+    return f"{size / 1024 / 1024:.2f}"
+
+
+def change(old, new):
+    return f"{(new - old) / old * 100:+.1f}%" if old else ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="一般 / 精簡格式大小與查詢時間比較")
+    parser.add_argument("--generate", action="store_true", help="先產生測試 CSV (bench/gen_oulad.py)")
+    parser.add_argument("--import", dest="do_import", action="store_true", help="用 import.py 匯入兩個測試資料庫")
+    parser.add_argument("--scale", type=float, default=0.01, help="測試資料大小，1 = 原始 OULAD 資料集")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench", "data"))
+    parser.add_argument("--db-name", default="final_project_bench", help="一般格式的測試資料庫 (會被清空)")
+    parser.add_argument("--compact-db-name", default="final_project_bench_compact",
+                        help="精簡格式的測試資料庫 (會被清空)")
+    parser.add_argument("--repeat", type=int, default=20, help="每個查詢跑幾次")
+    args = parser.parse_args()
+
+    if args.generate:
+        counts = generate(args.data_dir, args.scale, args.seed)
+        print(f"📄 已產生測試資料 ({sum(counts.values())} 筆) 在 {args.data_dir}")
+    if args.do_import:
+        for db_name, compact in ((args.db_name, False), (args.compact_db_name, True)):
+            ensure_database(db_name)
+            seconds = run_import(args.data_dir, db_name, compact)
+            print(f"✅ {db_name} 匯入完成 ({seconds:.1f} 秒)")
+
+    plain, compact = table_sizes(args.db_name), table_sizes(args.compact_db_name)
+    rows = []
+    for table in TABLES:
+        old, new = plain.get(table, (0, 0, 0)), compact.get(table, (0, 0, 0))
+        rows.append([table, mb(old[0]), mb(new[0]), mb(old[1]), mb(new[1]), mb(old[2]), mb(new[2]),
+                     change(old[2], new[2])])
+    total_old = sum(s[2] for s in plain.values())
+    total_new = sum(s[2] for s in compact.values())
+    rows.append(["(合計)", "", "", "", "", mb(total_old), mb(total_new), change(total_old, total_new)])
+    print("\n📦 資料表大小 (MB)")
+    print(tabulate(rows, headers=["table", "heap", "heap (精簡)", "index", "index (精簡)", "total", "total (精簡)",
+                                  "變化"], tablefmt="psql"))
+
+    values = sample_values(args.db_name)
+    old = time_queries(args.db_name, values, False, args.repeat)
+    new = time_queries(args.compact_db_name, values, True, args.repeat)
+    rows = []
+    for name in QUERIES:
+        (old_rows, old_median, old_min), (new_rows, new_median, new_min) = old[name], new[name]
+        rows.append([name, old_rows if old_rows == new_rows else f"{old_rows} ≠ {new_rows}",
+                     f"{old_median:.2f}", f"{new_median:.2f}", change(old_median, new_median),
+                     f"{old_min:.2f}", f"{new_min:.2f}"])
+    print(f"\n⏱️ 查詢時間 (ms，每個跑 {args.repeat} 次；參數 {values})")
+    print(tabulate(rows, headers=["query", "rows", "median", "median (精簡)", "變化", "min", "min (精簡)"],
+                   tablefmt="psql"))
+    if any(old[name][0] != new[name][0] for name in QUERIES):
+        print("❌ 兩邊回傳的筆數不一樣")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+/api/export/{table_name} 匯出速度測試
+
+啟動一個 uvicorn，依序用 csv / ndjson / arrow 把整張表下載一次 (邊收邊丟，不存檔)，
+回報 MB/s、筆數，以及 server process 的記憶體高峰 (VmHWM)，
+用來確認不管表多大，server 的記憶體都維持固定。
+
+用法 (在專案根目錄執行)：
+    python bench/bench_export.py --table student_vle
+    python bench/bench_export.py --table student_vle --formats csv ndjson
+"""
+import argparse
+import time
+
+import httpx
+from tabulate import tabulate
+
+from bench_async import start_server
+
+
+def peak_rss_mb(pid):
+    """Linux 才有 /proc；其他系統回傳 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def download(url, params):
+    total = 0
+    newlines = 0
+    start = time.perf_counter()
+    first_byte = None
+    with httpx.stream("GET", url, params=params, timeout=None) as r:
+        r.raise_for_status()
+        for chunk in r.iter_raw():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            total += len(chunk)
+            newlines += chunk.count(b"\n")
+    return total, newlines, time.perf_counter() - start, first_byte or 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匯出 API 速度測試")
+    parser.add_argument("--table", default="student_vle")
+    parser.add_argument("--formats", nargs="+", default=["csv", "ndjson", "arrow"])
+    parser.add_argument("--sort-by", default=None)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    proc = start_server(args.port, async_mode=False)
+    results = []
+    try:
+        url = f"http://127.0.0.1:{args.port}/api/export/{args.table}"
+        for fmt in args.formats:
+            params = {"format": fmt}
+            if args.sort_by:
+                params["sort_by"] = args.sort_by
+            size, lines, elapsed, ttfb = download(url, params)
+            mb = size / 1024 / 1024
+            rows = lines - 1 if fmt == "csv" else (lines if fmt == "ndjson" else "-")
+            results.append([fmt, rows, f"{mb:.1f}", f"{elapsed:.2f}", f"{mb / elapsed:.1f}",
+                            f"{ttfb * 1000:.0f}", f"{peak_rss_mb(proc.pid) or 0:.0f}"])
+            print(f"{fmt:7s} {mb:8.1f} MB in {elapsed:.2f}s = {mb / elapsed:.1f} MB/s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print()
+    print(tabulate(results, headers=["format", "rows", "MB", "seconds", "MB/s", "first byte (ms)", "server peak RSS (MB)"],
+                   tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
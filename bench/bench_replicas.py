@@ -0,0 +1,99 @@
+"""
+讀寫分離 (DB_READ_REPLICAS，見 read_replicas.py) 的讀取吞吐量：0 / 1 / 2 / 3 個唯讀副本
+
+每一輪用前 N 個副本啟動 uvicorn (0 = 全部讀主資料庫)，關掉回應快取 (每個請求都真的查資料庫)，
+在不同併發數下打 /api/data/{table}，比較 requests/sec 與 p50 / p99 延遲，
+最後從 /api/pool/replicas 看讀取實際分到哪裡。
+
+副本要先準備好 (streaming replication，跟主資料庫同一個資料庫名稱)，例如本機：
+    pg_basebackup -h 127.0.0.1 -p 5432 -U postgres -D /tmp/replica1 -R -X stream
+    pg_ctl -D /tmp/replica1 -o "-p 5433" start      (5434、5435 照做)
+
+用法 (在專案根目錄執行，資料庫要先匯入好)：
+    python bench/bench_replicas.py
+    python bench/bench_replicas.py --replicas 127.0.0.1:5433,127.0.0.1:5434,127.0.0.1:5435 --readers 0 1 2 3 \\
+        --concurrency 10 50 --requests 2000 --async
+注意：主資料庫跟副本都在同一台機器時，大家搶同一組 CPU / 磁碟，測到的是分流的額外成本，不是加機器的效果。
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+from tabulate import tabulate
+
+from bench_async import ROOT, run_load
+
+
+def start_server(port, env):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=dict(os.environ, **env)
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/tables", timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("uvicorn 啟動失敗")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="唯讀副本數量 vs 讀取吞吐量")
+    parser.add_argument("--replicas", default="127.0.0.1:5433,127.0.0.1:5434,127.0.0.1:5435",
+                        help="逗號分隔的副本 host:port，第 N 輪用前 N 個")
+    parser.add_argument("--readers", type=int, nargs="+", default=[0, 1, 2, 3], help="要測的副本數")
+    parser.add_argument("--table", default="student_vle")
+    parser.add_argument("--query", default="sum_click[gte]=3",
+                        help="額外的 query string (篩選讓每個請求都有實際的查詢成本)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--requests", type=int, default=1000, help="每個併發數送出的請求總數")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="用 DB_ASYNC=1 (asyncpg) 模式")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    addresses = [a.strip() for a in args.replicas.split(",") if a.strip()]
+    if max(args.readers) > len(addresses):
+        parser.error(f"--readers 最多 {len(addresses)} (--replicas 只給了 {len(addresses)} 個)")
+
+    results = []
+    for readers in args.readers:
+        env = {
+            "DB_READ_REPLICAS": ",".join(addresses[:readers]),
+            "DB_ASYNC": "1" if args.async_mode else "0",
+            "RESPONSE_CACHE": "0",
+        }
+        proc = start_server(args.port, env)
+        try:
+            base = f"http://127.0.0.1:{args.port}"
+            status = httpx.get(f"{base}/api/pool/replicas").json()
+            down = [r["name"] for r in status["replicas"] if not r["healthy"]]
+            if down:
+                print(f"⚠️ 這些副本目前不能用，讀取會改走主資料庫: {down}")
+            url = f"{base}/api/data/{args.table}"
+            params = dict(parse_qsl(args.query))
+            asyncio.run(run_load(url, 1, 20, params))  # 暖機
+            for c in args.concurrency:
+                r = asyncio.run(run_load(url, c, args.requests, params))
+                results.append([readers, c, f"{r['rps']:.1f}", f"{r['p50_ms']:.1f}", f"{r['p99_ms']:.1f}", r["errors"]])
+                print(f"readers={readers} c={c:<4d} {r['rps']:8.1f} req/s  p99={r['p99_ms']:.1f}ms")
+            status = httpx.get(f"{base}/api/pool/replicas").json()
+            served = ", ".join(f"{s['name']}={s['served']}" for s in status["replicas"])
+            print(f"   讀取分配：主資料庫={status['primary_reads']}" + (f", {served}" if served else ""))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print()
+    print(tabulate(results, headers=["replicas", "concurrency", "req/s", "p50 (ms)", "p99 (ms)", "errors"],
+                   tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+/api/data 一頁資料「查詢 + 編成 JSON」的速度比較 (不經過 HTTP，直接在同一個 process 裡量)
+
+- dict-per-row：以前的做法，RealDictCursor → 逐格檢查日期 → jsonable_encoder → json.dumps
+- tuple rows：現在的預設，tuple → dict(zip()) → serialization.dumps (有 orjson 用 orjson)
+- tuple columns：format=columns 的精簡格式，連 dict 都不建
+- json_agg：讓 PostgreSQL 直接產生 JSON 字串 (參考用；不好跟 cursor / 日期格式整合，所以沒採用)
+
+每種跑 --repeat 次取中位數，回傳的大小也一起列出來。
+
+用法 (在專案根目錄執行)：
+    python bench/bench_serialize.py
+    python bench/bench_serialize.py --table student_vle --limits 100 1000 --repeat 50
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_pool import get_pool  # noqa: E402
+from schema_cache import schema  # noqa: E402
+from serialization import dumps, encode_rows, orjson, page_payload, temporal_indexes  # noqa: E402
+
+
+def page_sql(table_name, limit):
+    primary_key = schema.key_info(table_name)["primary_key"]
+    return sql.SQL("SELECT * FROM {} ORDER BY {} LIMIT {}").format(
+        sql.Identifier(table_name), sql.SQL(", ").join(map(sql.Identifier, primary_key)), sql.Literal(limit)
+    )
+
+
+def dict_per_row(conn, query):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(query)
+        rows = cur.fetchall()
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                row[key] = str(value)
+    payload = {"data": rows, "pagination": {}}
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def tuple_rows(fmt):
+    def run(conn, query):
+        with conn.cursor() as cur:
+            cur.execute(query)
+            columns = [d.name for d in cur.description]
+            rows = cur.fetchall()
+        temporal = temporal_indexes(columns, schema.column_types(TABLE[0]))
+        return dumps(page_payload(columns, encode_rows(columns, rows, temporal, fmt), {}, fmt))
+    return run
+
+
+def json_agg(conn, query):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT COALESCE(json_agg(t), '[]')::text FROM ({}) AS t").format(query))
+        data = cur.fetchone()[0]
+    return ('{"data":' + data + ',"pagination":{}}').encode()
+
+
+METHODS = {
+    "dict-per-row (old)": dict_per_row,
+    "tuple rows": tuple_rows("rows"),
+    "tuple columns": tuple_rows("columns"),
+    "json_agg": json_agg,
+}
+
+# tuple_rows 需要知道是哪張表 (日期欄位)
+TABLE = [None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分頁資料 JSON 編碼速度比較")
+    parser.add_argument("--table", default="student_info")
+    parser.add_argument("--limits", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+    TABLE[0] = args.table
+
+    print(f"JSON encoder: {'orjson' if orjson is not None else 'json (標準函式庫)'}")
+    results = []
+    with get_pool().connection() as conn:
+        schema.load(conn)
+        for limit in args.limits:
+            query = page_sql(args.table, limit)
+            baseline = None
+            for name, method in METHODS.items():
+                method(conn, query)   # 暖機
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    body = method(conn, query)
+                    times.append((time.perf_counter() - start) * 1000)
+                median = statistics.median(times)
+                baseline = baseline or median
+                results.append([limit, name, f"{median:.2f}", f"{baseline / median:.1f}x", f"{len(body) / 1024:.0f}"])
+            conn.rollback()
+
+    print(tabulate(results, headers=["rows", "method", "median ms", "speedup", "KB"], tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
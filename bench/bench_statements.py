@@ -0,0 +1,189 @@
+"""
+Prepared statement 快取 (statement_cache.py) 省下多少 parse / 規劃時間
+
+1. 直接連資料庫：/api/data 會跑的幾種查詢，各跑 --repeat 次
+   - text：跟以前一樣每次送組好的 SQL (PostgreSQL 每次 parse + 規劃)
+   - prepared：statement_cache 的 PREPARE 一次、之後 EXECUTE
+   比較每個查詢的中位數，差值就是每次省下的 parse / 規劃時間；
+   EXPLAIN (SUMMARY) 的 Planning Time 是其中規劃的部分，順便列出來對照
+   一個 /api/data 請求 = 有條件的筆數 (count) + 一頁資料 (page_*)
+2. (--api) 分別用 STATEMENT_CACHE=0 / 1 啟動 uvicorn (關掉回應快取)，比較 /api/data 的 req/s
+
+用法 (在專案根目錄執行，資料庫要先匯入好，DB_NAME 預設 final_project_bench)：
+    python bench/bench_statements.py
+    python bench/bench_statements.py --repeat 2000 --api --concurrency 1 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from tabulate import tabulate
+
+from bench_async import ROOT, run_load
+from bench_replicas import start_server
+
+os.environ.setdefault("DB_NAME", "final_project_bench")
+sys.path.insert(0, ROOT)
+
+from psycopg2 import sql  # noqa: E402
+
+from db_pool import DB_CONFIG, get_pool  # noqa: E402
+from filters import compile_filters, filters_shape  # noqa: E402
+from pagination import finish_page, page_query, page_shape, resolve_page_request  # noqa: E402
+from row_counts import FILTERED_COUNT_LIMIT, filtered_count_query  # noqa: E402
+from schema_cache import schema  # noqa: E402
+from statement_cache import StatementCache  # noqa: E402
+
+
+def sample_student(cur):
+    """student_vle 筆數最多的學生 (code_module, code_presentation, id_student)"""
+    cur.execute("SELECT code_module, code_presentation, id_student FROM student_vle "
+                "GROUP BY 1, 2, 3 ORDER BY count(*) DESC LIMIT 1")
+    return cur.fetchone()
+
+
+def cases(cur, student):
+    """
+    名稱 → make(i)，回傳 (shape, query, params)；shape 跟 main.py 用的一樣。
+    條件是主鍵的前幾個欄位 (查某位學生的點擊紀錄)，走索引、執行本身很快，parse / 規劃佔的比例才看得出來
+    """
+    key_info = schema.key_info("student_vle")
+    filters = [(column, "eq", value) for column, value in zip(("code_module", "code_presentation", "id_student"), student)]
+    where, where_params = compile_filters(filters)
+    base = ("student_vle", schema.version, filters_shape(filters))
+
+    def count(i):
+        query = filtered_count_query("student_vle", where)
+        return ("count",) + base, query, list(where_params) + [FILTERED_COUNT_LIMIT + 1]
+
+    def page_offset(i):
+        req = resolve_page_request(None, "ASC", i % 5 + 1, 20)
+        query, params = page_query("student_vle", key_info, req, where, where_params)
+        return ("page",) + base + page_shape(req), query, params
+
+    # 先翻 5 頁收集 cursor，keyset 那組輪流用
+    cursors, cursor = [], None
+    for _ in range(5):
+        req = resolve_page_request(None, "ASC", 1, 20, cursor)
+        query, params = page_query("student_vle", key_info, req, where, where_params)
+        cur.execute(query, params)
+        columns = [d.name for d in cur.description]
+        _, cursor, _ = finish_page(cur.fetchall(), key_info, req, columns)
+        if cursor is None:
+            break
+        cursors.append(cursor)
+
+    def page_keyset(i):
+        req = resolve_page_request(None, "ASC", 1, 20, cursors[i % len(cursors)])
+        query, params = page_query("student_vle", key_info, req, where, where_params)
+        return ("page",) + base + page_shape(req), query, params
+
+    def update(i):
+        # 每次都 rollback，不會真的改到資料
+        query = sql.SQL("UPDATE {} SET {} = {} WHERE {} = {}").format(
+            sql.Identifier("student_info"), sql.Identifier("studied_credits"), sql.Placeholder(),
+            sql.Identifier("id_student"), sql.Placeholder())
+        return ("update", "student_info", schema.version, ("studied_credits",), ("id_student",)), query, [60, i]
+
+    return {"count": count, "page_offset": page_offset, "page_keyset": page_keyset, "update": update}
+
+
+def planning_ms(cur, query, params):
+    cur.execute(sql.SQL("EXPLAIN (SUMMARY) ") + query, params)
+    for (line,) in cur.fetchall():
+        if line.startswith("Planning Time:"):
+            return float(line.split(":")[1].split()[0])
+    return None
+
+
+def time_case(conn, make, repeat, cache):
+    """每次執行的時間 (ms) 清單；cache 是 None 時每次送 SQL 文字"""
+    times = []
+    with conn.cursor() as cur:
+        for i in range(repeat):
+            shape, query, params = make(i)
+            start = time.perf_counter()
+            if cache is None:
+                cur.execute(query, params)
+            else:
+                cache.execute(cur, shape, query, params)
+            if cur.description is not None:
+                cur.fetchall()
+            times.append((time.perf_counter() - start) * 1000)
+            conn.rollback()
+    return times
+
+
+def direct(repeat, student):
+    conn = get_pool().getconn()
+    cache = StatementCache()
+    try:
+        with conn.cursor() as cur:
+            makers = cases(cur, student)
+        conn.rollback()
+        rows, saved = [], {}
+        for name, make in makers.items():
+            with conn.cursor() as cur:
+                plan = statistics.median(planning_ms(cur, *make(i)[1:]) for i in range(20))
+            conn.rollback()
+            # 前面 10 次是暖機 (包含第一次 PREPARE、前 5 次 custom plan)，不算
+            text = time_case(conn, make, repeat + 10, None)[10:]
+            prepared = time_case(conn, make, repeat + 10, cache)[10:]
+            old, new = statistics.median(text), statistics.median(prepared)
+            saved[name] = old - new
+            rows.append([name, f"{plan:.3f}", f"{old:.3f}", f"{new:.3f}", f"{(old - new) * 1000:.0f}",
+                         f"{(new - old) / old * 100:+.1f}%"])
+    finally:
+        get_pool().putconn(conn)
+    print(f"\n⏱️ 每次執行的中位數 (ms，各 {repeat} 次；資料庫 {DB_CONFIG['database']}，學生 {student})")
+    print(tabulate(rows, headers=["query", "planning (EXPLAIN)", "text", "prepared", "省下 (µs)", "變化"],
+                   tablefmt="psql"))
+    for page in ("page_offset", "page_keyset"):
+        print(f"一個 /api/data 請求 (count + {page}) 約省下 {(saved['count'] + saved[page]) * 1000:.0f} µs")
+
+
+def api(concurrency, total, port, student):
+    results = []
+    params = dict(zip(("code_module", "code_presentation", "id_student"), map(str, student)))
+    for enabled in ("0", "1"):
+        proc = start_server(port, {"STATEMENT_CACHE": enabled, "RESPONSE_CACHE": "0"})
+        try:
+            url = f"http://127.0.0.1:{port}/api/data/student_vle"
+            asyncio.run(run_load(url, 1, 20, params))  # 暖機
+            for c in concurrency:
+                r = asyncio.run(run_load(url, c, total, params))
+                results.append(["on" if enabled == "1" else "off", c, f"{r['rps']:.1f}", f"{r['p50_ms']:.2f}",
+                                f"{r['p99_ms']:.2f}", r["errors"]])
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(f"\n🌐 /api/data/student_vle ({params}，換頁)")
+    print(tabulate(results, headers=["statement cache", "concurrency", "req/s", "p50 (ms)", "p99 (ms)", "errors"],
+                   tablefmt="psql"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="prepared statement 快取省下的 parse / 規劃時間")
+    parser.add_argument("--repeat", type=int, default=1000, help="每個查詢每種方式跑幾次")
+    parser.add_argument("--api", action="store_true", help="另外用 uvicorn 比較整個 API 的 req/s")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--requests", type=int, default=1000, help="--api 每個併發數送出的請求總數")
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    conn = get_pool().getconn()
+    try:
+        with conn.cursor() as cur:
+            student = sample_student(cur)
+    finally:
+        get_pool().putconn(conn)
+    direct(args.repeat, student)
+    if args.api:
+        api(args.concurrency, args.requests, args.port, student)
+
+
+if __name__ == "__main__":
+    main()
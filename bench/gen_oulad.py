@@ -0,0 +1,182 @@
+"""
+產生 OULAD 格式的測試 CSV (七張表，欄位跟原始資料集 / init.sql 一樣)，給效能測試用
+
+--scale 1 大約是原始資料集的大小：
+    courses 22、assessments 206、vle 6,364、student_info / student_registration 32,593、
+    student_assessment 約 17 萬、student_vle 約 1,065 萬筆
+student_info / student_registration / student_assessment / student_vle 跟 vle 依 scale 等比例縮放，
+courses、assessments 固定 (每門課的評量數不會因為學生變多而變多)。
+同樣的 --seed 每次產生的內容都一樣，可以拿來比較不同版本的程式。
+
+缺值跟 import.py 吃的格式一樣是空字串；student_vle 的主鍵 (學生, id_site, 課程, date) 不重複，
+student_assessment 只對「有修這門課」的學生產生成績。
+
+用法 (在專案根目錄執行)：
+    python bench/gen_oulad.py --scale 0.01 --out bench/data
+    python import.py --data-dir bench/data
+"""
+import argparse
+import csv
+import os
+import random
+import time
+
+# 原始資料集的 22 個 module-presentation
+PRESENTATIONS = {
+    "AAA": ["2013J", "2014J"],
+    "BBB": ["2013B", "2013J", "2014B", "2014J"],
+    "CCC": ["2014B", "2014J"],
+    "DDD": ["2013B", "2013J", "2014B", "2014J"],
+    "EEE": ["2013J", "2014B", "2014J"],
+    "FFF": ["2013B", "2013J", "2014B", "2014J"],
+    "GGG": ["2013J", "2014B", "2014J"],
+}
+
+# scale = 1 時的筆數
+FULL_STUDENTS = 32593
+FULL_SITES = 6364
+VLE_ROWS_PER_STUDENT = 327
+ASSESSMENTS_PER_PRESENTATION = (7, 12)
+SUBMIT_RATE = 0.57
+
+REGIONS = ["East Anglian Region", "Scotland", "North Western Region", "South East Region", "West Midlands Region",
+           "Wales", "North Region", "South Region", "Ireland", "South West Region", "East Midlands Region",
+           "Yorkshire Region", "London Region"]
+EDUCATION = [("A Level or Equivalent", 43), ("Lower Than A Level", 40), ("HE Qualification", 14),
+             ("No Formal quals", 1), ("Post Graduate Qualification", 2)]
+IMD_BANDS = ["0-10%", "10-20", "20-30%", "30-40%", "40-50%", "50-60%", "60-70%", "70-80%", "80-90%", "90-100%", ""]
+AGE_BANDS = [("0-35", 70), ("35-55", 29), ("55<=", 1)]
+RESULTS = [("Pass", 38), ("Withdrawn", 31), ("Fail", 22), ("Distinction", 9)]
+ACTIVITY_TYPES = [("resource", 45), ("subpage", 15), ("oucontent", 15), ("url", 12), ("forumng", 5), ("quiz", 4),
+                  ("page", 2), ("homepage", 1), ("ouwiki", 1)]
+
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def presentation_list():
+    return [(module, p) for module, presentations in PRESENTATIONS.items() for p in presentations]
+
+
+class Writer:
+    def __init__(self, out_dir, name, header):
+        self.path = os.path.join(out_dir, f"{name}.csv")
+        self._file = open(self.path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+        self.rows = 0
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        self._file.close()
+
+
+def generate(out_dir, scale=0.01, seed=42):
+    """產生七個 CSV，回傳 {表: 筆數}"""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    presentations = presentation_list()
+    students_per = max(1, round(FULL_STUDENTS * scale / len(presentations)))
+    sites_per = max(5, round(FULL_SITES * scale / len(presentations)))
+
+    writers = {
+        "courses": Writer(out_dir, "courses", ["code_module", "code_presentation", "module_presentation_length"]),
+        "assessments": Writer(out_dir, "assessments", ["code_module", "code_presentation", "id_assessment",
+                                                       "assessment_type", "date", "weight"]),
+        "vle": Writer(out_dir, "vle", ["id_site", "code_module", "code_presentation", "activity_type",
+                                       "week_from", "week_to"]),
+        "student_info": Writer(out_dir, "student_info", [
+            "code_module", "code_presentation", "id_student", "gender", "region", "highest_education",
+            "imd_band", "age_band", "num_of_prev_attempts", "studied_credits", "disability", "final_result"]),
+        "student_registration": Writer(out_dir, "student_registration", [
+            "code_module", "code_presentation", "id_student", "date_registration", "date_unregistration"]),
+        "student_assessment": Writer(out_dir, "student_assessment", [
+            "id_assessment", "id_student", "date_submitted", "is_banked", "score"]),
+        "student_vle": Writer(out_dir, "student_vle", [
+            "code_module", "code_presentation", "id_student", "id_site", "date", "sum_click"]),
+    }
+    next_assessment, next_site = 1752, 526721
+    # 學生編號大部分只修一門課，少數人會出現在好幾個 presentation
+    student_pool = range(6516, 6516 + FULL_STUDENTS * 80)
+    try:
+        for module, presentation in presentations:
+            length = rng.randint(234, 269)
+            writers["courses"].write((module, presentation, length))
+
+            assessments = []
+            count = rng.randint(*ASSESSMENTS_PER_PRESENTATION)
+            for k in range(count):
+                exam = k == count - 1
+                date = "" if exam and rng.random() < 0.5 else int(length * (k + 1) / count)
+                kind = "Exam" if exam else rng.choice(["TMA", "CMA"])
+                weight = 100.0 if exam else round(100.0 / max(1, count - 1), 1)
+                assessments.append((next_assessment, date))
+                writers["assessments"].write((module, presentation, next_assessment, kind, date, weight))
+                next_assessment += 1
+
+            sites = []
+            for _ in range(sites_per):
+                week_from = rng.randint(0, 38) if rng.random() < 0.18 else ""
+                week_to = week_from if week_from == "" else week_from + rng.randint(0, 2)
+                writers["vle"].write((next_site, module, presentation, weighted(rng, ACTIVITY_TYPES),
+                                      week_from, week_to))
+                sites.append(next_site)
+                next_site += 1
+
+            for id_student in rng.sample(student_pool, students_per):
+                result = weighted(rng, RESULTS)
+                writers["student_info"].write((
+                    module, presentation, id_student, rng.choice("MF"), rng.choice(REGIONS),
+                    weighted(rng, EDUCATION), rng.choice(IMD_BANDS), weighted(rng, AGE_BANDS),
+                    rng.choices([0, 1, 2, 3], [87, 10, 2, 1])[0], rng.choice([30, 60, 60, 60, 90, 120, 150, 240]),
+                    rng.choice("NNNNNNNNNY"), result,
+                ))
+                unregistered = rng.randint(-30, length) if result == "Withdrawn" else ""
+                writers["student_registration"].write((module, presentation, id_student,
+                                                       rng.randint(-180, 0), unregistered))
+
+                last_day = unregistered if unregistered != "" else length
+                for id_assessment, date in assessments:
+                    if rng.random() > SUBMIT_RATE:
+                        continue
+                    due = date if date != "" else length
+                    score = "" if rng.random() < 0.001 else min(100, max(0, round(rng.gauss(75, 18))))
+                    writers["student_assessment"].write((id_assessment, id_student,
+                                                         max(-10, due + rng.randint(-20, 5)),
+                                                         int(rng.random() < 0.01), score))
+
+                seen = set()
+                for _ in range(VLE_ROWS_PER_STUDENT):
+                    key = (rng.choice(sites), rng.randint(-25, max(-25, last_day)))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    writers["student_vle"].write((module, presentation, id_student, key[0], key[1],
+                                                  max(1, int(rng.expovariate(1 / 4)))))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {name: writer.rows for name, writer in writers.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產生 OULAD 格式的測試資料")
+    parser.add_argument("--scale", type=float, default=0.01, help="1 = 原始資料集的大小")
+    parser.add_argument("--out", default="bench/data")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(args.out, args.scale, args.seed)
+    for name, rows in counts.items():
+        print(f"📄 {name}.csv：{rows} 筆")
+    print(f"✅ 測試資料已產生在 {args.out} ({time.perf_counter() - start:.1f} 秒)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+批次寫入：一次新增 / 更新 / 刪除很多筆，整批在同一個交易裡完成
+
+單筆的 POST / PUT /api/data/{table_name} 每一筆都要一個 HTTP request、一次 commit，
+成績批改一次要改上千筆 student_assessment 時非常慢。這裡的做法：
+1. 整批資料用 COPY 灌進暫存表 bulk_rows (每筆帶著它在 request 裡的序號 _row)
+2. 在暫存表上用 SQL 一次檢查：型別、外鍵、主鍵重複、被其他表參照…，找出哪幾筆有問題
+3. 一個 INSERT ... SELECT / UPDATE ... FROM / DELETE ... USING 把其餘的寫進去
+
+API：
+    POST /api/data/{table_name}/bulk         {"rows": [{...}, ...], "on_conflict": "error|skip|update", "atomic": true}
+    PUT  /api/data/{table_name}/bulk         {"rows": [{"data": {...}, "conditions": {...}}, ...], "atomic": true}
+    POST /api/data/{table_name}/bulk/delete  {"rows": [{...條件...}, ...], "atomic": true}
+
+回傳每一筆的結果：results[i] 對應 rows[i] (inserted / updated / skipped / deleted / not_found / error / rolled_back)，
+失敗的那些筆另外列在 errors 裡。atomic=true (預設) 時只要有一筆失敗就整批不寫入。
+欄位組合不同的資料會分組，各組各跑一次上面的流程 (還是同一個交易)。
+精簡格式 (compact_schema.py) 的代碼欄位在灌進暫存表之前先把字串換成代碼。
+"""
+import io
+import os
+import re
+from collections import Counter
+
+import psycopg2
+from fastapi import APIRouter, HTTPException
+from psycopg2 import sql
+
+from db_pool import get_pool, PoolTimeout
+from models import BulkCreatePayload, BulkUpdatePayload, BulkDeletePayload
+from response_cache import response_cache
+from row_counts import row_counts
+from schema_cache import schema, check_table
+from compact_schema import dictionary
+
+router = APIRouter()
+
+# 一個 request 最多幾筆
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "100000"))
+# atomic=false 時，最多容忍幾筆失敗就整批放棄 (COPY 遇到型別錯誤時要重跑，錯太多筆會很慢)
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+
+STAGE = sql.Identifier("bulk_rows")
+
+# COPY 錯誤訊息裡的 "COPY bulk_rows, line 3, column c1: ..."
+_COPY_LINE = re.compile(r"COPY bulk_rows, line (\d+)")
+
+
+class BulkAborted(Exception):
+    """錯誤太多筆，整批放棄"""
+
+
+class BulkResult:
+    def __init__(self, total, atomic):
+        self.status = [None] * total
+        self.errors = {}
+        self.atomic = atomic
+
+    def fail(self, row, message):
+        self.status[row] = "error"
+        self.errors[row] = message
+        if not self.atomic and len(self.errors) > BULK_MAX_ERRORS:
+            raise BulkAborted(f"失敗超過 {BULK_MAX_ERRORS} 筆，整批放棄")
+
+    def set(self, rows, status):
+        for row in rows:
+            if self.status[row] is None:
+                self.status[row] = status
+
+    def failed(self, rows):
+        return [r for r in rows if r in self.errors]
+
+    def should_abort(self):
+        return self.atomic and bool(self.errors)
+
+    def response(self, committed, message):
+        status = [s or "rolled_back" for s in self.status] if not committed else self.status
+        return {
+            "message": message,
+            "status": "success" if committed else "failed",
+            "committed": committed,
+            "summary": dict(Counter(status)),
+            "results": status,
+            "errors": [{"row": r, "error": e} for r, e in sorted(self.errors.items())],
+        }
+
+
+def _copy_value(value):
+    """轉成 COPY text 格式的一個欄位"""
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _create_stage(cur, table_name, columns):
+    """
+    暫存表：_row + 每個 (別名, 來源欄位)。
+    用 CREATE TABLE AS 從原表複製欄位型別 (含 VARCHAR 長度)，太長的值在 COPY 時就會被抓到是哪一筆
+    """
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(STAGE))
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT NULL::integer AS _row, {} FROM {} t WITH NO DATA").format(
+        STAGE,
+        sql.SQL(", ").join(
+            sql.SQL("t.{} AS {}").format(sql.Identifier(column), sql.Identifier(alias))
+            for alias, column in columns
+        ),
+        sql.Identifier(table_name),
+    ))
+
+
+def _load_stage(cur, columns, rows, result):
+    """
+    rows: [(序號, [值...]), ...]，用 COPY 灌進暫存表，回傳成功灌進去的序號。
+    COPY 遇到型別錯誤會整個失敗，錯誤訊息會說是第幾行：
+    把那一筆標記為失敗後重跑 (atomic 時直接結束，反正整批都不會寫入)
+    """
+    copy = sql.SQL("COPY {} (_row, {}) FROM STDIN").format(
+        STAGE, sql.SQL(", ").join(sql.Identifier(alias) for alias, _ in columns)
+    ).as_string(cur)
+    pending = list(rows)
+    while pending:
+        buf = io.StringIO()
+        for row, values in pending:
+            buf.write(str(row))
+            for value in values:
+                buf.write("\t")
+                buf.write(_copy_value(value))
+            buf.write("\n")
+        buf.seek(0)
+
+        cur.execute("SAVEPOINT bulk_copy")
+        try:
+            cur.copy_expert(copy, buf)
+            cur.execute("RELEASE SAVEPOINT bulk_copy")
+            break
+        except psycopg2.DataError as e:
+            cur.execute("ROLLBACK TO SAVEPOINT bulk_copy")
+            match = _COPY_LINE.search(e.diag.context or "")
+            if match is None:
+                raise
+            row, _ = pending.pop(int(match.group(1)) - 1)
+            result.fail(row, e.diag.message_primary)
+            if result.should_abort():
+                return []
+    return [row for row, _ in pending]
+
+
+def _match(left, right, pairs):
+    """left.欄位 = right.別名 AND ...，pairs: [(欄位, 別名), ...]"""
+    return sql.SQL(" AND ").join(
+        sql.SQL("{}.{} = {}.{}").format(sql.Identifier(left), sql.Identifier(column),
+                                        sql.Identifier(right), sql.Identifier(alias))
+        for column, alias in pairs
+    )
+
+
+def _select_rows(cur, query, params=None):
+    cur.execute(query, params)
+    return [r[0] for r in cur.fetchall()]
+
+
+def _drop_from_stage(cur, rows):
+    if rows:
+        cur.execute(sql.SQL("DELETE FROM {} WHERE _row = ANY(%s)").format(STAGE), (rows,))
+
+
+def _check_foreign_keys(cur, table_name, aliases, result):
+    """外鍵欄位都在這批資料裡的，檢查父表有沒有對應的資料 (有任何 NULL 就不檢查，跟 PostgreSQL 一樣)"""
+    for fk in schema.table(table_name)["foreign_keys"]:
+        if not all(c in aliases for c in fk["columns"]):
+            continue
+        pairs = list(zip(fk["ref_columns"], (aliases[c] for c in fk["columns"])))
+        query = sql.SQL(
+            "SELECT b._row FROM {} b WHERE {} AND NOT EXISTS (SELECT 1 FROM {} r WHERE {})"
+        ).format(
+            STAGE,
+            sql.SQL(" AND ").join(sql.SQL("b.{} IS NOT NULL").format(sql.Identifier(a)) for _, a in pairs),
+            sql.Identifier(fk["ref_table"]),
+            _match("r", "b", pairs),
+        )
+        message = "%s 找不到對應的資料 (%s)" % (fk["ref_table"], ", ".join(fk["columns"]))
+        for row in _select_rows(cur, query):
+            result.fail(row, message)
+
+
+def _check_duplicates(cur, aliases, result, message):
+    """同一批裡 aliases 這些欄位重複的，第二筆之後算失敗"""
+    query = sql.SQL(
+        "SELECT _row FROM (SELECT _row, row_number() OVER (PARTITION BY {} ORDER BY _row) AS n FROM {}) d WHERE n > 1"
+    ).format(sql.SQL(", ").join(map(sql.Identifier, aliases)), STAGE)
+    for row in _select_rows(cur, query):
+        result.fail(row, message)
+
+
+def _group_rows(rows, shape):
+    """依欄位組合分組：{shape: [(序號, row), ...]}"""
+    groups = {}
+    for i, row in enumerate(rows):
+        groups.setdefault(shape(row), []).append((i, row))
+    return groups
+
+
+def _run(table_name, total, atomic, groups, apply_group, message):
+    """整批在同一個交易裡跑完；atomic 時有任何一筆失敗就 rollback"""
+    if total == 0:
+        raise HTTPException(status_code=400, detail="rows 不能是空的")
+    if total > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"一次最多 {BULK_MAX_ROWS} 筆")
+    result = BulkResult(total, atomic)
+
+    try:
+        db_pool = get_pool()
+        conn = db_pool.getconn()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
+        raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+    try:
+        cur = conn.cursor()
+        try:
+            for shape, members in groups.items():
+                apply_group(cur, shape, members, result)
+                if result.should_abort():
+                    conn.rollback()
+                    return result.response(False, "有資料驗證失敗，整批都沒有寫入")
+            conn.commit()
+            row_counts.invalidate(table_name)
+            response_cache.invalidate(table_name)
+        except BulkAborted as e:
+            conn.rollback()
+            return result.response(False, str(e))
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            cur.close()
+    finally:
+        db_pool.putconn(conn)
+    return result.response(True, message)
+
+
+# ==========================================
+# 批次新增
+# ==========================================
+def _insert_group(table_name, on_conflict):
+    info = schema.table(table_name)
+    pk = info["primary_key"]
+    not_null = {name for name, c in info["columns"].items() if c["not_null"]}
+    encoded = schema.encoded_columns(table_name)
+
+    def apply(cur, columns, members, result):
+        aliases = {c: "c%d" % i for i, c in enumerate(columns)}
+        missing_pk = [c for c in pk if c not in aliases]
+        staged, added = [], {}
+        for row, data in members:
+            data = dictionary.encode_for_write(cur, data, encoded, added)
+            if missing_pk:
+                result.fail(row, "缺少主鍵欄位：" + ", ".join(missing_pk))
+            elif any(data[c] is None for c in columns if c in not_null):
+                result.fail(row, "不可為 NULL 的欄位沒有值")
+            else:
+                staged.append((row, [data[c] for c in columns]))
+        if result.should_abort() or not staged:
+            return
+
+        _create_stage(cur, table_name, [(aliases[c], c) for c in columns])
+        staged = _load_stage(cur, [(aliases[c], c) for c in columns], staged, result)
+        if result.should_abort() or not staged:
+            return
+
+        _check_foreign_keys(cur, table_name, aliases, result)
+        if pk:
+            _check_duplicates(cur, [aliases[c] for c in pk], result, "同一批資料裡主鍵重複")
+            existing = _select_rows(cur, sql.SQL("SELECT b._row FROM {} b JOIN {} t ON {}").format(
+                STAGE, sql.Identifier(table_name), _match("t", "b", [(c, aliases[c]) for c in pk])
+            ))
+            existing = [r for r in existing if r not in result.errors]
+            if on_conflict == "error":
+                for row in existing:
+                    result.fail(row, "主鍵已存在")
+            else:
+                result.set(existing, "skipped" if on_conflict == "skip" else "updated")
+        if result.should_abort():
+            return
+
+        skip = existing if pk and on_conflict == "skip" else []
+        _drop_from_stage(cur, result.failed(staged) + skip)
+
+        query = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ORDER BY _row").format(
+            sql.Identifier(table_name),
+            sql.SQL(", ").join(map(sql.Identifier, columns)),
+            sql.SQL(", ").join(sql.Identifier(aliases[c]) for c in columns),
+            STAGE,
+        )
+        updates = [c for c in columns if c not in pk]
+        if pk and on_conflict == "update" and updates:
+            query += sql.SQL(" ON CONFLICT ({}) DO UPDATE SET {}").format(
+                sql.SQL(", ").join(map(sql.Identifier, pk)),
+                sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in updates),
+            )
+        elif pk and on_conflict != "error":
+            query += sql.SQL(" ON CONFLICT DO NOTHING")
+        cur.execute(query)
+        result.set(staged, "inserted")
+
+    return apply
+
+
+@router.post("/api/data/{table_name}/bulk")
+def bulk_create(table_name: str, payload: BulkCreatePayload):
+    rows = payload.rows
+    check_table(table_name, sorted({c for row in rows for c in row}))
+    groups = _group_rows(rows, lambda row: tuple(sorted(row)))
+    return _run(table_name, len(rows), payload.atomic, groups,
+                _insert_group(table_name, payload.on_conflict), "批次新增完成")
+
+
+# ==========================================
+# 批次更新
+# ==========================================
+def _update_group(table_name):
+    encoded = schema.encoded_columns(table_name)
+
+    def apply(cur, shape, members, result):
+        data_columns, condition_columns = shape
+        staged, added = [], {}
+        for row, item in members:
+            if not item.conditions:
+                result.fail(row, "無法更新：找不到原始資料對應條件")
+            elif not item.data:
+                result.fail(row, "沒有要更新的欄位")
+            else:
+                data = dictionary.encode_for_write(cur, item.data, encoded, added)
+                conditions = dictionary.encode_values(item.conditions, encoded)
+                staged.append((row, [data[c] for c in data_columns] + [conditions[c] for c in condition_columns]))
+        if result.should_abort() or not staged:
+            return
+
+        # 同一個欄位可能同時出現在 data 跟 conditions (例如改主鍵)，所以分成 v* / k* 兩組別名
+        values = {c: "v%d" % i for i, c in enumerate(data_columns)}
+        keys = {c: "k%d" % i for i, c in enumerate(condition_columns)}
+        columns = [(values[c], c) for c in data_columns] + [(keys[c], c) for c in condition_columns]
+        _create_stage(cur, table_name, columns)
+        staged = _load_stage(cur, columns, staged, result)
+        if result.should_abort() or not staged:
+            return
+
+        _check_foreign_keys(cur, table_name, values, result)
+        _check_duplicates(cur, list(keys.values()), result, "同一批資料裡更新條件重複")
+        if result.should_abort():
+            return
+        _drop_from_stage(cur, result.failed(staged))
+
+        query = sql.SQL("UPDATE {} AS t SET {} FROM {} b WHERE {} RETURNING b._row").format(
+            sql.Identifier(table_name),
+            sql.SQL(", ").join(
+                sql.SQL("{} = b.{}").format(sql.Identifier(c), sql.Identifier(values[c])) for c in data_columns
+            ),
+            STAGE,
+            _match("t", "b", keys.items()),
+        )
+        result.set(set(_select_rows(cur, query)), "updated")
+        result.set(staged, "not_found")
+
+    return apply
+
+
+@router.put("/api/data/{table_name}/bulk")
+def bulk_update(table_name: str, payload: BulkUpdatePayload):
+    rows = payload.rows
+    check_table(table_name, sorted({c for item in rows for c in list(item.data) + list(item.conditions)}))
+    groups = _group_rows(rows, lambda item: (tuple(sorted(item.data)), tuple(sorted(item.conditions))))
+    return _run(table_name, len(rows), payload.atomic, groups, _update_group(table_name), "批次更新完成")
+
+
+# ==========================================
+# 批次刪除
+# ==========================================
+def _delete_group(table_name):
+    encoded = schema.encoded_columns(table_name)
+
+    def apply(cur, condition_columns, members, result):
+        staged = []
+        for row, conditions in members:
+            if not conditions:
+                result.fail(row, "沒有刪除條件")
+            else:
+                conditions = dictionary.encode_values(conditions, encoded)
+                staged.append((row, [conditions[c] for c in condition_columns]))
+        if result.should_abort() or not staged:
+            return
+
+        keys = {c: "k%d" % i for i, c in enumerate(condition_columns)}
+        columns = [(keys[c], c) for c in condition_columns]
+        _create_stage(cur, table_name, columns)
+        staged = _load_stage(cur, columns, staged, result)
+        if result.should_abort() or not staged:
+            return
+
+        # 還被其他表的外鍵參照的資料刪不掉，先找出來
+        for child, fk in schema.referenced_by(table_name):
+            query = sql.SQL("SELECT DISTINCT b._row FROM {} b JOIN {} t ON {} JOIN {} c ON {}").format(
+                STAGE, sql.Identifier(table_name), _match("t", "b", keys.items()),
+                sql.Identifier(child), _match("c", "t", zip(fk["columns"], fk["ref_columns"])),
+            )
+            for row in _select_rows(cur, query):
+                if row not in result.errors:
+                    result.fail(row, f"{child} 還有資料參照這筆，無法刪除")
+        if result.should_abort():
+            return
+        _drop_from_stage(cur, result.failed(staged))
+
+        query = sql.SQL("DELETE FROM {} AS t USING {} b WHERE {} RETURNING b._row").format(
+            sql.Identifier(table_name), STAGE, _match("t", "b", keys.items())
+        )
+        result.set(set(_select_rows(cur, query)), "deleted")
+        result.set(staged, "not_found")
+
+    return apply
+
+
+@router.post("/api/data/{table_name}/bulk/delete")
+def bulk_delete(table_name: str, payload: BulkDeletePayload):
+    rows = payload.rows
+    check_table(table_name, sorted({c for row in rows for c in row}))
+    groups = _group_rows(rows, lambda row: tuple(sorted(row)))
+    return _run(table_name, len(rows), payload.atomic, groups, _delete_group(table_name), "批次刪除完成")
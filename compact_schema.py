@@ -0,0 +1,275 @@
+"""
+精簡格式 (compact schema)：重複出現的短字串欄位改存 smallint 代碼 (dictionary encoding)
+
+code_module / code_presentation 在 student_vle、student_info、student_registration、student_assessment
+每一筆都重複一次 VARCHAR，還出現在複合主鍵與外鍵的索引裡，其實全部只有 22 種 module-presentation。
+import.py --compact 時：
+- ENCODED_COLUMNS 這幾個欄位在所有表都改成 SMALLINT (外鍵兩邊型別一樣，主鍵 / 外鍵照舊)，
+  代碼 ↔ 字串對照存在 value_dictionary 表
+- 匯入：先用原本的 init.sql 在 LOAD_SCHEMA 建一份文字版 (UNLOGGED) 的表，照平常的方式 (csv_import.py) 匯入，
+  再從裡面的值建代碼表、一張表一次 INSERT ... SELECT (JOIN 代碼表) 寫進正式表，最後把 LOAD_SCHEMA 整個刪掉
+- 代碼依字串排序給號，所以 ORDER BY 代碼 跟 ORDER BY 字串 順序一樣 (之後 API 新增的值接在後面，排序就不一定了)
+
+API 這邊完全看不到代碼：schema_cache 載入結構時順便讀代碼表 (dictionary)，這些欄位對外的型別還是 character varying；
+- /api/data、export、stats 讀出來的代碼換回字串；篩選條件的字串先在代碼表裡找出符合的代碼，
+  變成 欄位 = ANY(代碼陣列) (所以 prefix / 範圍條件也能用，比較方式是 Python 的字串比較)
+- 新增 / 修改時字串換成代碼，代碼表裡沒有的值自動新增；當條件用的值不在代碼表裡就是比對不到
+- 代碼表有變動時 trigger 會 NOTIFY schema_changed，各個 worker 的 schema_cache 跟著重新載入
+
+不能跟 --fast / --partition / --incremental 一起用。
+比較一般 / 精簡格式的大小與查詢時間：python bench/bench_compact.py
+"""
+import re
+import threading
+import time
+
+from psycopg2 import sql
+
+ENCODED_COLUMNS = ("code_module", "code_presentation", "activity_type", "imd_band", "age_band")
+DICTIONARY_TABLE = "value_dictionary"
+# 匯入時文字版的表放在這個 schema
+LOAD_SCHEMA = "compact_load"
+# smallint 最大值
+MAX_CODE = 32767
+# 代碼表裡找不到代碼時最多幾秒重新載入一次 (可能是別的 worker 剛新增的)
+MISS_RELOAD_INTERVAL = 5
+# 同時有人新增值、搶到同一個代碼時重試幾次
+ADD_RETRIES = 5
+
+CREATE_DICTIONARY = f"""
+CREATE TABLE {DICTIONARY_TABLE} (
+    column_name VARCHAR(64) NOT NULL,
+    code SMALLINT NOT NULL,
+    value VARCHAR(45) NOT NULL,
+    PRIMARY KEY (column_name, code),
+    UNIQUE (column_name, value)
+);
+
+-- 代碼表有變動時通知 API 重新載入 (schema_cache.NOTIFY_CHANNEL)
+CREATE OR REPLACE FUNCTION {DICTIONARY_TABLE}_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('schema_changed', '{DICTIONARY_TABLE}');
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER {DICTIONARY_TABLE}_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {DICTIONARY_TABLE}
+    FOR EACH STATEMENT EXECUTE FUNCTION {DICTIONARY_TABLE}_notify();
+"""
+
+DICTIONARY_EXISTS = f"SELECT to_regclass('public.{DICTIONARY_TABLE}') IS NOT NULL"
+LOAD_DICTIONARY = f"SELECT column_name, code, value FROM {DICTIONARY_TABLE}"
+
+# 新增一個值：代碼 = 目前最大 + 1；別人同時新增同一個值 / 搶到同一個代碼時 DO NOTHING，再查一次
+ADD_VALUE = sql.SQL(f"""
+    INSERT INTO {DICTIONARY_TABLE} (column_name, code, value)
+    SELECT {{}}, COALESCE(MAX(code), 0) + 1, {{}} FROM {DICTIONARY_TABLE} WHERE column_name = {{}}
+    ON CONFLICT DO NOTHING
+    RETURNING code
+""").format(sql.Placeholder(), sql.Placeholder(), sql.Placeholder())
+FIND_VALUE = sql.SQL(f"SELECT code FROM {DICTIONARY_TABLE} WHERE column_name = {{}} AND value = {{}}").format(
+    sql.Placeholder(), sql.Placeholder())
+
+# 篩選條件在字串上怎麼比 (null 不用換代碼)
+_MATCHERS = {
+    "eq": lambda v, x: v == x,
+    "ne": lambda v, x: v != x,
+    "lt": lambda v, x: v < x,
+    "lte": lambda v, x: v <= x,
+    "gt": lambda v, x: v > x,
+    "gte": lambda v, x: v >= x,
+    "in": lambda v, x: v in x,
+    "prefix": lambda v, x: v.startswith(x),
+}
+
+
+# ---------- 建表 / 匯入 (import.py --compact) ----------
+def compact_init_sql(init_sql):
+    """init.sql 裡 ENCODED_COLUMNS 的 VARCHAR 欄位改成 SMALLINT，再加上代碼表"""
+    pattern = r"\b(" + "|".join(ENCODED_COLUMNS) + r")\s+VARCHAR\s*\(\s*\d+\s*\)"
+    return re.sub(pattern, r"\1 SMALLINT", init_sql, flags=re.I) + CREATE_DICTIONARY
+
+
+def load_init_sql(init_sql):
+    """匯入用的文字版：原本的 init.sql，表都是 UNLOGGED (只是中繼，不用寫 WAL)"""
+    return re.sub(r"CREATE TABLE", "CREATE UNLOGGED TABLE", init_sql, flags=re.I)
+
+
+def _table_columns(cur, schema_name, table_name):
+    cur.execute("""
+        SELECT a.attname FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(%s) AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """, (f"{schema_name}.{table_name}",))
+    return [row[0] for row in cur.fetchall()]
+
+
+def build_dictionary(cur, tables):
+    """LOAD_SCHEMA 裡各表出現過的值依字串排序給代碼，回傳 {欄位: 幾種值}"""
+    counts = {}
+    for column in ENCODED_COLUMNS:
+        sources = [t for t in tables if column in _table_columns(cur, LOAD_SCHEMA, t)]
+        if not sources:
+            continue
+        union = sql.SQL(" UNION ").join(
+            sql.SQL("SELECT {} AS value FROM {}").format(sql.Identifier(column), sql.Identifier(LOAD_SCHEMA, t))
+            for t in sources
+        )
+        cur.execute(sql.SQL("""
+            INSERT INTO {} (column_name, code, value)
+            SELECT %s, row_number() OVER (ORDER BY value), value
+            FROM (SELECT DISTINCT value FROM ({}) u WHERE value IS NOT NULL) v
+        """).format(sql.Identifier(DICTIONARY_TABLE), union), (column,))
+        counts[column] = cur.rowcount
+        if cur.rowcount > MAX_CODE:
+            raise ValueError(f"{column} 有 {cur.rowcount} 種值，超過 smallint 能表示的 {MAX_CODE} 種")
+    return counts
+
+
+def encode_table(cur, table_name):
+    """LOAD_SCHEMA 裡的文字版 → 正式表 (代碼)，回傳筆數"""
+    columns = _table_columns(cur, "public", table_name)
+    joins, select = [], []
+    for i, column in enumerate(columns):
+        if column in ENCODED_COLUMNS:
+            alias = sql.Identifier(f"d{i}")
+            joins.append(sql.SQL(" LEFT JOIN {} {} ON {}.column_name = {} AND {}.value = s.{}").format(
+                sql.Identifier(DICTIONARY_TABLE), alias, alias, sql.Literal(column), alias, sql.Identifier(column)))
+            select.append(sql.SQL("{}.code").format(alias))
+        else:
+            select.append(sql.SQL("s.{}").format(sql.Identifier(column)))
+    cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} s{}").format(
+        sql.Identifier(table_name), sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(", ").join(select), sql.Identifier(LOAD_SCHEMA, table_name), sql.Composed(joins)))
+    return cur.rowcount
+
+
+def drop_load_schema(cur):
+    cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(LOAD_SCHEMA)))
+
+
+# ---------- API 用：代碼 ↔ 字串 ----------
+class ValueDictionary:
+    """代碼表的記憶體副本，由 schema_cache 載入結構時一起載入"""
+
+    def __init__(self):
+        self._values = {}   # 欄位 → {代碼: 字串}
+        self._codes = {}    # 欄位 → {字串: 代碼}
+        self._lock = threading.Lock()
+        self._last_miss_reload = 0.0
+        # 找不到代碼時呼叫 (schema_cache 設定成重新載入)
+        self.reload = None
+
+    def load(self, cur):
+        """一般格式 (沒有代碼表) 時清空，之後什麼都不換"""
+        cur.execute(DICTIONARY_EXISTS)
+        rows = []
+        if cur.fetchone()[0]:
+            cur.execute(LOAD_DICTIONARY)
+            rows = cur.fetchall()
+        values = {}
+        for column, code, value in rows:
+            values.setdefault(column, {})[code] = value
+        codes = {column: {v: c for c, v in mapping.items()} for column, mapping in values.items()}
+        with self._lock:
+            self._values, self._codes = values, codes
+
+    def covers(self, column):
+        return column in self._values
+
+    def _reload_on_miss(self):
+        now = time.monotonic()
+        if self.reload is not None and now - self._last_miss_reload > MISS_RELOAD_INTERVAL:
+            self._last_miss_reload = now
+            self.reload()
+            return True
+        return False
+
+    def decode(self, column, code):
+        if code is None:
+            return None
+        value = self._values.get(column, {}).get(code)
+        if value is None and self._reload_on_miss():
+            value = self._values.get(column, {}).get(code)
+        return value if value is not None else code
+
+    def decode_rows(self, columns, rows, encoded):
+        """tuple 列裡 encoded 欄位的代碼換回字串"""
+        indexes = [(i, c) for i, c in enumerate(columns) if c in encoded]
+        if not indexes:
+            return rows
+        decoded = []
+        for row in rows:
+            row = list(row)
+            for i, column in indexes:
+                row[i] = self.decode(column, row[i])
+            decoded.append(tuple(row))
+        return decoded
+
+    def decode_dicts(self, rows, encoded):
+        """dict 列 (RealDictCursor) 同上"""
+        for row in rows:
+            for column in encoded & row.keys():
+                row[column] = self.decode(column, row[column])
+        return rows
+
+    def encode_filters(self, filters, encoded):
+        """filters.parse_filters 的結果裡 encoded 欄位的條件換成 欄位 in [符合的代碼]"""
+        result = []
+        for column, op, value in filters:
+            if column not in encoded or op == "null":
+                result.append((column, op, value))
+                continue
+            match, target = _MATCHERS[op], set(value) if op == "in" else value
+            codes = sorted(c for c, v in self._values.get(column, {}).items() if match(v, target))
+            result.append((column, "in", codes))
+        return result
+
+    def encode(self, column, value):
+        """字串 → 代碼，代碼表裡沒有回傳 None"""
+        return None if value is None else self._codes.get(column, {}).get(str(value))
+
+    def missing(self, data, encoded):
+        """data 裡代碼表還沒有的 (欄位, 值)"""
+        return [(c, str(v)) for c, v in data.items()
+                if c in encoded and v is not None and self.encode(c, v) is None]
+
+    def encode_values(self, data, encoded, added=None):
+        """
+        {欄位: 值} 裡 encoded 欄位換成代碼。added = {(欄位, 值): 代碼} 是這次才新增的；
+        還是找不到的值換成 None (當條件時比對不到任何資料)
+        """
+        added = added or {}
+        return {c: (self.encode(c, v) or added.get((c, str(v))) if c in encoded and v is not None else v)
+                for c, v in data.items()}
+
+    def add(self, cur, column, value):
+        """新增一個值 (跟著目前的交易 commit)，回傳代碼；已經有了就回傳原本的代碼"""
+        for _ in range(ADD_RETRIES):
+            cur.execute(ADD_VALUE, (column, value, column))
+            row = cur.fetchone()
+            if row is None:
+                cur.execute(FIND_VALUE, (column, value))
+                row = cur.fetchone()
+            if row is not None:
+                return row[0]
+        raise RuntimeError(f"無法新增 {column} = {value!r} 到代碼表")
+
+    def encode_for_write(self, cur, data, encoded, added=None):
+        """
+        寫入用：代碼表沒有的值先新增，再換成代碼。
+        added：同一個交易裡已經新增過的 {(欄位, 值): 代碼} (批次寫入時同一個新值不用每筆都查一次)
+        """
+        added = {} if added is None else added
+        for column, value in self.missing(data, encoded):
+            if (column, value) not in added:
+                added[(column, value)] = self.add(cur, column, value)
+        return self.encode_values(data, encoded, added)
+
+
+def decode_sql(column, expression):
+    """SQL 裡把代碼換回字串 (export 用 COPY 直接輸出，沒辦法在 Python 這邊換)"""
+    return sql.SQL("(SELECT value FROM {} WHERE column_name = {} AND code = {})").format(
+        sql.Identifier(DICTIONARY_TABLE), sql.Literal(column), expression)
+
+
+dictionary = ValueDictionary()
@@ -1,14 +1,22 @@
 import psycopg2
 from psycopg2 import sql
 import os
+import time
+from urllib.parse import parse_qsl
 from dotenv import load_dotenv
 from tabulate import tabulate
 
+from filters import compile_filters, parse_filters
+
 load_dotenv()
 PASSWORD = os.getenv("PASSWORD")
 DB_NAME = "final_project"
 TABLE_LIST = ["assessments", "courses", "student_assessment",
               "student_info", "student_registration", "student_vle", "vle"]
+# 查詢結果一頁顯示幾筆 (以前是 fetchall 整張表再一次印出來，student_vle 要等好幾分鐘、吃好幾 GB 記憶體)
+PAGE_SIZE = int(os.getenv("CLI_PAGE_SIZE", "50"))
+# 「印出剩下全部」時每次從伺服器拿幾筆 (named cursor 的 itersize)
+CLI_ITERSIZE = int(os.getenv("CLI_ITERSIZE", "2000"))
 
 conn = psycopg2.connect(
     host="localhost",
@@ -36,23 +44,104 @@ def get_columns(table_name):
     return [desc[0] for desc in cur.description]
 
 
+def get_column_types(table_name):
+    cur.execute(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = %s",
+        (table_name,)
+    )
+    return dict(cur.fetchall())
+
+def askForConditions(table_name):
+    """
+    選填的查詢條件與筆數上限，條件語法跟 /api/data 一樣 (見 filters.py)，例如
+    code_presentation=2014J&sum_click[gte]=5。回傳 (WHERE 條件或 None, 參數, 上限或 None)
+    """
+    text = input("條件 (例如 code_presentation=2014J&sum_click[gte]=5，直接 Enter = 全部)> ").strip()
+    filters = parse_filters(parse_qsl(text, keep_blank_values=True), get_column_types(table_name))
+    where, params = compile_filters(filters)
+    limit = input("最多幾筆 (直接 Enter = 不限)> ").strip()
+    return where, params, int(limit) if limit else None
+
+def browse(table, order_by=None, order="ASC"):
+    """
+    用 named cursor (伺服器端 cursor) 分頁顯示查詢結果：資料留在資料庫，每次只拿一頁，
+    所以不管表多大，第一頁都一樣快 (有排序時要看排序欄位有沒有索引)。
+    cursor 是 SCROLL 的，可以往回翻、跳頁
+    """
+    where, params, limit = askForConditions(table)
+    query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table))
+    if where is not None:
+        query += sql.SQL(" WHERE ") + where
+    if order_by:
+        query += sql.SQL(" ORDER BY {} {}").format(sql.Identifier(order_by), sql.SQL(order))
+    if limit is not None:
+        query += sql.SQL(" LIMIT {}").format(sql.Literal(limit))
+
+    # named cursor 只在交易裡有效，看完就 rollback (只有讀取)
+    browse_cur = conn.cursor(name="cli_browse", scrollable=True)
+    browse_cur.itersize = CLI_ITERSIZE
+    try:
+        browse_cur.execute(query, params)
+        page = shown = 0
+        while True:
+            start = time.perf_counter()
+            browse_cur.scroll(page * PAGE_SIZE, mode="absolute")
+            rows = browse_cur.fetchmany(PAGE_SIZE)
+            elapsed = time.perf_counter() - start
+            if not rows:
+                if page == 0:
+                    print("（沒有資料）\n")
+                    return
+                print("❌ 沒有這一頁")
+                page = shown
+                continue
+            cols = [d[0] for d in browse_cur.description]
+            last = len(rows) < PAGE_SIZE
+            shown = page
+
+            print()
+            print(tabulate(rows, headers=cols, tablefmt="psql"))
+            first_row = page * PAGE_SIZE + 1
+            print(f"第 {page + 1} 頁 (第 {first_row} ~ {first_row + len(rows) - 1} 筆{'，最後一頁' if last else ''}，"
+                  f"{elapsed:.3f} 秒)")
+
+            command = input("Enter/n 下一頁，p 上一頁，數字 跳到第幾頁，a 印出剩下全部，q 結束> ").strip().lower()
+            if command in ("", "n"):
+                if last:
+                    print("（已經是最後一頁）")
+                else:
+                    page += 1
+            elif command == "p":
+                page = max(0, page - 1)
+            elif command.isdigit() and int(command) >= 1:
+                page = int(command) - 1
+            elif command == "a":
+                # 剩下的照 itersize 一批一批拿、一批一批印，記憶體裡最多一批
+                browse_cur.scroll((page + 1) * PAGE_SIZE, mode="absolute")
+                while True:
+                    batch = browse_cur.fetchmany(CLI_ITERSIZE)
+                    if not batch:
+                        break
+                    print(tabulate(batch, headers=cols, tablefmt="psql"))
+                print()
+                return
+            elif command == "q":
+                print()
+                return
+            else:
+                print("❌ 無效選項")
+    finally:
+        browse_cur.close()
+        conn.rollback()
+
 def retrieve_data():
     table = askForTable()
     try:
-        query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table))
-        cur.execute(query)
-
-        rows = cur.fetchall()
-        cols = [d[0] for d in cur.description]
-
-        if not rows:
-            print("（沒有資料）\n")
-            return
-
-        print()
-        print(tabulate(rows, headers=cols, tablefmt="psql"))
-        print()
-
+        browse(table)
+    except ValueError as e:
+        conn.rollback()
+        print("❌ 輸入錯誤:", e)
     except Exception as e:
         conn.rollback()
         print("❌ 查詢失敗:", e)
@@ -66,27 +155,17 @@ def retrieve_data_sorted():
     for i, c in enumerate(cols, 1):
         print(f"{i}. {c}")
 
-    idx = int(input("欄位編號> "))
-    order = input("排序方向 (ASC/DESC)> ").upper()
-
-    if idx == 0:
-        query = sql.SQL("SELECT * FROM {}").format(
-            sql.Identifier(table)
-        )
-    else:
-        query = sql.SQL(
-            "SELECT * FROM {} ORDER BY {} {}"
-        ).format(
-            sql.Identifier(table),
-            sql.Identifier(cols[idx - 1]),
-            sql.SQL(order if order in ("ASC", "DESC") else "ASC")
-        )
-
-    cur.execute(query)
-    rows = cur.fetchall()
-    cols_name = [d[0] for d in cur.description]
-
-    print(tabulate(rows, headers=cols_name, tablefmt="psql"))
+    try:
+        idx = int(input("欄位編號> "))
+        order = input("排序方向 (ASC/DESC)> ").upper()
+        order_by = cols[idx - 1] if idx > 0 else None
+        browse(table, order_by, order if order in ("ASC", "DESC") else "ASC")
+    except (IndexError, ValueError) as e:
+        conn.rollback()
+        print("❌ 輸入錯誤:", e)
+    except Exception as e:
+        conn.rollback()
+        print("❌ 查詢失敗:", e)
 
 def add_data():
     table = askForTable()
@@ -0,0 +1,522 @@
+"""
+CSV → PostgreSQL 串流匯入 (import.py 用)
+
+以前每個 CSV 都是 pd.read_csv 整個讀進來、再 to_csv 成一整個 StringIO 才 COPY，
+student_vle 這種大檔同時會有好幾份完整的資料在記憶體裡。現在：
+- 不需要轉換的表：檔案直接一段一段餵給 COPY FROM STDIN，Python 這邊只佔一個讀取緩衝區
+- 需要轉換的表 (courses、student_assessment)：pd.read_csv(chunksize=...) 一次讀一塊、轉換、
+  轉成 CSV 文字，經由 CopyStream 這個 file-like 邊產生邊讓 COPY 讀走，記憶體裡只有目前這一塊
+- student_vle 的去重 (同一個主鍵的 sum_click 加總)：先 COPY 進暫存表，
+  再由 PostgreSQL 用 GROUP BY 寫進正式表，資料量超過 work_mem 時由資料庫自己落地到磁碟
+
+記憶體上限用 IMPORT_MEMORY_MB (環境變數) 或 import.py --memory-mb 設定，
+決定 pandas 每塊讀幾筆。
+
+平行匯入 (import_parallel)：從 init.sql 的外鍵找出表格之間的相依關係，
+父表都匯入完的表就開始匯入 (courses → vle / assessments / student_info → …)，
+大檔 (student_vle) 再切成幾段用不同連線同時 COPY。
+student_vle 分區時 (import.py --partition) 每個學期各自 GROUP BY，直接寫進自己的分區。
+
+上傳的 CSV (import_stream，POST /api/import/{table_name} 用，見 import_jobs.py)：
+來源是一邊收一邊讀的 file-like，不能先取樣或切段，其餘轉換跟上面一樣。
+"""
+import csv
+import itertools
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+from psycopg2 import sql
+
+# Python 這邊匯入時大約最多用多少記憶體 (MB)
+IMPORT_MEMORY_MB = int(os.getenv("IMPORT_MEMORY_MB", "256"))
+# COPY 每次從檔案 / CopyStream 讀多少 bytes
+COPY_READ_BYTES = 1024 * 1024
+# 估計每筆資料大小時先讀幾筆
+SAMPLE_ROWS = 1000
+# 平行匯入時，檔案超過這個大小才切段同時 COPY
+PARTITION_MIN_BYTES = int(os.getenv("IMPORT_PARTITION_MIN_MB", "16")) * 1024 * 1024
+
+STUDENT_VLE_KEY = ["id_student", "id_site", "code_module", "code_presentation", "date"]
+STUDENT_VLE_NOT_NULL = " AND ".join(f"{c} IS NOT NULL" for c in STUDENT_VLE_KEY)
+# 平行匯入 student_vle 用的暫存表 (UNLOGGED、各連線共用，所以不能是 TEMP)
+STUDENT_VLE_STAGING = "student_vle_staging"
+# 匯入失敗時要一起清掉的暫存表 (import_parallel)
+STAGING_TABLES = {"student_vle": [STUDENT_VLE_STAGING]}
+# 上傳的 CSV 標題列：欄位名稱會直接組進 COPY 的欄位清單，只接受這種格式
+_COLUMN_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class CopyStream:
+    """把一塊一塊產生的 CSV 文字包成 copy_expert 讀得懂的 file-like，只留目前這一塊在記憶體"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buf):
+            try:
+                self._buf = next(self._chunks).encode("utf-8")
+            except StopIteration:
+                self._buf = b""
+                self._pos = 0
+                return b""
+            self._pos = 0
+        if size is None or size < 0:
+            size = len(self._buf) - self._pos
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def chunk_rows(file_path, memory_mb=IMPORT_MEMORY_MB, **read_kwargs):
+    """
+    依記憶體上限估計 pandas 每塊讀幾筆：
+    先讀 SAMPLE_ROWS 筆量 DataFrame 的實際大小，一塊同時會有 DataFrame + 轉出來的 CSV 文字 + 編碼後的 bytes，
+    再留一半給 pandas 轉換時的暫存
+    """
+    sample = pd.read_csv(file_path, nrows=SAMPLE_ROWS, **read_kwargs)
+    if sample.empty:
+        return SAMPLE_ROWS
+    frame_bytes = sample.memory_usage(deep=True).sum() / len(sample)
+    text_bytes = len(sample.to_csv(index=False, header=False)) / len(sample)
+    per_row = frame_bytes + 2 * text_bytes
+    return max(SAMPLE_ROWS, int(memory_mb * 1024 * 1024 / 2 / per_row))
+
+
+def read_csv_chunks(file_path, memory_mb=IMPORT_MEMORY_MB, **read_kwargs):
+    """分塊讀 CSV；一律當字串讀，數值原樣送給 PostgreSQL，不會被 pandas 轉成 1.0 之類的格式"""
+    read_kwargs.setdefault("dtype", str)
+    rows = chunk_rows(file_path, memory_mb, **read_kwargs)
+    return pd.read_csv(file_path, chunksize=rows, **read_kwargs)
+
+
+def frames_to_csv(frames):
+    for df in frames:
+        yield df.to_csv(index=False, header=False, na_rep="")
+
+
+def copy_sql(table_name, columns=None, header=False, force_null=None):
+    """COPY ... FROM STDIN (CSV；空欄位是 NULL，force_null 的欄位連 "" 也當 NULL，跟 pandas 讀檔時一樣)"""
+    target = table_name if columns is None else f"{table_name} ({', '.join(columns)})"
+    options = ["FORMAT CSV", "NULL ''"]
+    if header:
+        options.append("HEADER")
+    if force_null:
+        options.append(f"FORCE_NULL ({', '.join(force_null)})")
+    return f"COPY {target} FROM STDIN WITH ({', '.join(options)})"
+
+
+class RangeReader:
+    """只讀檔案裡 [start, end) 這一段的 file-like，給分段平行 COPY 用"""
+
+    def __init__(self, f, start, end):
+        self._f = f
+        self._left = end - start
+        f.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+
+def split_file(file_path, parts):
+    """
+    依檔案大小切成 parts 段，切點對齊到下一個換行，回傳 [(start, end), ...]；第一段包含標題列。
+    (假設欄位值裡沒有換行，OULAD 的 CSV 都是這樣)
+    """
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, parts):
+            f.seek(size * i // parts)
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def copy_file(cur, table_name, file_path, columns=None, byte_range=None):
+    """不需要轉換：檔案直接串流給 COPY (跳過標題列)；byte_range=(start, end) 時只送那一段"""
+    if columns is None:
+        cur.execute(f"SELECT * FROM {table_name} LIMIT 0")
+        columns = [d[0] for d in cur.description]
+        target_columns = None
+    else:
+        target_columns = columns
+    header = byte_range is None or byte_range[0] == 0
+    with open(file_path, "rb") as f:
+        source = f if byte_range is None else RangeReader(f, *byte_range)
+        cur.copy_expert(copy_sql(table_name, target_columns, header=header, force_null=columns), source,
+                        size=COPY_READ_BYTES)
+
+
+def copy_frames(cur, table_name, frames, columns=None):
+    """一塊一塊的 DataFrame 經由 CopyStream 餵給 COPY"""
+    cur.copy_expert(copy_sql(table_name, columns), CopyStream(frames_to_csv(frames)), size=COPY_READ_BYTES)
+
+
+# ---------- 各表的轉換 ----------
+def split_presentation(df):
+    """courses：code_presentation 拆成年份 / 月份 (複合屬性拆分)"""
+    df["presentation_year"] = df["code_presentation"].str[:4].astype(int)
+    df["presentation_month"] = df["code_presentation"].str[4:]
+    return df
+
+
+def load_assessment_bridge(data_dir="data"):
+    """student_assessment 要補的 code_module / code_presentation (assessments 很小，整個讀進來)"""
+    return pd.read_csv(os.path.join(data_dir, "assessments.csv"), dtype=str)[
+        ["id_assessment", "code_module", "code_presentation"]
+    ]
+
+
+def query_assessment_bridge(cur):
+    """同 load_assessment_bridge，但從資料庫裡的 assessments 讀 (上傳時用)"""
+    cur.execute("SELECT id_assessment::text, code_module, code_presentation FROM assessments")
+    return pd.DataFrame(cur.fetchall(), columns=["id_assessment", "code_module", "code_presentation"])
+
+
+def add_assessment_course(df, bridge):
+    """student_assessment：依 id_assessment 補上 code_module / code_presentation"""
+    return pd.merge(df, bridge, on="id_assessment", how="left")
+
+
+# ---------- 匯入一張表 ----------
+# 每張表的匯入計畫 = 依序執行的幾個階段，同一個階段裡的每一段可以用不同連線同時跑：
+#     [[(名稱, fn(cur)), ...], [...], ...]
+# 單一連線 (import_table) 時就照順序一段一段跑
+
+def _file_parts(file_path, partitions):
+    """檔案夠大才切段 (小檔切了只是多開連線)"""
+    if partitions <= 1 or os.path.getsize(file_path) < PARTITION_MIN_BYTES:
+        return [None]
+    return split_file(file_path, partitions)
+
+
+def _part_name(i, parts):
+    return "" if len(parts) == 1 else f"part {i + 1}/{len(parts)}"
+
+
+def plan_copy(table_name, file_path, columns=None, partitions=1):
+    parts = _file_parts(file_path, partitions)
+    return [[
+        (_part_name(i, parts), lambda cur, r=r: copy_file(cur, table_name, file_path, columns, r))
+        for i, r in enumerate(parts)
+    ]]
+
+
+def plan_courses(file_path, memory_mb=IMPORT_MEMORY_MB, data_dir="data", partitions=1, targets=None):
+    def load(cur):
+        columns = list(pd.read_csv(file_path, nrows=0).columns) + ["presentation_year", "presentation_month"]
+        frames = (split_presentation(df) for df in read_csv_chunks(file_path, memory_mb))
+        copy_frames(cur, "courses", frames, columns)
+    return [[("", load)]]
+
+
+def plan_assessments(file_path, memory_mb=IMPORT_MEMORY_MB, data_dir="data", partitions=1, targets=None):
+    return plan_copy("assessments", file_path,
+                     ["code_module", "code_presentation", "id_assessment", "assessment_type", "date", "weight"],
+                     partitions)
+
+
+def plan_student_assessment(file_path, memory_mb=IMPORT_MEMORY_MB, data_dir="data", partitions=1, targets=None):
+    def load(cur):
+        bridge = load_assessment_bridge(data_dir)
+        frames = (add_assessment_course(df, bridge) for df in read_csv_chunks(file_path, memory_mb))
+        copy_frames(cur, "student_assessment", frames)
+    return [[("", load)]]
+
+
+def plan_student_vle(file_path, memory_mb=IMPORT_MEMORY_MB, data_dir="data", partitions=1, targets=None):
+    """
+    原始資料同一個主鍵會有好幾筆，要把 sum_click 加總。
+    先原樣 COPY 進暫存表 (UNLOGGED、沒有主鍵)，再 GROUP BY 寫進正式表，
+    跟以前 pandas groupby(...).sum() 的結果一樣：主鍵有 NULL 的丟掉、全是 NULL 的 sum_click 算 0。
+    資料量超過 work_mem 時由資料庫自己落地到磁碟，不佔 Python 的記憶體。
+    平行時：檔案切段同時 COPY 進暫存表，再依 id_student 分成幾份同時 GROUP BY
+    (同一個主鍵一定落在同一份，所以分開加總結果一樣)。
+    student_vle 有分區時 (targets = [(分區, 學期), ...]，見 partitioning.py) 改成每個學期一份，
+    直接寫進那個學期的分區 (不用逐筆判斷要放哪個分區，不同學期也不會搶同一個索引)，
+    不在 targets 裡的學期最後經由父表寫進 DEFAULT 分區。
+    這時暫存表也依學期分區 (COPY 時就分好)，每個學期只讀自己那一份，不用每一步都掃整張暫存表
+    """
+    not_null = STUDENT_VLE_NOT_NULL
+    buckets = max(1, partitions) if _file_parts(file_path, partitions) != [None] else 1
+
+    leaves = (targets or {}).get("student_vle")
+
+    def create_staging(cur):
+        cur.execute(f"DROP TABLE IF EXISTS {STUDENT_VLE_STAGING}")
+        if not leaves:
+            cur.execute(f"CREATE UNLOGGED TABLE {STUDENT_VLE_STAGING} AS SELECT * FROM student_vle WITH NO DATA")
+            return
+        # 分區表的父表不能是 UNLOGGED，各分區可以；LIKE 會帶上 NOT NULL，原始資料的 NULL 要先收進來再丟
+        cur.execute(f"CREATE TABLE {STUDENT_VLE_STAGING} (LIKE student_vle) PARTITION BY LIST (code_presentation)")
+        for column in STUDENT_VLE_KEY + ["sum_click"]:
+            cur.execute(f"ALTER TABLE {STUDENT_VLE_STAGING} ALTER COLUMN {column} DROP NOT NULL")
+        for i, (_, value) in enumerate(leaves):
+            cur.execute(f"CREATE UNLOGGED TABLE {STUDENT_VLE_STAGING}_{i} PARTITION OF {STUDENT_VLE_STAGING} "
+                        f"FOR VALUES IN (%s)", (value,))
+        cur.execute(f"CREATE UNLOGGED TABLE {STUDENT_VLE_STAGING}_default PARTITION OF {STUDENT_VLE_STAGING} DEFAULT")
+
+    def aggregate(cur, bucket):
+        where = not_null if buckets == 1 else f"{not_null} AND id_student % {buckets} = {bucket}"
+        insert_grouped(cur, "student_vle", where)
+
+    def insert_grouped(cur, target, where, params=None, staging=STUDENT_VLE_STAGING):
+        insert_student_vle_grouped(cur, staging, target, where, params)
+
+    def drop_staging(cur):
+        cur.execute(f"DROP TABLE {STUDENT_VLE_STAGING}")
+
+    load = plan_copy(STUDENT_VLE_STAGING, file_path,
+                     ["code_module", "code_presentation", "id_student", "id_site", "date", "sum_click"],
+                     partitions)[0]
+    if leaves:
+        # 暫存表第 i 個分區就是第 i 個學期，DEFAULT 分區是其他學期 (含 NULL，會被 not_null 濾掉)
+        steps = [(f"aggregate {value}",
+                  lambda cur, leaf=leaf, i=i: insert_grouped(cur, leaf, not_null, staging=f"{STUDENT_VLE_STAGING}_{i}"))
+                 for i, (leaf, value) in enumerate(leaves)]
+        steps.append(("aggregate other presentations",
+                      lambda cur: insert_grouped(cur, "student_vle", not_null,
+                                                 staging=f"{STUDENT_VLE_STAGING}_default")))
+    else:
+        steps = [(f"aggregate {b + 1}/{buckets}" if buckets > 1 else "aggregate",
+                  lambda cur, b=b: aggregate(cur, b))
+                 for b in range(buckets)]
+    return [
+        [("create staging", create_staging)],
+        [("copy " + name if name else "copy", fn) for name, fn in load],
+        steps,
+        [("drop staging", drop_staging)],
+    ]
+
+
+def insert_student_vle_grouped(cur, staging, target, where, params=None):
+    """暫存表 staging 裡符合 where 的列，同一個主鍵的 sum_click 加總後寫進 target"""
+    columns = STUDENT_VLE_KEY + ["sum_click"]
+    key = ", ".join(STUDENT_VLE_KEY)
+    cur.execute(sql.SQL(f"""
+        INSERT INTO {{}} ({', '.join(columns)})
+        SELECT {key}, COALESCE(SUM(sum_click), 0)
+        FROM {{}}
+        WHERE {where}
+        GROUP BY {key}
+    """).format(sql.Identifier(target), sql.Identifier(staging)), params)
+
+
+def plan_plain(table_name):
+    def plan(file_path, memory_mb=IMPORT_MEMORY_MB, data_dir="data", partitions=1, targets=None):
+        return plan_copy(table_name, file_path, partitions=partitions)
+    return plan
+
+
+PLANS = {
+    "courses": plan_courses,
+    "assessments": plan_assessments,
+    "student_assessment": plan_student_assessment,
+    "student_vle": plan_student_vle,
+}
+
+
+def plan_table(table_name, data_dir="data", memory_mb=IMPORT_MEMORY_MB, partitions=1, targets=None):
+    file_path = os.path.join(data_dir, f"{table_name}.csv")
+    plan = PLANS.get(table_name, plan_plain(table_name))
+    return plan(file_path, memory_mb=memory_mb, data_dir=data_dir, partitions=partitions, targets=targets)
+
+
+def import_table(cur, table_name, data_dir="data", memory_mb=IMPORT_MEMORY_MB, targets=None):
+    """
+    把 data/{table_name}.csv 匯入 table_name，全部在同一個連線上依序執行 (不 commit)。
+    targets：分區表直接寫進哪些分區 (partitioning.load_targets)，None = 一律經由父表
+    """
+    for phase in plan_table(table_name, data_dir, memory_mb, targets=targets):
+        for _, fn in phase:
+            fn(cur)
+
+
+# ---------- 上傳的 CSV ----------
+def read_header(source):
+    """讀掉標題列，回傳欄位名稱 (上傳的檔案欄位順序不一定跟資料表一樣，COPY 照標題列對應)"""
+    line = source.readline().decode("utf-8-sig")
+    columns = [c.strip() for c in next(csv.reader([line]), [])]
+    if not columns or not all(_COLUMN_NAME.fullmatch(c) for c in columns):
+        raise ValueError(f"CSV 標題列不正確：{line.strip()[:200]!r}")
+    return columns
+
+
+def copy_transformed(cur, table_name, frames, transform):
+    """一塊一塊轉換後 COPY，欄位照轉換後的第一塊；回傳筆數"""
+    frames = (transform(df) for df in frames)
+    try:
+        first = next(frames, None)
+    except KeyError as e:
+        raise ValueError(f"CSV 缺少欄位 {e}") from e
+    if first is None:
+        return 0
+    copy_frames(cur, table_name, itertools.chain([first], frames), list(first.columns))
+    return cur.rowcount
+
+
+def import_stream(cur, table_name, source, chunk_rows, on_phase=None):
+    """
+    上傳的 CSV (binary file-like，第一行是標題列) 匯入 table_name，轉換跟 import_table 一樣 (不 commit)：
+    courses 拆年份 / 月份、student_assessment 補 code_module / code_presentation
+    (從資料庫裡的 assessments 查)、student_vle 同一個主鍵的 sum_click 加總。
+    pandas 每塊讀 chunk_rows 筆；on_phase(名稱)：換階段時呼叫 (回報進度用)。回傳寫進 table_name 的筆數
+    """
+    if on_phase:
+        on_phase("copy")
+    if table_name == "courses":
+        return copy_transformed(cur, table_name, pd.read_csv(source, chunksize=chunk_rows, dtype=str),
+                                split_presentation)
+    if table_name == "student_assessment":
+        bridge = query_assessment_bridge(cur)
+        return copy_transformed(cur, table_name, pd.read_csv(source, chunksize=chunk_rows, dtype=str),
+                                lambda df: add_assessment_course(df, bridge))
+
+    columns = read_header(source)
+    if table_name != "student_vle":
+        cur.copy_expert(copy_sql(table_name, columns, force_null=columns), source, size=COPY_READ_BYTES)
+        return cur.rowcount
+    # 暫存表是這條連線自己的，同時有好幾個上傳也不會互相影響
+    cur.execute("CREATE TEMP TABLE student_vle_upload ON COMMIT DROP AS SELECT * FROM student_vle WITH NO DATA")
+    cur.copy_expert(copy_sql("student_vle_upload", columns, force_null=columns), source, size=COPY_READ_BYTES)
+    if on_phase:
+        on_phase("aggregate")
+    insert_student_vle_grouped(cur, "student_vle_upload", "student_vle", STUDENT_VLE_NOT_NULL)
+    return cur.rowcount
+
+
+# ---------- 平行匯入 ----------
+def table_dependencies(init_sql):
+    """從 init.sql 的 CREATE TABLE / REFERENCES 找出每張表依賴哪些表：{表: {父表, ...}}"""
+    deps = {}
+    for match in re.finditer(r"CREATE TABLE\s+(\w+)\s*\((.*?)\n\)\s*;", init_sql, re.S | re.I):
+        table, body = match.group(1), match.group(2)
+        deps[table] = set(re.findall(r"REFERENCES\s+(\w+)", body, re.I)) - {table}
+    return deps
+
+
+def dependents(table, deps, tables):
+    """tables 裡直接或間接依賴 table 的表 (table 失敗時它們都不會開始)"""
+    found = set()
+    changed = True
+    while changed:
+        changed = False
+        for t in tables:
+            if t != table and t not in found and set(deps.get(t, ())) & (found | {table}):
+                found.add(t)
+                changed = True
+    return [t for t in tables if t in found]
+
+
+def cleanup_failed(connect, table, children=()):
+    """
+    匯入失敗的表：TRUNCATE 掉已經 commit 的部分、DROP 掉暫存表。
+    有外鍵指向它的表要一起 TRUNCATE 才清得掉；它們還沒開始匯入，本來就是空的
+    """
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("TRUNCATE {}").format(
+                sql.SQL(", ").join(map(sql.Identifier, [table, *children]))))
+            for staging in STAGING_TABLES.get(table, []):
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def import_parallel(connect, tables, deps, data_dir="data", memory_mb=IMPORT_MEMORY_MB,
+                    workers=4, partitions=None, targets=None):
+    """
+    依外鍵相依關係平行匯入：父表都匯入完的表就可以開始，同時最多 workers 條連線。
+    大檔切成 partitions 段 (預設 = workers) 同時 COPY。
+    每一段用自己的連線、各自 commit；記憶體上限由所有連線平分。
+    某張表有任何一段失敗：等它其他段跑完，把已經 commit 的部分 TRUNCATE 掉、暫存表 DROP 掉 (cleanup_failed)，
+    不會留下只匯入一半的表。
+    connect()：回傳新的 psycopg2 連線；targets 同 import_table。
+    回傳 (timings, failed)：timings = [(表, 段, 開始秒數, 結束秒數), ...]，failed = {表: 錯誤}
+    """
+    partitions = partitions or workers
+    per_task_memory = max(16, memory_mb // workers)
+    pending = {t: set(deps.get(t, ())) & set(tables) for t in tables}
+    plans = {}
+    timings = []
+    failed = {}
+    done = set()
+    start = time.perf_counter()
+
+    def run(table, name, fn):
+        began = time.perf_counter() - start
+        conn = connect()
+        try:
+            cur = conn.cursor()
+            fn(cur)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return table, name, began, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+
+        def submit_phase(table):
+            for name, fn in plans[table].pop(0):
+                running[pool.submit(run, table, name, fn)] = table
+
+        def start_ready():
+            for table in [t for t, parents in pending.items() if parents <= done]:
+                del pending[table]
+                file_path = os.path.join(data_dir, f"{table}.csv")
+                if not os.path.exists(file_path):
+                    print(f"⚠️ 找不到檔案 {file_path}，跳過...")
+                    done.add(table)
+                    continue
+                plans[table] = plan_table(table, data_dir, per_task_memory, partitions, targets)
+                submit_phase(table)
+
+        start_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                try:
+                    timings.append(future.result())
+                except Exception as e:
+                    failed.setdefault(table, str(e))
+                if any(t == table for t in running.values()):
+                    continue
+                # 這張表目前這個階段全部跑完了
+                if table in failed:
+                    plans.pop(table, None)
+                    try:
+                        cleanup_failed(connect, table, dependents(table, deps, tables))
+                    except Exception as e:
+                        failed[table] += f" (清除失敗：{e})"
+                elif plans[table]:
+                    submit_phase(table)
+                else:
+                    del plans[table]
+                    done.add(table)
+            start_ready()
+
+    # 父表失敗的表不會開始
+    for table in pending:
+        failed[table] = "相依的資料表匯入失敗：" + ", ".join(sorted(pending[table] - done))
+    return timings, failed
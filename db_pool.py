@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+
+from query_metrics import QUERY_METRICS, TimedCursor, record_acquire
+
+load_dotenv()
+
+# 連線參數 (可用環境變數覆寫)
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "port": int(os.getenv("DB_PORT", "5432")),
+    "database": os.getenv("DB_NAME", "final_project"),
+    "user": os.getenv("DB_USER", "postgres"),
+    "password": os.getenv("PASSWORD"),
+}
+
+# 連線池大小與等待時間
+POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# 連線閒置超過這個秒數，借出前先 SELECT 1 確認還活著
+HEALTH_CHECK_IDLE = float(os.getenv("DB_POOL_HEALTH_CHECK_IDLE", "30"))
+
+
+class PoolTimeout(Exception):
+    """等待可用連線逾時"""
+
+
+class DBPool:
+    """
+    執行緒安全的 psycopg2 連線池：
+    - 啟動時先開 minconn 條，之後依需求長到 maxconn 條
+    - 連線用完時排隊等待 (最多 timeout 秒)，而不是直接開新連線把 max_connections 吃光
+    - 借出時做健康檢查，壞掉的連線直接丟掉重開
+    - 歸還時把沒結束的交易 rollback，確保下一個人拿到乾淨的連線
+
+    註：psycopg2 內建的 ThreadedConnectionPool 在歸還時只會保留 minconn 條閒置連線，
+    尖峰過後多的會被關掉、下次又重連，所以這裡自己管理。
+    """
+
+    def __init__(self, minconn=POOL_MIN, maxconn=POOL_MAX, timeout=POOL_TIMEOUT, **conn_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("連線池大小設定錯誤")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._conn_kwargs = conn_kwargs
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, 上次歸還時間)]
+        self._in_use = set()
+        self._opening = 0
+        self._closed = False
+        self._stats = {
+            "connects": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "wait_time_total": 0.0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._conn_kwargs)
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        # 剛用過的連線不用每次都 ping，省一次 round-trip
+        if time.monotonic() - last_used < HEALTH_CHECK_IDLE:
+            return True
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("連線池已關閉")
+                while not self._idle and len(self._in_use) + self._opening >= self.maxconn:
+                    waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if not self._idle and len(self._in_use) + self._opening >= self.maxconn:
+                            self._stats["timeouts"] += 1
+                            raise PoolTimeout(f"等待資料庫連線超過 {self.timeout} 秒")
+                if self._idle:
+                    # 拿最近歸還的那條 (LIFO)，比較不會拿到閒置太久被斷線的
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._opening += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+            elif not self._is_healthy(conn, last_used):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use.add(conn)
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                self._stats["wait_time_total"] += time.monotonic() - start
+            record_acquire(time.monotonic() - start)
+            return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if not (broken or conn.closed or self._closed):
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """借出一條連線，離開 with 區塊時 (包含發生例外) 一定會歸還"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            idle = len(self._idle)
+            in_use = len(self._in_use)
+        stats.update({
+            "min_size": self.minconn,
+            "max_size": self.maxconn,
+            "open": idle + in_use,
+            "idle": idle,
+            "in_use": in_use,
+            "wait_time_total": round(stats["wait_time_total"], 4),
+        })
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def new_pool(minconn=POOL_MIN, maxconn=POOL_MAX, timeout=POOL_TIMEOUT, **overrides):
+    """照 DB_CONFIG 開一個連線池；overrides 換掉部分連線參數 (例如唯讀副本的 host / port，見 read_replicas.py)"""
+    # 預設 cursor 會記下每個 SQL 的時間 (見 query_metrics.py)
+    extra = {"cursor_factory": TimedCursor} if QUERY_METRICS else {}
+    return DBPool(minconn, maxconn, timeout, **dict(DB_CONFIG, **overrides), **extra)
+
+
+def get_pool():
+    """取得 (必要時建立) 全域連線池"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = new_pool()
+    return _db_pool
+
+
+def close_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
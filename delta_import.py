@@ -0,0 +1,280 @@
+"""
+增量匯入 (import.py --incremental)
+
+以前每次有新的 CSV 都要 drop 掉所有表、重建、整份重新匯入，要好幾分鐘，期間網頁也查不到資料。
+增量模式只套用有變動的部分，全部在同一個交易裡完成 (commit 之前網頁看到的都是舊資料)：
+
+1. 每個檔案算 sha256，跟上次套用時記在 import_manifest 的一樣就整張表跳過
+2. 檔案有變：把每一筆依某個整數欄位 (例如 id_student) 分到 INCREMENTAL_BUCKETS 個桶子，
+   每個桶子算一個指紋 (每筆資料 hash 的總和，跟順序無關)，跟 manifest 比對找出有變動的桶子
+3. 只把有變動的桶子裡的資料 COPY 進暫存表，INSERT ... ON CONFLICT (主鍵) DO UPDATE 寫進去
+   (值沒變的那幾筆不會真的被改寫)
+4. 有變動的桶子裡，原本有、新檔案裡沒有的資料刪掉
+   (新增 / 更新依父表 → 子表的順序，刪除反過來，外鍵才不會擋)
+5. 每張表套用了什麼 (檔案 hash、各桶指紋、新增 / 更新 / 刪除筆數) 記進 import_manifest
+
+第一次 (還沒有 manifest) 時所有桶子都算有變動，等於整份比對一次。
+完整重新匯入 (drop_all_tables) 時會把 manifest 一起清掉。
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from csv_import import (
+    IMPORT_MEMORY_MB, COPY_READ_BYTES, STUDENT_VLE_KEY, CopyStream, copy_sql, frames_to_csv,
+    read_csv_chunks, split_presentation, load_assessment_bridge, add_assessment_course,
+)
+
+INCREMENTAL_BUCKETS = int(os.getenv("INCREMENTAL_BUCKETS", "256"))
+
+MANIFEST_TABLE = "import_manifest"
+
+CREATE_MANIFEST = f"""
+    CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+        id SERIAL PRIMARY KEY,
+        table_name VARCHAR(64) NOT NULL,
+        file_hash CHAR(64) NOT NULL,
+        buckets TEXT[] NOT NULL,
+        rows_in_file BIGINT,
+        changed_buckets INT,
+        inserted BIGINT,
+        updated BIGINT,
+        deleted BIGINT,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+LATEST_MANIFEST = f"""
+    SELECT DISTINCT ON (table_name) table_name, file_hash, buckets
+    FROM {MANIFEST_TABLE}
+    ORDER BY table_name, id DESC
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT a.attname
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+    ORDER BY array_position(i.indkey, a.attnum)
+"""
+
+# 分桶用的整數欄位 (None = 表很小，整張表一個桶子)
+BUCKET_COLUMNS = {
+    "courses": None,
+    "vle": "id_site",
+    "assessments": "id_assessment",
+    "student_info": "id_student",
+    "student_registration": "id_student",
+    "student_vle": "id_student",
+    "student_assessment": "id_student",
+}
+
+
+# ---------- 讀檔 (跟完整匯入時同樣的轉換) ----------
+def source_files(table_name, data_dir="data"):
+    """這張表的資料來自哪些檔案 (student_assessment 還要用 assessments.csv 補欄位)"""
+    files = [os.path.join(data_dir, f"{table_name}.csv")]
+    if table_name == "student_assessment":
+        files.append(os.path.join(data_dir, "assessments.csv"))
+    return files
+
+
+def file_hash(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(COPY_READ_BYTES), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def table_frames(table_name, table_columns, data_dir="data", memory_mb=IMPORT_MEMORY_MB):
+    """
+    依完整匯入時的規則讀出一塊一塊的 DataFrame，欄位名稱 / 順序跟資料表一樣。
+    直接 COPY 的表只把空欄位當 NULL (跟 COPY 一樣)；用 pandas 轉換的表沿用 pandas 的 NA 規則
+    """
+    file_path = os.path.join(data_dir, f"{table_name}.csv")
+    if table_name == "courses":
+        for df in read_csv_chunks(file_path, memory_mb):
+            yield split_presentation(df)[table_columns]
+        return
+    if table_name == "student_assessment":
+        bridge = load_assessment_bridge(data_dir)
+        chunks = (add_assessment_course(df, bridge) for df in read_csv_chunks(file_path, memory_mb))
+    else:
+        chunks = read_csv_chunks(file_path, memory_mb, keep_default_na=False, na_values=[""])
+    for df in chunks:
+        # 跟完整匯入一樣依欄位位置對應
+        df.columns = table_columns[:len(df.columns)]
+        yield df
+
+
+def row_buckets(df, bucket_column):
+    if bucket_column is None:
+        return np.zeros(len(df), dtype=np.int64)
+    ids = pd.to_numeric(df[bucket_column], errors="coerce").abs() % INCREMENTAL_BUCKETS
+    return ids.fillna(0).astype(np.int64).to_numpy()
+
+
+def bucket_sql(bucket_column):
+    """跟 row_buckets 同樣的分桶規則，給 SQL 用"""
+    if bucket_column is None:
+        return "0"
+    return f"COALESCE(mod(abs({bucket_column}), {INCREMENTAL_BUCKETS}), 0)"
+
+
+def fingerprint(frames, bucket_column):
+    """
+    每個桶子的指紋 = 筆數 + 每筆 hash 的總和 (uint64 溢位就繞回去)，跟資料順序無關。
+    回傳 (每桶指紋字串的 list, 總筆數)
+    """
+    sums = np.zeros(INCREMENTAL_BUCKETS, dtype=np.uint64)
+    counts = np.zeros(INCREMENTAL_BUCKETS, dtype=np.int64)
+    total = 0
+    for df in frames:
+        buckets = row_buckets(df, bucket_column)
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy(dtype=np.uint64)
+        np.add.at(sums, buckets, hashes)
+        np.add.at(counts, buckets, 1)
+        total += len(df)
+    return [f"{c}:{s:016x}" for c, s in zip(counts, sums)], total
+
+
+# ---------- 套用變動 ----------
+def table_columns(cur, table_name):
+    cur.execute(f"SELECT * FROM {table_name} LIMIT 0")
+    return [d[0] for d in cur.description]
+
+
+def primary_key(cur, table_name):
+    cur.execute(PRIMARY_KEY_QUERY, (table_name,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def stage_changes(cur, table_name, columns, frames, bucket_column, changed):
+    """有變動的桶子裡的資料 COPY 進暫存表 {table}_delta"""
+    staging = f"{table_name}_delta"
+    cur.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT * FROM {table_name} WITH NO DATA")
+    everything = len(changed) == INCREMENTAL_BUCKETS
+    wanted = np.zeros(INCREMENTAL_BUCKETS, dtype=bool)
+    wanted[list(changed)] = True
+    selected = (df if everything else df[wanted[row_buckets(df, bucket_column)]] for df in frames)
+    cur.copy_expert(copy_sql(staging, columns), CopyStream(frames_to_csv(selected)), size=COPY_READ_BYTES)
+    return staging
+
+
+def upsert(cur, table_name, columns, pk, staging):
+    """暫存表 → 正式表；主鍵已存在而且值有變才更新。回傳 (新增筆數, 更新筆數)"""
+    if table_name == "student_vle":
+        # 原始資料同一個主鍵有好幾筆，跟完整匯入一樣先加總
+        key = ", ".join(STUDENT_VLE_KEY)
+        not_null = " AND ".join(f"{c} IS NOT NULL" for c in STUDENT_VLE_KEY)
+        source = (f"SELECT {key}, COALESCE(SUM(sum_click), 0) AS sum_click FROM {staging} "
+                  f"WHERE {not_null} GROUP BY {key}")
+        columns = STUDENT_VLE_KEY + ["sum_click"]
+    else:
+        source = f"SELECT {', '.join(columns)} FROM {staging}"
+
+    values = [c for c in columns if c not in pk]
+    if values:
+        conflict = (
+            f"DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in values)} "
+            f"WHERE ({', '.join(f'{table_name}.{c}' for c in values)}) "
+            f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{c}' for c in values)})"
+        )
+    else:
+        conflict = "DO NOTHING"
+    cur.execute(f"""
+        WITH changed AS (
+            INSERT INTO {table_name} ({', '.join(columns)})
+            {source}
+            ON CONFLICT ({', '.join(pk)}) {conflict}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM changed
+    """)
+    return cur.fetchone()
+
+
+def delete_missing(cur, table_name, pk, staging, bucket_column, changed):
+    """有變動的桶子裡，新檔案已經沒有的資料刪掉"""
+    match = " AND ".join(f"s.{c} = t.{c}" for c in pk)
+    cur.execute(f"""
+        DELETE FROM {table_name} t
+        WHERE {bucket_sql('t.' + bucket_column if bucket_column else None)} = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM {staging} s WHERE {match})
+    """, (sorted(changed),))
+    return cur.rowcount
+
+
+def latest_manifest(cur):
+    cur.execute(CREATE_MANIFEST)
+    cur.execute(LATEST_MANIFEST)
+    return {table: (digest, buckets) for table, digest, buckets in cur.fetchall()}
+
+
+def incremental_import(conn, tables, data_dir="data", memory_mb=IMPORT_MEMORY_MB):
+    """
+    tables 要依父表 → 子表的順序。全部在 conn 的同一個交易裡，成功才 commit。
+    回傳 {表: {"status": "unchanged" / "applied", "changed_buckets", "inserted", "updated", "deleted"}}
+    """
+    report = {}
+    applied = []   # (表, 主鍵, 暫存表, 分桶欄位, 有變動的桶子, manifest 資料)
+    try:
+        with conn.cursor() as cur:
+            manifest = latest_manifest(cur)
+
+            for table_name in tables:
+                files = source_files(table_name, data_dir)
+                if not all(os.path.exists(f) for f in files):
+                    print(f"⚠️ 找不到檔案 {files[0]}，跳過...")
+                    continue
+                digest = file_hash(files)
+                previous = manifest.get(table_name)
+                if previous and previous[0] == digest:
+                    report[table_name] = {"status": "unchanged"}
+                    continue
+
+                columns = table_columns(cur, table_name)
+                pk = primary_key(cur, table_name)
+                if not pk:
+                    raise ValueError(f"{table_name} 沒有主鍵，無法增量匯入")
+                bucket_column = BUCKET_COLUMNS.get(table_name)
+                buckets, total = fingerprint(
+                    table_frames(table_name, columns, data_dir, memory_mb), bucket_column
+                )
+                old = previous[1] if previous and len(previous[1]) == len(buckets) else [None] * len(buckets)
+                changed = {i for i, (a, b) in enumerate(zip(old, buckets)) if a != b}
+
+                staging = None
+                inserted = updated = 0
+                if changed:
+                    staging = stage_changes(cur, table_name, columns,
+                                            table_frames(table_name, columns, data_dir, memory_mb),
+                                            bucket_column, changed)
+                    inserted, updated = upsert(cur, table_name, columns, pk, staging)
+                applied.append((table_name, pk, staging, bucket_column, changed, (digest, buckets, total)))
+                report[table_name] = {"status": "applied", "changed_buckets": len(changed),
+                                      "inserted": inserted, "updated": updated, "deleted": 0}
+
+            # 刪除從子表開始
+            for table_name, pk, staging, bucket_column, changed, _ in reversed(applied):
+                if staging is not None:
+                    report[table_name]["deleted"] = delete_missing(
+                        cur, table_name, pk, staging, bucket_column, changed
+                    )
+
+            for table_name, _, _, _, changed, (digest, buckets, total) in applied:
+                r = report[table_name]
+                cur.execute(f"""
+                    INSERT INTO {MANIFEST_TABLE}
+                        (table_name, file_hash, buckets, rows_in_file, changed_buckets, inserted, updated, deleted)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """, (table_name, digest, buckets, total, len(changed), r["inserted"], r["updated"], r["deleted"]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return report
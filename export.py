@@ -0,0 +1,340 @@
+"""
+整張表匯出：GET /api/export/{table_name}?format=csv|ndjson|arrow
+
+/api/data 是給畫面翻頁用的；要把整張表拿出去分析時用這個。
+資料一邊從資料庫讀、一邊送給瀏覽器，不會整張表先讀進記憶體，
+1 千筆還是 1 千萬筆，server 的記憶體用量都一樣。
+
+- csv / ndjson：用 COPY (SELECT ...) TO STDOUT，由 PostgreSQL 直接產生文字，
+  背景執行緒把 COPY 的輸出塞進有上限的 queue，StreamingResponse 從 queue 拿出來送
+- arrow：用 named (server-side) cursor 每次抓 ARROW_BATCH_ROWS 筆，轉成 Arrow IPC stream
+  (需要 pip install pyarrow)
+
+排序：sort_by / order (sort_by 可以多個欄位，例如 score:desc,id_student)；
+篩選：其他 query string 跟 /api/data 一樣是「欄位[運算子]=值」條件 (語法見 filters.py)，
+例如 /api/export/student_vle?format=csv&code_module=AAA&code_presentation=2013J&date[gte]=0
+精簡格式 (compact_schema.py) 的代碼欄位在 SELECT 裡就換回字串，COPY 出來的跟一般格式一樣。
+設定了唯讀副本 (DB_READ_REPLICAS) 時從副本讀，不佔主資料庫 (見 read_replicas.py)。
+"""
+import queue
+import threading
+from typing import Optional
+
+import psycopg2
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from psycopg2 import sql
+from starlette.concurrency import run_in_threadpool
+
+from db_pool import PoolTimeout
+
+from filters import FilterError, parse_filters, compile_filters, filter_columns
+from index_advisor import workload
+from pagination import CursorError, parse_sort
+from read_replicas import acquire_read
+from schema_cache import schema, check_table
+from compact_schema import decode_sql, dictionary
+
+router = APIRouter()
+
+# COPY 輸出累積到這麼大才丟進 queue 一次
+COPY_CHUNK_BYTES = 256 * 1024
+# queue 最多放幾塊 (記憶體上限約 COPY_CHUNK_BYTES * QUEUE_CHUNKS)
+QUEUE_CHUNKS = 16
+ARROW_BATCH_ROWS = 10000
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+
+# PostgreSQL 型別 → Arrow 型別 (沒列到的一律當字串)
+ARROW_TYPES = {
+    "smallint": "int16",
+    "integer": "int32",
+    "bigint": "int64",
+    "real": "float32",
+    "double precision": "float64",
+    "boolean": "bool_",
+}
+
+# 這些 query string 不是篩選條件
+RESERVED_PARAMS = {"format", "sort_by", "order"}
+
+_DONE = object()
+
+
+class _ExportCancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    """給 copy_expert 用的 file-like：湊滿一塊就丟進 queue；queue 滿了就等 (背壓)"""
+
+    def __init__(self, chunks, stop):
+        self.chunks = chunks
+        self.stop = stop
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= COPY_CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        chunk = b"".join(self.buf)
+        self.buf, self.size = [], 0
+        while True:
+            if self.stop.is_set():
+                raise _ExportCancelled()
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def build_select(table_name, sort=(), filters=(), select_list=None):
+    """
+    組出 SELECT (回傳 sql.Composed 與參數)，export 跟其他需要整表查詢的地方共用。
+    sort：[(欄位, 是否 DESC), ...] (pagination.parse_sort)；filters：filters.parse_filters 的結果
+    """
+    query = sql.SQL("SELECT {} FROM {}").format(
+        select_list or sql.SQL("*"), sql.Identifier(table_name)
+    )
+    where, params = compile_filters(filters)
+    if where is not None:
+        query += sql.SQL(" WHERE ") + where
+    if sort:
+        query += sql.SQL(" ORDER BY ") + sql.SQL(", ").join(
+            sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL("DESC" if desc else "ASC")) for col, desc in sort
+        )
+    return query, params
+
+
+def decoded_select_list(table_name):
+    """精簡格式時代碼欄位換回字串的 SELECT 欄位 (欄位名稱不變)；沒有代碼欄位時回傳 None (= SELECT *)"""
+    encoded = schema.encoded_columns(table_name)
+    if not encoded:
+        return None
+    return sql.SQL(", ").join(
+        sql.SQL("{} AS {}").format(decode_sql(c, sql.Identifier(table_name, c)), sql.Identifier(c))
+        if c in encoded else sql.Identifier(c)
+        for c in schema.column_types(table_name)
+    )
+
+
+class _CopyStream:
+    """
+    在背景執行緒跑 COPY ... TO STDOUT，一塊一塊交出去。
+    建立時就開始 COPY、等到第一塊 (或錯誤)：查詢有問題時還沒送出 200，可以回錯誤狀態碼
+    """
+
+    def __init__(self, db_pool, conn, copy_statement, params):
+        self.db_pool = db_pool
+        self.conn = conn
+        self.chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.stop = threading.Event()
+        self.failed = []
+        self.producer = threading.Thread(target=self._produce, args=(copy_statement, params),
+                                         name="export-copy", daemon=True)
+        self.producer.start()
+        self.first = self.chunks.get()
+        if isinstance(self.first, Exception):
+            self.close()
+            raise self.first
+
+    def _produce(self, copy_statement, params):
+        writer = _QueueWriter(self.chunks, self.stop)
+        try:
+            with self.conn.cursor() as cur:
+                # COPY 不能用參數，先用 mogrify 把參數安全地嵌進 SQL
+                cur.copy_expert(cur.mogrify(copy_statement, params).decode(), writer)
+            writer.flush()
+            self.chunks.put(_DONE)
+        except Exception as e:
+            self.failed.append(e)
+            if not self.stop.is_set():
+                self.chunks.put(e)
+
+    def __iter__(self):
+        item = self.first
+        while item is not _DONE:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            item = self.chunks.get()
+
+    def close(self):
+        """不管正常結束、出錯還是 client 中途斷線都要呼叫：叫 producer 停下來，歸還連線"""
+        self.stop.set()
+        # 把 queue 清空讓 producer 不會卡在 put
+        while self.producer.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        # 還在等下一塊的讀取端 (如果有) 也讓它結束
+        try:
+            self.chunks.put_nowait(_DONE)
+        except queue.Full:
+            pass
+        # COPY 被中斷過的連線狀態不可靠，直接丟掉
+        self.db_pool.putconn(self.conn, broken=bool(self.failed))
+
+
+class _ChunkSink:
+    """給 Arrow IPC writer 寫的 file-like：每寫完一批就把累積的 bytes 拿走送出去"""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+class _ArrowStream:
+    """
+    用 named cursor 分批讀，每批轉成一個 Arrow RecordBatch。
+    建立時就 DECLARE 好 cursor (查詢有問題時還沒送出 200)
+    """
+
+    def __init__(self, db_pool, conn, table_name, query, params):
+        import pyarrow as pa
+
+        self.db_pool = db_pool
+        self.conn = conn
+        self.schema = pa.schema([
+            (name, getattr(pa, ARROW_TYPES.get(pg_type, "string"))())
+            for name, pg_type in schema.column_types(table_name).items()
+        ])
+        self.cur = conn.cursor(name="export_cursor")
+        self.cur.itersize = ARROW_BATCH_ROWS
+        try:
+            self.cur.execute(query, params)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        import pyarrow as pa
+
+        sink = _ChunkSink()
+        writer = pa.ipc.new_stream(sink, self.schema)
+        while True:
+            rows = self.cur.fetchmany(ARROW_BATCH_ROWS)
+            if not rows:
+                break
+            columns = zip(*rows)
+            writer.write_batch(pa.record_batch(
+                [pa.array(col, type=field.type) for col, field in zip(columns, self.schema)],
+                schema=self.schema,
+            ))
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+
+    def close(self):
+        """關掉 cursor、歸還連線 (沒 commit 的交易 putconn 會 rollback)"""
+        try:
+            self.cur.close()
+        except psycopg2.Error:
+            pass
+        self.db_pool.putconn(self.conn)
+
+
+class _ExportResponse(StreamingResponse):
+    """
+    StreamingResponse 正常送完才會跑 background，client 中途斷線時不會；
+    這裡用 finally 保證一定呼叫 stream.close() 歸還連線 (不用等 generator 被 GC)
+    """
+
+    def __init__(self, stream, **kwargs):
+        super().__init__(stream, **kwargs)
+        self.stream = stream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.stream.close)
+
+
+def _open_stream(make_stream, *args):
+    """借讀取用的連線並開始查詢；連不上、排不到連線或查詢失敗回 503 (這時還沒送出任何東西)"""
+    try:
+        db_pool, conn = acquire_read()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
+        raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+    try:
+        return make_stream(db_pool, conn, *args)
+    except psycopg2.Error as e:
+        print("Export Error:", e)
+        raise HTTPException(status_code=503, detail="匯出查詢失敗，請稍後再試")
+
+
+@router.get("/api/export/{table_name}")
+def export_table(
+    table_name: str,
+    request: Request,
+    format: str = "csv",
+    sort_by: Optional[str] = None,
+    order: str = "ASC",
+):
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支援的格式：{format} (可用 csv / ndjson / arrow)")
+    check_table(table_name)
+    try:
+        filters = parse_filters(request.query_params.multi_items(), schema.column_types(table_name), RESERVED_PARAMS)
+        sort = parse_sort(sort_by, order)
+    except (FilterError, CursorError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    check_table(table_name, [col for col, _ in sort])
+
+    # 串流輸出，時間不準，只記型態 (見 index_advisor.py)
+    workload.record(table_name, "export", sort[0][0] if sort else None, filter_columns(filters))
+    filters = dictionary.encode_filters(filters, schema.encoded_columns(table_name))
+    select_list = decoded_select_list(table_name)
+
+    media_type, ext = FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="{table_name}.{ext}"'}
+
+    if format == "csv":
+        query, params = build_select(table_name, sort, filters, select_list)
+        copy = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT CSV, HEADER)").format(query)
+        stream = _open_stream(_CopyStream, copy, params)
+    elif format == "ndjson":
+        # row_to_json 由 PostgreSQL 直接產生 JSON；用 CSV 格式加上不會出現的 quote / delimiter 字元，
+        # COPY 就不會跳脫 JSON 裡的反斜線或加引號，一行就是一筆 JSON
+        query, params = build_select(table_name, sort, filters, select_list)
+        json_query = sql.SQL("SELECT row_to_json(t) FROM ({}) AS t").format(query)
+        copy = sql.SQL(
+            "COPY ({}) TO STDOUT WITH (FORMAT CSV, QUOTE E'\\x01', DELIMITER E'\\x02')"
+        ).format(json_query)
+        stream = _open_stream(_CopyStream, copy, params)
+    else:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Arrow 格式需要先 pip install pyarrow")
+        query, params = build_select(table_name, sort, filters, select_list)
+        stream = _open_stream(_ArrowStream, table_name, query, params)
+
+    return _ExportResponse(stream, media_type=media_type, headers=headers)
@@ -0,0 +1,252 @@
+"""
+快速匯入模式 (import.py --fast)
+
+一般匯入是先執行 init.sql 建好主鍵、外鍵再 COPY，PostgreSQL 每灌一筆都要更新 B-tree、檢查外鍵，
+student_registration / student_vle 匯入慢主要就是慢在這裡。快速模式改成：
+1. 在一個暫時的 schema 裡執行 init.sql，從 pg_catalog 讀出每張表的欄位、約束、索引 (讀完就 rollback 掉)
+2. 在 public 建只有欄位的 UNLOGGED 表 (不寫 WAL)，載入時 synchronous_commit = off
+3. 資料灌完後：SET LOGGED → 主鍵 → 外鍵 → 其他索引 → ANALYZE，
+   同一個步驟裡不同的表用不同連線同時做 (建主鍵 / 索引一次排序建好，比一筆一筆插入快很多)
+4. 最後再讀一次 public 的結構，跟 init.sql 建出來的逐項比對，確定完全一樣
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from csv_import import IMPORT_MEMORY_MB, import_parallel, table_dependencies
+
+REFERENCE_SCHEMA = "fastload_ref"
+# 建主鍵 / 索引時每條連線可以用的排序記憶體
+MAINTENANCE_WORK_MEM = "256MB"
+
+COLUMNS_QUERY = """
+    SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull,
+           pg_get_expr(d.adbin, d.adrelid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+    WHERE n.nspname = %s AND c.relkind = 'r'
+    ORDER BY c.relname, a.attnum
+"""
+
+PERSISTENCE_QUERY = """
+    SELECT c.relname, c.relpersistence
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s AND c.relkind = 'r'
+"""
+
+# pg_get_constraintdef 只有在表格不在 search_path 時才會加 schema 名稱，所以讀之前先切 search_path
+CONSTRAINTS_QUERY = """
+    SELECT cl.relname, con.conname, con.contype, pg_get_constraintdef(con.oid)
+    FROM pg_constraint con
+    JOIN pg_class cl ON cl.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = cl.relnamespace
+    WHERE n.nspname = %s AND con.contype IN ('p', 'u', 'c', 'f')
+    ORDER BY cl.relname, con.conname
+"""
+
+# 不是由約束自動建立的索引
+INDEXES_QUERY = """
+    SELECT c.relname, ic.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid)
+    ORDER BY c.relname, ic.relname
+"""
+
+
+def read_schema(cur, schema_name):
+    """
+    讀出 schema_name 裡每張表的結構：
+    {表: {"columns": [...], "constraints": [(名稱, 種類, 定義)], "indexes": [(名稱, 定義)], "persistence": "p"}}
+    """
+    cur.execute("SELECT set_config('search_path', %s, true)", (schema_name,))
+    tables = {}
+    cur.execute(COLUMNS_QUERY, (schema_name,))
+    for table, column, data_type, not_null, default in cur.fetchall():
+        info = tables.setdefault(table, {"columns": [], "constraints": [], "indexes": [], "persistence": None})
+        info["columns"].append((column, data_type, not_null, default))
+    cur.execute(PERSISTENCE_QUERY, (schema_name,))
+    for table, persistence in cur.fetchall():
+        tables[table]["persistence"] = persistence
+    cur.execute(CONSTRAINTS_QUERY, (schema_name,))
+    for table, name, contype, definition in cur.fetchall():
+        tables[table]["constraints"].append((name, contype, definition))
+    cur.execute(INDEXES_QUERY, (schema_name,))
+    for table, name, definition in cur.fetchall():
+        # pg_get_indexdef 一律寫出 schema 名稱，比對時拿掉
+        tables[table]["indexes"].append((name, definition.replace(f" ON {schema_name}.", " ON ")))
+    return tables
+
+
+def reference_schema(conn, init_sql):
+    """在暫時的 schema 裡執行 init.sql，讀出應該要有的結構，然後 rollback (不留下任何東西)"""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE SCHEMA {REFERENCE_SCHEMA}")
+            cur.execute("SELECT set_config('search_path', %s, true)", (REFERENCE_SCHEMA,))
+            cur.execute(init_sql)
+            return read_schema(cur, REFERENCE_SCHEMA)
+    finally:
+        conn.rollback()
+
+
+def create_bare_tables(conn, reference):
+    """只有欄位 (含 NOT NULL / DEFAULT) 的 UNLOGGED 表，主鍵、外鍵、索引都先不建"""
+    with conn.cursor() as cur:
+        for table, info in reference.items():
+            columns = []
+            for name, data_type, not_null, default in info["columns"]:
+                column = f"{name} {data_type}"
+                if not_null:
+                    column += " NOT NULL"
+                if default is not None:
+                    column += f" DEFAULT {default}"
+                columns.append(column)
+            cur.execute(f"CREATE UNLOGGED TABLE {table} ({', '.join(columns)})")
+    conn.commit()
+
+
+def drop_bare_tables(conn, reference):
+    """
+    匯入或建約束失敗時把這次建的表全部 drop 掉，
+    不留下沒有主鍵 / 外鍵 (或只建了一部分)、API 分頁與批次寫入都不能正常用的表
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {', '.join(reference)}")
+    conn.commit()
+
+
+def fast_connect(connect):
+    """載入用的連線：commit 不等 WAL 寫到磁碟 (當機時最多掉最後幾筆交易，反正可以重新匯入)"""
+    def open_connection():
+        conn = connect()
+        with conn.cursor() as cur:
+            cur.execute("SET synchronous_commit = off")
+        conn.commit()
+        return conn
+    return open_connection
+
+
+class StepFailed(Exception):
+    """建約束 / 索引的某一步失敗 (例如 CSV 裡主鍵重複、外鍵對不到)"""
+
+    def __init__(self, table, step, error):
+        super().__init__(f"{step}：{str(error).strip()}")
+        self.table = table
+
+
+def _run_steps(connect, steps, workers, start, timings):
+    """steps: [(表, 步驟名稱, SQL), ...]，用 workers 條連線同時執行，有錯就等其他的做完、丟出第一個 StepFailed"""
+    def run(table, name, statement):
+        began = time.perf_counter() - start
+        conn = connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'")
+                cur.execute(statement)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return table, name, began, time.perf_counter() - start
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(step, pool.submit(run, *step)) for step in steps]
+        for (table, name, _), future in futures:
+            try:
+                timings.append(future.result())
+            except Exception as e:
+                error = error or StepFailed(table, name, e)
+    if error is not None:
+        raise error
+
+
+def build_constraints(connect, reference, workers, start, timings):
+    """
+    SET LOGGED → 主鍵 / UNIQUE / CHECK → 外鍵 → 其他索引 → ANALYZE。
+    外鍵要等兩邊的表都變回一般表、被參照的主鍵建好才能加，所以分步驟；同一步驟裡各表同時做
+    """
+    _run_steps(connect, [(t, "set logged", f"ALTER TABLE {t} SET LOGGED") for t in reference],
+               workers, start, timings)
+
+    def constraint_steps(kinds):
+        return [
+            (table, f"{contype_name(kind)} {name}", f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+            for table, info in reference.items()
+            for name, kind, definition in info["constraints"] if kind in kinds
+        ]
+
+    _run_steps(connect, constraint_steps("puc"), workers, start, timings)
+    _run_steps(connect, constraint_steps("f"), workers, start, timings)
+    _run_steps(connect, [
+        (table, f"index {name}", definition)
+        for table, info in reference.items() for name, definition in info["indexes"]
+    ], workers, start, timings)
+    _run_steps(connect, [(t, "analyze", f"ANALYZE {t}") for t in reference], workers, start, timings)
+
+
+def contype_name(kind):
+    return {"p": "primary key", "u": "unique", "c": "check", "f": "foreign key"}[kind]
+
+
+def compare_schema(expected, actual):
+    """回傳不一樣的地方 (字串的 list)，完全一樣時是空的；只比 init.sql 裡有的表"""
+    problems = []
+    for table in sorted(expected):
+        if table not in actual:
+            problems.append(f"{table}：少了這張表")
+            continue
+        for part in ("columns", "constraints", "indexes", "persistence"):
+            if expected[table][part] != actual[table][part]:
+                problems.append(f"{table} 的 {part} 不一樣：應該是 {expected[table][part]}，實際是 {actual[table][part]}")
+    return problems
+
+
+def fast_load(connect, tables, init_sql, data_dir="data", memory_mb=IMPORT_MEMORY_MB, workers=4, partitions=None):
+    """
+    快速匯入 (資料表要先 drop 掉)。
+    connect()：回傳新的 psycopg2 連線。回傳 (timings, failed, problems)：
+    timings 同 import_parallel，failed = {表: 錯誤}，problems = 跟 init.sql 比對不一樣的地方。
+    有表匯入失敗時不建約束 (外鍵一定建不起來)；建約束失敗時 (主鍵重複、外鍵對不到…) 那張表記在 failed。
+    這兩種情況這次建的表都全部 drop 掉，problems 是空的
+    """
+    conn = connect()
+    try:
+        reference = reference_schema(conn, init_sql)
+        create_bare_tables(conn, reference)
+    finally:
+        conn.close()
+
+    start = time.perf_counter()
+    timings, failed = import_parallel(
+        fast_connect(connect), tables, table_dependencies(init_sql), data_dir=data_dir,
+        memory_mb=memory_mb, workers=workers, partitions=partitions
+    )
+    if not failed:
+        try:
+            build_constraints(connect, reference, workers, start, timings)
+        except StepFailed as e:
+            failed[e.table] = f"建立約束 / 索引失敗 ({e})"
+    if failed:
+        conn = connect()
+        try:
+            drop_bare_tables(conn, reference)
+        finally:
+            conn.close()
+        return timings, failed, []
+
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            problems = compare_schema(reference, read_schema(cur, "public"))
+        conn.rollback()
+    finally:
+        conn.close()
+    return timings, failed, problems
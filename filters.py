@@ -0,0 +1,143 @@
+"""
+查詢條件語法：/api/data/{table_name} 與 /api/export/{table_name} 共用
+
+query string 裡的「欄位[運算子]=值」就是一個條件，多個條件之間是 AND：
+    ?code_module=AAA                        等於 (沒寫運算子就是 eq)
+    ?score[gte]=50&score[lt]=80             範圍：gt / gte / lt / lte，ne = 不等於
+    ?id_student[in]=11391,28400,30268       IN 清單 (逗號分隔，最多 FILTER_MAX_IN_VALUES 個)
+    ?region[prefix]=East                    開頭是 (只能用在文字欄位)
+    ?imd_band[null]=true                    是 / 不是 NULL
+值會先依欄位型別 (schema_cache 的欄位資訊) 轉好，轉不過去就回 400，
+所以 SQL 裡的比較都是「欄位 運算子 同型別參數」，B-tree 索引 (含主鍵) 都用得到：
+eq / in 變成 = / = ANY(陣列)，範圍變成 < > 等，prefix 變成 LIKE 'xxx%' (資料庫是 C collation 時可以走 B-tree)。
+"""
+import hashlib
+import json
+import re
+
+from psycopg2 import sql
+
+FILTER_MAX_IN_VALUES = 1000
+
+_KEY = re.compile(r"^(?P<column>[^\[\]]+)(?:\[(?P<op>[a-z]+)\])?$")
+
+COMPARISONS = {"eq": "=", "ne": "<>", "lt": "<", "lte": "<=", "gt": ">", "gte": ">="}
+OPERATORS = set(COMPARISONS) | {"in", "prefix", "null"}
+
+INTEGER_TYPES = {"smallint", "integer", "bigint"}
+FLOAT_TYPES = {"real", "double precision", "numeric"}
+TEXT_TYPES = {"character varying", "character", "text"}
+
+
+class FilterError(ValueError):
+    """條件寫錯：欄位不存在、運算子不支援、值的型別不對"""
+
+
+def _convert(column, data_type, value):
+    try:
+        if data_type in INTEGER_TYPES:
+            return int(value)
+        if data_type in FLOAT_TYPES:
+            return float(value)
+        if data_type == "boolean":
+            return _boolean(value)
+    except ValueError:
+        raise FilterError(f"{column} 的值 {value!r} 不是 {data_type}")
+    return value
+
+
+def _boolean(value):
+    lowered = value.lower()
+    if lowered in ("true", "1", "yes"):
+        return True
+    if lowered in ("false", "0", "no"):
+        return False
+    raise ValueError(value)
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def parse_filters(items, column_types, reserved=()):
+    """
+    items：query string 的 (key, value) list (request.query_params.multi_items())；
+    column_types：{欄位: 型別}。reserved 裡的參數 (page、sort_by…) 不是條件。
+    回傳 [(欄位, 運算子, 轉好型別的值), ...]
+    """
+    filters = []
+    for key, value in items:
+        if key in reserved:
+            continue
+        match = _KEY.match(key)
+        if not match:
+            raise FilterError(f"看不懂的條件：{key}")
+        column, op = match.group("column"), match.group("op") or "eq"
+        if column not in column_types:
+            raise FilterError(f"沒有這個欄位：{column}")
+        if op not in OPERATORS:
+            raise FilterError(f"不支援的運算子：{op} (可用 {', '.join(sorted(OPERATORS))})")
+        data_type = column_types[column]
+
+        if op == "in":
+            values = [v for v in value.split(",") if v != ""]
+            if not values:
+                raise FilterError(f"{column}[in] 至少要有一個值")
+            if len(values) > FILTER_MAX_IN_VALUES:
+                raise FilterError(f"{column}[in] 最多 {FILTER_MAX_IN_VALUES} 個值")
+            filters.append((column, op, [_convert(column, data_type, v) for v in values]))
+        elif op == "prefix":
+            if data_type not in TEXT_TYPES:
+                raise FilterError(f"{column} 不是文字欄位，不能用 prefix")
+            filters.append((column, op, value))
+        elif op == "null":
+            try:
+                filters.append((column, op, _boolean(value)))
+            except ValueError:
+                raise FilterError(f"{column}[null] 只能是 true 或 false")
+        else:
+            filters.append((column, op, _convert(column, data_type, value)))
+    return filters
+
+
+def compile_filters(filters):
+    """轉成 WHERE 後面的條件 (sql.Composed) 與參數；沒有條件時回傳 (None, [])"""
+    parts, params = [], []
+    for column, op, value in filters:
+        ident = sql.Identifier(column)
+        if op == "in":
+            parts.append(sql.SQL("{} = ANY({})").format(ident, sql.Placeholder()))
+            params.append(value)
+        elif op == "prefix":
+            parts.append(sql.SQL("{} LIKE {}").format(ident, sql.Placeholder()))
+            params.append(_escape_like(value) + "%")
+        elif op == "null":
+            parts.append(sql.SQL("{} IS NULL" if value else "{} IS NOT NULL").format(ident))
+        else:
+            parts.append(sql.SQL("{} {} {}").format(ident, sql.SQL(COMPARISONS[op]), sql.Placeholder()))
+            params.append(value)
+    if not parts:
+        return None, []
+    return sql.SQL(" AND ").join(parts), params
+
+
+def filter_columns(filters, ops=None):
+    """條件用到的欄位 (依出現順序、不重複)；ops 有值時只算這些運算子"""
+    columns = []
+    for column, op, _ in filters:
+        if (ops is None or op in ops) and column not in columns:
+            columns.append(column)
+    return columns
+
+
+def filters_shape(filters):
+    """條件的型態 (欄位、運算子；null 要分 IS NULL / IS NOT NULL)，不含值：組出來的 SQL 只跟這個有關 (見 statement_cache.py)"""
+    return tuple((column, op, value if op == "null" else None) for column, op, value in filters)
+
+
+def filters_signature(filters):
+    """條件的指紋 (放進 cursor，換了條件後舊的 cursor 就不能用)；沒有條件時是空字串"""
+    if not filters:
+        return ""
+    canonical = json.dumps(sorted([column, op, value] for column, op, value in filters), default=str)
+    return hashlib.sha1(canonical.encode()).hexdigest()[:12]
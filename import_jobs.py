@@ -0,0 +1,332 @@
+"""
+上傳 CSV 匯入：POST /api/import/{table_name}，不用登入主機跑 import.py
+
+request body 就是 CSV 檔 (第一行是標題列)，例如：
+    curl -X POST --data-binary @student_vle.csv -H "Content-Type: text/csv" http://127.0.0.1:8000/api/import/student_vle
+收到的每一塊直接丟進有上限的 queue，背景執行緒的 COPY FROM STDIN 從 queue 讀 (跟 export.py 反過來)，
+檔案不會整個放進記憶體、也不會先存到磁碟；COPY 來不及讀時 queue 滿了，上傳就跟著慢下來 (背壓)。
+轉換跟 import.py 一樣 (csv_import.import_stream)：courses 拆年份 / 月份、student_assessment 補 code_module /
+code_presentation、student_vle 同一個主鍵的 sum_click 加總。
+
+整個匯入是同一個交易：成功才 commit，失敗或取消就整個 rollback，資料表維持上傳前的樣子。
+資料表裡已經有的主鍵會讓整個工作失敗 (要更新既有資料請用 import.py --incremental 或 bulk.py)。
+上傳收完就回 202 (student_vle 的加總、commit 可能還在跑)，之後用工作編號查進度：
+    GET  /api/import/jobs                  最近的工作
+    GET  /api/import/jobs/{job_id}         狀態、階段、已讀 bytes / 筆數、每秒幾筆、進度 % (有 Content-Length 時)
+    POST /api/import/jobs/{job_id}/cancel  取消 (commit 之前都可以)，正在跑的 SQL 會被中斷
+工作紀錄只在這個 process 的記憶體裡 (uvicorn 開多個 worker 時，要問收到上傳的那一個)。
+精簡格式 (compact_schema.py) 的表不支援上傳，請用 import.py --compact。
+"""
+import io
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import psycopg2
+from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+from csv_import import COPY_READ_BYTES, import_stream
+from db_pool import get_pool, PoolTimeout
+from read_replicas import replicas
+from response_cache import response_cache
+from row_counts import row_counts
+from schema_cache import schema, check_table
+
+router = APIRouter()
+
+# queue 最多放幾塊上傳的資料 (每塊大小由 server 決定，通常 64 KB 左右)
+UPLOAD_QUEUE_CHUNKS = 64
+# courses / student_assessment 要經過 pandas 轉換，每塊讀幾筆
+UPLOAD_CHUNK_ROWS = int(os.getenv("IMPORT_UPLOAD_CHUNK_ROWS", "20000"))
+# 同時最多幾個上傳在跑
+IMPORT_MAX_JOBS = int(os.getenv("IMPORT_MAX_JOBS", "2"))
+# 結束的工作保留幾筆紀錄
+IMPORT_JOB_HISTORY = 50
+
+_END = None
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class _UploadStream(io.RawIOBase):
+    """從工作的 queue 讀上傳內容的 file-like (外面再包 BufferedReader 給 COPY / pandas 用)，順便算進度"""
+
+    def __init__(self, job):
+        self.job = job
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.buf):
+            if self.eof:
+                return 0
+            chunk = self.job.next_chunk()
+            if chunk is _END:
+                self.eof = True
+                return 0
+            self.buf, self.pos = chunk, 0
+        data = self.buf[self.pos:self.pos + len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        self.job.consumed(data)
+        return len(data)
+
+
+class ImportJob:
+    def __init__(self, table_name, total_bytes=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.table_name = table_name
+        self.total_bytes = total_bytes
+        self.status = "running"
+        self.phase = "upload"
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.rows_loaded = None
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._started = time.monotonic()
+        self._elapsed = None
+        self._chunks = queue.Queue(maxsize=UPLOAD_QUEUE_CHUNKS)
+        self._cancel = threading.Event()
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    # ---------- 上傳端 (request handler) ----------
+    def feed(self, chunk):
+        """丟一塊進 queue，滿了就等；工作已經結束 (失敗 / 取消) 時回傳 False，不用再收了"""
+        while not self.finished.is_set():
+            try:
+                self._chunks.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def try_feed(self, chunk):
+        """不等待的版本：queue 還有空位就直接放 (不用每塊都切到 thread)"""
+        try:
+            self._chunks.put_nowait(chunk)
+            return True
+        except queue.Full:
+            return False
+
+    # ---------- 匯入端 (背景執行緒) ----------
+    def next_chunk(self):
+        while True:
+            if self._cancel.is_set():
+                raise ImportCancelled("已取消")
+            try:
+                return self._chunks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def consumed(self, data):
+        self.bytes_read += len(data)
+        self.lines_read += data.count(b"\n")
+
+    def set_phase(self, phase):
+        with self._lock:
+            if self._cancel.is_set():
+                raise ImportCancelled("已取消")
+            self.phase = phase
+
+    def run(self):
+        db_pool = get_pool()
+        try:
+            conn = db_pool.getconn()
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            self._finish("failed", f"資料庫連線失敗：{e}")
+            return
+        with self._lock:
+            self._conn = conn
+        broken = False
+        try:
+            source = io.BufferedReader(_UploadStream(self), COPY_READ_BYTES)
+            with conn.cursor() as cur:
+                rows = import_stream(cur, self.table_name, source, UPLOAD_CHUNK_ROWS, self.set_phase)
+                # 標題列之後還有沒讀完的 (例如 pandas 讀到一半就出錯) 不算成功
+                if source.read(1):
+                    raise ValueError("上傳的內容沒有全部讀完")
+                self.set_phase("commit")
+                conn.commit()
+            self.rows_loaded = rows
+            # 之後的讀取要等唯讀副本重播到這裡 (上傳的回應在 commit 之前就送出了，middleware 記不到)
+            try:
+                replicas.note_write(conn)
+            except psycopg2.Error as e:
+                conn.rollback()
+                print("⚠️ 無法取得寫入後的 WAL 位置:", e)
+            row_counts.invalidate(self.table_name)
+            response_cache.invalidate(self.table_name)
+            self._analyze(conn)
+            self._finish("succeeded")
+        except Exception as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            if self._cancel.is_set():
+                self._finish("cancelled")
+            else:
+                self._finish("failed", str(e).strip())
+        finally:
+            with self._lock:
+                self._conn = None
+            db_pool.putconn(conn, broken=broken)
+            # 上傳端可能還卡在 put，清空讓它發現工作結束了
+            while True:
+                try:
+                    self._chunks.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _analyze(self, conn):
+        """一次寫進很多筆，統計資訊順便更新 (失敗不影響已經 commit 的資料)"""
+        with self._lock:
+            self.phase = "analyze"
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"ANALYZE {self.table_name}")
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️ ANALYZE {self.table_name} 失敗:", e)
+
+    def _finish(self, status, error=None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.phase = None
+            self.finished_at = time.time()
+            self._elapsed = time.monotonic() - self._started
+        self.finished.set()
+
+    def cancel(self):
+        """commit 之前都可以取消，回傳有沒有取消成功"""
+        with self._lock:
+            if self.status != "running" or self.phase in ("commit", "analyze"):
+                return False
+            self._cancel.set()
+            conn = self._conn
+        # 正在跑的 SQL (例如 student_vle 的加總) 直接中斷；卡在讀上傳內容的 COPY 會在下一次讀的時候停下來
+        if conn is not None:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = self._elapsed if self._elapsed is not None else time.monotonic() - self._started
+            rows = max(0, self.lines_read - 1)
+            return {
+                "job_id": self.id,
+                "table": self.table_name,
+                "status": self.status,
+                "phase": self.phase,
+                "bytes_read": self.bytes_read,
+                "total_bytes": self.total_bytes,
+                "progress": (round(min(100.0, self.bytes_read / self.total_bytes * 100), 1)
+                             if self.total_bytes else None),
+                "rows_read": rows,
+                "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else None,
+                "rows_loaded": self.rows_loaded,
+                "elapsed_seconds": round(elapsed, 3),
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "error": self.error,
+            }
+
+
+class ImportJobs:
+    """這個 process 的上傳工作 (跑完的保留最近 IMPORT_JOB_HISTORY 筆)"""
+
+    def __init__(self):
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, table_name, total_bytes=None):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if not job.finished.is_set())
+            if running >= IMPORT_MAX_JOBS:
+                return None
+            job = ImportJob(table_name, total_bytes)
+            self._jobs[job.id] = job
+            finished = [k for k, j in self._jobs.items() if j.finished.is_set()]
+            for key in finished[:max(0, len(finished) - IMPORT_JOB_HISTORY)]:
+                del self._jobs[key]
+        threading.Thread(target=job.run, name=f"import-{job.id}", daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+
+jobs = ImportJobs()
+
+
+def _get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"找不到匯入工作 {job_id}")
+    return job
+
+
+@router.post("/api/import/{table_name}", status_code=202)
+async def upload_csv(table_name: str, request: Request):
+    check_table(table_name)
+    if schema.encoded_columns(table_name):
+        raise HTTPException(status_code=400, detail="精簡格式的資料表不支援上傳，請用 import.py --compact")
+    length = request.headers.get("content-length")
+    job = jobs.start(table_name, int(length) if length and length.isdigit() else None)
+    if job is None:
+        raise HTTPException(status_code=429, detail=f"同時最多 {IMPORT_MAX_JOBS} 個匯入，請稍後再試")
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if not job.try_feed(chunk) and not await run_in_threadpool(job.feed, chunk):
+                break
+    except ClientDisconnect:
+        job.cancel()
+    # 上傳收完了 (或工作已經結束)，剩下的在背景跑
+    if not job.finished.is_set():
+        await run_in_threadpool(job.feed, _END)
+    return job.snapshot()
+
+
+@router.get("/api/import/jobs")
+def list_import_jobs():
+    return {"jobs": [job.snapshot() for job in reversed(jobs.list())]}
+
+
+@router.get("/api/import/jobs/{job_id}")
+def get_import_job(job_id: str):
+    return _get_job(job_id).snapshot()
+
+
+@router.post("/api/import/jobs/{job_id}/cancel")
+def cancel_import_job(job_id: str):
+    job = _get_job(job_id)
+    if not job.cancel():
+        raise HTTPException(status_code=409, detail=f"工作已經是 {job.status} / {job.phase}，不能取消")
+    return {"message": "已取消", "job_id": job.id}
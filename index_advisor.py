@@ -0,0 +1,516 @@
+"""
+索引建議：依 API 實際收到的查詢型態 (workload) 建議要加哪些索引
+
+init.sql 只有主鍵，get_data 用非主鍵開頭的欄位排序 (score、date、sum_click、final_result…)，
+或 update / delete 用非主鍵欄位當條件時，都是整張表掃過再排序。
+1. 記錄：main.py / export.py 每次查詢呼叫 workload.record(表, 種類, 排序欄位, 篩選欄位)，
+   只記「型態」不記值，先累積在記憶體，每 INDEX_WORKLOAD_FLUSH 秒寫進 query_shapes 表一次
+   (多個 uvicorn worker 共用，重啟也不會不見)
+2. 建議：對每個型態檢查現有索引 (含主鍵) 能不能用；不能用就建議一個
+   - B-tree：(等號篩選欄位…, 排序欄位)，篩選欄位不同值越多的排越前面
+   - BRIN：只有單一欄位篩選、沒有排序、表夠大 (>= INDEX_BRIN_MIN_ROWS) 而且該欄位跟實體順序高度相關時
+     (例如依 date 匯入的 student_vle)，索引只有幾 KB
+3. 量測 (python index_advisor.py)：每個型態用表裡抽樣的值組出一個代表查詢，
+   EXPLAIN ANALYZE 建索引前 / 後的 plan cost 與執行時間。
+   沒加 --apply 時「建索引後」是在交易裡試建、量完就 rollback (試建期間會擋住那張表的寫入)；
+   加 --apply 時用 CREATE INDEX CONCURRENTLY 真的建立 (不擋寫入)
+
+建立的索引名稱都以 advisor_ 開頭；import.py 完整重新匯入 (drop table) 後要再跑一次 --apply。
+分區表 (partitioning.py) 不能直接 CREATE INDEX CONCURRENTLY：先在父表建 ON ONLY 的索引，
+每個分區各自 CONCURRENTLY 建好再 ATTACH 上去，全部掛上之後父表的索引才算有效。
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from tabulate import tabulate
+
+from db_pool import get_pool
+from filters import compile_filters
+from pagination import build_page_query
+from partitioning import children, is_partitioned
+from row_counts import ESTIMATE_QUERY
+
+WORKLOAD_TABLE = "query_shapes"
+WORKLOAD_LOG = os.getenv("INDEX_WORKLOAD_LOG", "1") == "1"
+WORKLOAD_FLUSH_INTERVAL = float(os.getenv("INDEX_WORKLOAD_FLUSH", "30"))
+BRIN_MIN_ROWS = int(os.getenv("INDEX_BRIN_MIN_ROWS", "1000000"))
+BRIN_MIN_CORRELATION = 0.9
+INDEX_PREFIX = "advisor_"
+# 代表查詢每個跑幾次取最快的 (排除第一次讀磁碟的影響)
+MEASURE_RUNS = 3
+PAGE_LIMIT = 100
+
+CREATE_WORKLOAD_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {WORKLOAD_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        kind VARCHAR(16) NOT NULL,
+        sort_by VARCHAR(64) NOT NULL,
+        filters TEXT[] NOT NULL,
+        calls BIGINT NOT NULL,
+        timed_calls BIGINT NOT NULL,
+        total_ms DOUBLE PRECISION NOT NULL,
+        last_seen TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (table_name, kind, sort_by, filters)
+    )
+"""
+
+INDEXES_QUERY = """
+    SELECT ic.relname, am.amname,
+           ARRAY(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+                 JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                 ORDER BY k.n) AS columns,
+           i.indexprs IS NOT NULL OR i.indpred IS NOT NULL AS partial
+    FROM pg_index i
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = ic.relam
+    WHERE i.indrelid = to_regclass(%s) AND i.indisvalid
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT a.attname
+    FROM pg_index i
+    JOIN unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) ON true
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+    WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+    ORDER BY k.n
+"""
+
+COLUMN_STATS_QUERY = """
+    SELECT s.attname,
+           CASE WHEN s.n_distinct < 0 THEN -s.n_distinct * c.reltuples ELSE s.n_distinct END,
+           s.correlation
+    FROM pg_stats s
+    JOIN pg_class c ON c.oid = to_regclass(%s)
+    WHERE s.schemaname = 'public' AND s.tablename = %s
+"""
+
+
+class WorkloadLog:
+    """
+    查詢型態計數器：record 只動記憶體，累積一段時間才在背景寫進資料庫。
+    種類：page = get_data 翻頁，update / delete = 依條件改 / 刪，export = 整表匯出
+    """
+
+    def __init__(self, interval=WORKLOAD_FLUSH_INTERVAL, enabled=WORKLOAD_LOG):
+        self.interval = interval
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pending = {}   # (表, 種類, 排序欄位, 篩選欄位) -> [次數, 有計時的次數, 總毫秒]
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        self._table_ready = False
+
+    def record(self, table_name, kind, sort_by=None, filters=(), elapsed_ms=None):
+        if not self.enabled:
+            return
+        key = (table_name, kind, sort_by or "", tuple(sorted(filters)))
+        with self._lock:
+            entry = self._pending.setdefault(key, [0, 0, 0.0])
+            entry[0] += 1
+            if elapsed_ms is not None:
+                entry[1] += 1
+                entry[2] += elapsed_ms
+            due = not self._flushing and time.monotonic() - self._last_flush >= self.interval
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._flush_in_background, name="workload-flush", daemon=True).start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print("⚠️ 查詢型態紀錄寫入失敗:", e)
+        finally:
+            with self._lock:
+                self._flushing = False
+
+    def flush(self):
+        """把累積的計數寫進 query_shapes (寫入失敗時放回去，下次再寫)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            with get_pool().connection() as conn:
+                with conn.cursor() as cur:
+                    if not self._table_ready:
+                        cur.execute(CREATE_WORKLOAD_TABLE)
+                        self._table_ready = True
+                    execute_values(cur, f"""
+                        INSERT INTO {WORKLOAD_TABLE} AS q
+                            (table_name, kind, sort_by, filters, calls, timed_calls, total_ms, last_seen)
+                        VALUES %s
+                        ON CONFLICT (table_name, kind, sort_by, filters) DO UPDATE
+                        SET calls = q.calls + EXCLUDED.calls,
+                            timed_calls = q.timed_calls + EXCLUDED.timed_calls,
+                            total_ms = q.total_ms + EXCLUDED.total_ms,
+                            last_seen = EXCLUDED.last_seen
+                    """, [(t, k, s, list(f), calls, timed, ms) for (t, k, s, f), (calls, timed, ms) in pending.items()],
+                        template="(%s, %s, %s, %s, %s, %s, %s, now())")
+                conn.commit()
+        except Exception:
+            with self._lock:
+                for key, (calls, timed, ms) in pending.items():
+                    entry = self._pending.setdefault(key, [0, 0, 0.0])
+                    entry[0] += calls
+                    entry[1] += timed
+                    entry[2] += ms
+            raise
+
+
+# 全域的紀錄 (各 uvicorn worker 各一份，都寫進同一張 query_shapes)
+workload = WorkloadLog()
+
+
+def load_workload(cur, min_calls=1):
+    cur.execute("SELECT to_regclass(%s)", (WORKLOAD_TABLE,))
+    if cur.fetchone()[0] is None:
+        return []
+    cur.execute(f"""
+        SELECT table_name, kind, sort_by, filters, calls, total_ms / NULLIF(timed_calls, 0)
+        FROM {WORKLOAD_TABLE}
+        WHERE calls >= %s
+        ORDER BY calls DESC, table_name, kind
+    """, (min_calls,))
+    return [
+        {"table": t, "kind": k, "sort_by": s or None, "filters": list(f), "calls": calls,
+         "avg_ms": round(avg, 2) if avg is not None else None}
+        for t, k, s, f, calls, avg in cur.fetchall()
+    ]
+
+
+def existing_indexes(cur, table_name):
+    """[(名稱, 種類 btree / brin…, [欄位…])]，運算式索引與部分索引不算"""
+    cur.execute(INDEXES_QUERY, (table_name,))
+    return [(name, method, columns) for name, method, columns, partial in cur.fetchall() if not partial]
+
+
+def served_by(indexes, shape):
+    """
+    現有索引裡能服務這個型態的那一個 (名稱)，沒有就回傳 None。
+    B-tree：開頭幾個欄位都是等號篩選欄位，接著是排序欄位 (沒有排序時至少要用到一個篩選欄位)；
+    BRIN：單一欄位篩選
+    """
+    filters, sort_by = set(shape["filters"]), shape["sort_by"]
+    if not filters and not sort_by:
+        # 不排序的翻頁照主鍵順序讀；不篩選也不排序的匯出本來就要讀整張表
+        return "primary key" if shape["kind"] == "page" else "full scan"
+    for name, method, columns in indexes:
+        if method == "brin":
+            if not sort_by and len(filters) == 1 and columns[0] in filters:
+                return name
+            continue
+        if method != "btree":
+            continue
+        i = 0
+        while i < len(columns) and columns[i] in filters:
+            i += 1
+        if sort_by and sort_by not in filters:
+            if i < len(columns) and columns[i] == sort_by:
+                return name
+        elif i > 0:
+            return name
+    return None
+
+
+def column_stats(cur, table_name):
+    """{欄位: (不同值的個數, 與實體順序的相關係數)}，沒 ANALYZE 過的欄位不在裡面"""
+    cur.execute(COLUMN_STATS_QUERY, (table_name, table_name))
+    return {name: (distinct, correlation) for name, distinct, correlation in cur.fetchall()}
+
+
+def table_rows(cur, table_name):
+    """估計筆數 (分區表是各分區加總)"""
+    cur.execute(ESTIMATE_QUERY, (table_name,))
+    return cur.fetchone()[0] or 0
+
+
+def index_name(table_name, columns, method):
+    name = f"{INDEX_PREFIX}{table_name}_{'_'.join(columns)}" + ("_brin" if method == "brin" else "")
+    return name[:63]
+
+
+def recommend(cur, shape, stats=None):
+    """建議的索引 {"name", "method", "columns", "definition"}"""
+    table_name = shape["table"]
+    stats = stats if stats is not None else column_stats(cur, table_name)
+    filters = sorted(shape["filters"], key=lambda c: -(stats.get(c, (0, None))[0] or 0))
+    columns = filters + ([shape["sort_by"]] if shape["sort_by"] and shape["sort_by"] not in filters else [])
+    method = "btree"
+    if not shape["sort_by"] and len(columns) == 1:
+        correlation = stats.get(columns[0], (0, None))[1]
+        if (correlation is not None and abs(correlation) >= BRIN_MIN_CORRELATION
+                and table_rows(cur, table_name) >= BRIN_MIN_ROWS):
+            method = "brin"
+    name = index_name(table_name, columns, method)
+    definition = sql.SQL("ON {} USING {} ({})").format(
+        sql.Identifier(table_name), sql.SQL(method), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    return {"name": name, "method": method, "columns": columns, "definition": definition}
+
+
+def primary_key(cur, table_name):
+    cur.execute(PRIMARY_KEY_QUERY, (table_name,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def sample_query(cur, shape):
+    """
+    這個型態的代表查詢 (query, params)；篩選值從表裡抽樣一筆。
+    update / delete 只量「找出要改的那幾筆」(SELECT ctid ... WHERE)，不真的改資料
+    """
+    table = sql.Identifier(shape["table"])
+    filters = shape["filters"]
+    values = []
+    if filters:
+        columns = sql.SQL(", ").join(map(sql.Identifier, filters))
+        cur.execute(sql.SQL("SELECT {} FROM {} TABLESAMPLE SYSTEM (1) REPEATABLE (0) LIMIT 1").format(columns, table))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(sql.SQL("SELECT {} FROM {} LIMIT 1").format(columns, table))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        values = list(row)
+    where = sql.SQL(" AND ").join(
+        sql.SQL("{} IS NOT DISTINCT FROM {}").format(sql.Identifier(c), sql.Placeholder()) for c in filters
+    )
+
+    if shape["kind"] == "page":
+        sort = [(shape["sort_by"], False)] if shape["sort_by"] else []
+        page_where, page_params = compile_filters(
+            [(c, "null", True) if v is None else (c, "eq", v) for c, v in zip(filters, values)]
+        )
+        return build_page_query(shape["table"], {"primary_key": primary_key(cur, shape["table"])},
+                                sort, PAGE_LIMIT, where=page_where, where_params=page_params)
+    if shape["kind"] in ("update", "delete"):
+        return sql.SQL("SELECT ctid FROM {} WHERE {}").format(table, where), values
+    query = sql.SQL("SELECT * FROM {}").format(table)
+    if filters:
+        query += sql.SQL(" WHERE ") + where
+    if shape["sort_by"]:
+        query += sql.SQL(" ORDER BY {}").format(sql.Identifier(shape["sort_by"]))
+    return query, values
+
+
+def measure(cur, query, params):
+    """
+    EXPLAIN ANALYZE 幾次，回傳最快那次的
+    {"cost": plan 總 cost, "ms": 執行時間, "plan": 節點摘要, "indexes": [plan 裡用到的索引]}
+    """
+    best = None
+    for _ in range(MEASURE_RUNS):
+        cur.execute(sql.SQL("EXPLAIN (ANALYZE, FORMAT JSON) ") + query, params)
+        result = cur.fetchone()[0]
+        plan = (json.loads(result) if isinstance(result, str) else result)[0]
+        if best is None or plan["Execution Time"] < best["ms"]:
+            best = {"cost": plan["Plan"]["Total Cost"], "ms": round(plan["Execution Time"], 3),
+                    "plan": _plan_summary(plan["Plan"]), "indexes": sorted(_plan_indexes(plan["Plan"]))}
+    return best
+
+
+def _plan_indexes(node):
+    names = {node["Index Name"]} if "Index Name" in node else set()
+    for child in node.get("Plans") or []:
+        names |= _plan_indexes(child)
+    return names
+
+
+def _plan_summary(node):
+    """plan 的節點種類 (含用到的索引)，例如 'Limit > Index Scan (advisor_student_vle_sum_click)'"""
+    parts = []
+    while node:
+        label = node["Node Type"]
+        if "Index Name" in node:
+            label += f" ({node['Index Name']})"
+        parts.append(label)
+        children = node.get("Plans") or []
+        node = children[0] if children else None
+    return " > ".join(parts)
+
+
+def _create_index(conn, index, concurrently):
+    with conn.cursor() as cur:
+        if concurrently and is_partitioned(cur, index["table"]):
+            _create_partitioned_index(cur, index["table"], index["name"], index["method"], index["columns"])
+            return
+        statement = sql.SQL("CREATE INDEX {}{} {}").format(
+            sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(index["name"]), index["definition"]
+        )
+        cur.execute(statement)
+
+
+def _create_partitioned_index(cur, table_name, name, method, columns):
+    """
+    分區表：父表建 ON ONLY 的索引 (先是 INVALID)，每個分區 CONCURRENTLY 建好再 ATTACH (子分區再往下一層)。
+    要在 autocommit 下執行；中途失敗時把已經建的都刪掉
+    """
+    created = []
+    try:
+        cur.execute(sql.SQL("CREATE INDEX {} ON ONLY {} USING {} ({})").format(
+            sql.Identifier(name), sql.Identifier(table_name), sql.SQL(method),
+            sql.SQL(", ").join(map(sql.Identifier, columns))))
+        created.append(name)
+        for child, relkind, _ in children(cur, table_name):
+            child_index = index_name(child, columns, method)
+            if relkind == "p":
+                _create_partitioned_index(cur, child, child_index, method, columns)
+            else:
+                cur.execute(sql.SQL("CREATE INDEX CONCURRENTLY {} ON {} USING {} ({})").format(
+                    sql.Identifier(child_index), sql.Identifier(child), sql.SQL(method),
+                    sql.SQL(", ").join(map(sql.Identifier, columns))))
+            created.append(child_index)
+            cur.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                sql.Identifier(name), sql.Identifier(child_index)))
+    except Exception:
+        for index in reversed(created):
+            _drop_index(cur, index)
+        raise
+
+
+def _drop_index(cur, name):
+    """分區表的索引不能 DROP CONCURRENTLY (會連同各分區的索引一起刪)；要在 autocommit 下執行"""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (name,))
+    row = cur.fetchone()
+    if row is None:
+        return
+    cur.execute(sql.SQL("DROP INDEX {}IF EXISTS {}").format(
+        sql.SQL("" if row[0] == "I" else "CONCURRENTLY "), sql.Identifier(name)))
+
+
+def _index_tree(cur, name):
+    """索引本身 + 各分區上掛的索引名稱 (分區表的 plan 裡出現的是分區的索引)"""
+    cur.execute("SELECT relid::regclass::text FROM pg_partition_tree(to_regclass(%s))", (name,))
+    return {name} | {row[0] for row in cur.fetchall()}
+
+
+def advise(conn, apply=False, min_calls=1, run_measure=True):
+    """
+    對 query_shapes 裡每個型態 (至少 min_calls 次) 給出建議。回傳 list，每個型態一筆：
+    {table, kind, sort_by, filters, calls, avg_ms, status, index, definition, before, after}
+    status：served (現有索引可用，index = 那個索引) / recommended / created / unused / failed。
+    同一個建議的索引可以服務好幾個型態時只建一個；
+    量測時 planner 在所有相關型態都沒選用的索引 (例如篩選值佔了大半張表) 標成 unused，apply 時建了也會再刪掉
+    """
+    report = []
+    planned = {}   # 索引名稱 → (建議, [用到它的型態])
+    with conn.cursor() as cur:
+        for shape in load_workload(cur, min_calls):
+            entry = dict(shape, status="served", index=None, definition=None, before=None, after=None)
+            report.append(entry)
+            if _missing_table(cur, shape["table"]):
+                entry.update(status="failed", error="資料表不存在")
+                continue
+            entry["index"] = served_by(existing_indexes(cur, shape["table"]), shape)
+            if entry["index"] is not None:
+                continue
+            proposed = [(name, index["method"], index["columns"]) for name, (index, _) in planned.items()
+                        if index["table"] == shape["table"]]
+            name = served_by(proposed, shape)
+            if name is None:
+                index = dict(recommend(cur, shape), table=shape["table"])
+                name = index["name"]
+                planned[name] = (index, [])
+            planned[name][1].append(entry)
+            entry.update(status="recommended", index=name,
+                         definition=f"CREATE INDEX {name} " + planned[name][0]["definition"].as_string(conn))
+            if run_measure:
+                entry["sample"] = sample_query(cur, shape)
+                if entry["sample"] is not None:
+                    entry["before"] = measure(cur, *entry["sample"])
+    conn.rollback()
+
+    for index, entries in planned.values():
+        if apply:
+            try:
+                conn.autocommit = True
+                _create_index(conn, index, concurrently=True)
+            except Exception as e:
+                # CONCURRENTLY 失敗會留下 INVALID 的索引，要清掉
+                with conn.cursor() as cur:
+                    _drop_index(cur, index["name"])
+                for entry in entries:
+                    entry.update(status="failed", error=str(e))
+                continue
+            finally:
+                conn.autocommit = False
+            for entry in entries:
+                entry["status"] = "created"
+        elif not run_measure:
+            continue
+        else:
+            # 沒有 apply：在交易裡試建，量完 rollback
+            _create_index(conn, index, concurrently=False)
+        with conn.cursor() as cur:
+            tree = _index_tree(cur, index["name"])
+            for entry in entries:
+                if entry.get("sample") is not None:
+                    entry["after"] = measure(cur, *entry["sample"])
+        conn.rollback()
+
+        measured = [entry["after"] for entry in entries if entry["after"]]
+        if measured and not any(tree & set(after["indexes"]) for after in measured):
+            for entry in entries:
+                entry["status"] = "unused"
+            if apply:
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        _drop_index(cur, index["name"])
+                finally:
+                    conn.autocommit = False
+
+    for entry in report:
+        entry.pop("sample", None)
+    return report
+
+
+def _missing_table(cur, table_name):
+    cur.execute("SELECT to_regclass(%s) IS NULL", (table_name,))
+    return cur.fetchone()[0]
+
+
+def print_report(report):
+    def fmt(m):
+        return f"{m['cost']:.0f} / {m['ms']:.2f} ms" if m else ""
+
+    rows = [
+        (r["table"], r["kind"], r["sort_by"] or "", ", ".join(r["filters"]), r["calls"], r["status"],
+         r["index"] or "", fmt(r["before"]), fmt(r["after"]))
+        for r in report
+    ]
+    print(tabulate(rows, headers=["table", "kind", "sort_by", "filters", "calls", "status", "index",
+                                  "before (cost / time)", "after (cost / time)"], tablefmt="psql"))
+    for r in report:
+        if r.get("error"):
+            print(f"❌ {r['table']} {r['index'] or ''}: {r['error']}")
+    for r in report:
+        if r["before"] and r["after"]:
+            print(f"   {r['index']}: {r['before']['plan']}  →  {r['after']['plan']}")
+    definitions = sorted({r["definition"] for r in report if r["status"] == "recommended" and r["definition"]})
+    if definitions:
+        print("\n建議的索引 (加 --apply 用 CREATE INDEX CONCURRENTLY 建立)：")
+        for definition in definitions:
+            print(f"   {definition};")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="依 API 收到的查詢型態建議 / 建立索引")
+    parser.add_argument("--apply", action="store_true", help="用 CREATE INDEX CONCURRENTLY 建立建議的索引")
+    parser.add_argument("--min-calls", type=int, default=1, help="至少出現幾次的查詢型態才考慮")
+    parser.add_argument("--no-measure", action="store_true", help="只列建議，不跑 EXPLAIN ANALYZE 量測前後差異")
+    args = parser.parse_args()
+
+    with get_pool().connection() as conn:
+        report = advise(conn, apply=args.apply, min_calls=args.min_calls, run_measure=not args.no_measure)
+    if not report:
+        print("⚠️ 還沒有任何查詢型態紀錄 (先讓 API 跑一陣子，或 INDEX_WORKLOAD_LOG=0 關掉了)")
+    else:
+        print_report(report)
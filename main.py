@@ -1,66 +1,111 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, PlainTextResponse
 import psycopg2
-from psycopg2.extras import RealDictCursor
 from psycopg2 import sql
 import os
-from typing import List, Dict, Any, Optional
+from typing import Optional
+from contextlib import contextmanager
 from dotenv import load_dotenv
-import datetime
-import math
+import time
+
+from db_pool import get_pool, close_pool, PoolTimeout
+from models import UpdatePayload, CreatePayload
+from filters import FilterError, parse_filters, compile_filters, filter_columns, filters_signature, filters_shape
+from pagination import (
+    CursorError, PAGE_PARAMS, resolve_page_request, page_query, page_shape, finish_page,
+    build_pagination
+)
+from response_cache import response_cache
+from row_counts import row_counts, count_rows, count_filtered
+from serialization import RESPONSE_FORMATS, encode_rows, page_payload, temporal_indexes
+from schema_cache import schema, check_table, start_schema_listener, stop_schema_listener
+from compact_schema import dictionary
+import export
+import bulk
+import stats
+import import_jobs
+from index_advisor import workload, advise
+import query_metrics
+from query_metrics import TimingMiddleware, metrics, slow_log
+from read_replicas import ReadRoutingMiddleware, acquire_read, replicas, served_lsn
+from statement_cache import statements
 
 load_dotenv()
 
 # 設定 API 文件標題
 app = FastAPI(title="成績計算與管理系統", description="用於管理成績資料庫的後端 API")
+# 每個請求記下借連線 / 每個 SQL / 編碼的時間，回應加 Server-Timing 標頭 (見 query_metrics.py)
+app.add_middleware(TimingMiddleware)
+# 設定 DB_READ_REPLICAS 時讀取分到唯讀副本，寫入後記下 WAL 位置 (read-after-write，見 read_replicas.py)
+app.add_middleware(ReadRoutingMiddleware)
+
+# DB_ASYNC=1 時 /api/data/{table_name} 這組改走 asyncpg (見 async_api.py)
+# FastAPI 依註冊順序比對路由，所以要在同步版之前掛上去
+ASYNC_DB = os.getenv("DB_ASYNC", "0") == "1"
+if ASYNC_DB:
+    import async_api
+    app.include_router(async_api.router)
+    app.on_event("startup")(async_api.open_async_pool)
+    app.on_event("shutdown")(async_api.close_async_pool)
 
-# 資料庫連線
-def get_db_connection():
+# 資料庫連線：從連線池借一條，離開 with 區塊時自動歸還 (連線設定見 db_pool.py)
+# read_only=True 時可能借到唯讀副本的連線 (見 read_replicas.py)
+@contextmanager
+def get_db_connection(read_only=False):
     try:
-        conn = psycopg2.connect(
-            host="localhost",
-            database="final_project", # 請確認資料庫名稱
-            user="postgres",
-            password=os.getenv("PASSWORD")
-        )
-        return conn
-    except Exception as e:
+        if read_only:
+            db_pool, conn = acquire_read()
+        else:
+            db_pool = get_pool()
+            conn = db_pool.getconn()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
         print("DB Connection Error:", e)
-        return None
+        raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+    try:
+        yield conn
+    finally:
+        # 沒 commit 的交易會在歸還時 rollback，壞掉的連線會被丟掉
+        db_pool.putconn(conn)
 
-# 通用的更新模型
-class UpdatePayload(BaseModel):
-    data: Dict[str, Any]      
-    conditions: Dict[str, Any] 
+# 啟動時載入資料表結構快取，並監聽 DDL 自動重新載入 (見 schema_cache.py)
+@app.on_event("startup")
+def startup_schema_cache():
+    try:
+        start_schema_listener()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("⚠️ 無法載入資料表結構，第一次查詢時再載入:", e)
+
+# 有設定唯讀副本時開始定期檢查 (見 read_replicas.py)；
+# 回應快取作廢時記下寫入位置，落後的副本讀到的頁面才不會被存起來 (見 response_cache.py)
+@app.on_event("startup")
+def startup_replicas():
+    replicas.start()
+    if replicas.enabled:
+        response_cache.write_lsn = replicas.note_write
 
-# 通用的新增模型
-class CreatePayload(BaseModel):
-    data: Dict[str, Any]
+@app.on_event("shutdown")
+def shutdown_pool():
+    stop_schema_listener()
+    replicas.stop()
+    try:
+        workload.flush()
+    except Exception as e:
+        print("⚠️ 查詢型態紀錄寫入失敗:", e)
+    close_pool()
 
 # 1. 取得所有表格名稱 (含過濾功能)
 @app.get("/api/tables")
 def get_tables():
-    conn = get_db_connection()
-    if not conn:
+    # 從 schema 快取讀，不查 information_schema
+    try:
+        all_tables = schema.table_names()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
         return []
-    
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT table_name 
-        FROM information_schema.tables 
-        WHERE table_schema = 'public' 
-        AND table_type = 'BASE TABLE'
-        ORDER BY table_name;
-    """)
-    all_tables = [row[0] for row in cur.fetchall()]
-    
-    cur.close()
-    conn.close()
 
     # 過濾清單：隱藏不想顯示的表格
-    exclude_list = ['sqlite_sequence'] 
+    exclude_list = ['sqlite_sequence', 'import_manifest', 'stats_refresh', 'vle_rollup_student_week', 'vle_rollup_site_week', 'query_shapes'] 
     real_tables = [t for t in all_tables if t not in exclude_list]
 
     return real_tables
@@ -68,228 +113,298 @@ def get_tables():
 # 2. 取得指定表格的欄位資訊
 @app.get("/api/columns/{table_name}")
 def get_columns(table_name: str):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    query = sql.SQL("""
-        SELECT column_name, data_type 
-        FROM information_schema.columns 
-        WHERE table_name = %s 
-        ORDER BY ordinal_position;
-    """)
-    cur.execute(query, (table_name,))
-    columns = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    return columns
+    # 格式同以前的 information_schema 查詢：[{"column_name": ..., "data_type": ...}]
+    try:
+        return schema.columns_info(table_name)
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
+        return []
 
 # ==========================================
-# 3. 取得表格資料 (🚀 核心修改：截斷 1000 筆 + 分頁)
+# 3. 取得表格資料 (keyset 分頁，回傳 next_cursor / prev_cursor)
 # ==========================================
 @app.get("/api/data/{table_name}")
 def get_data(
     table_name: str, 
-    sort_by: Optional[str] = None, 
+    request: Request,
+    sort_by: Optional[str] = None,  # 可以多個欄位：score:desc,date_submitted
     order: str = "ASC",
     page: int = 1,      
-    limit: int = 100    # 預設每頁 100 筆
+    limit: int = 100,   # 預設每頁 100 筆
+    cursor: Optional[str] = None,  # 上一次回傳的 next_cursor / prev_cursor
+    format: str = "rows"  # columns：欄位名稱只列一次的精簡格式 (見 serialization.py)
 ):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # 🔴 硬性限制：最多只看前 1000 筆
-    HARD_LIMIT_RECORDS = 1000
-    
-    # 計算 OFFSET
-    offset = (page - 1) * limit
-
-    # 如果請求的資料起點已經超過 1000 筆，直接回傳空值
-    if offset >= HARD_LIMIT_RECORDS:
-        cur.close()
-        conn.close()
-        return {
-            "data": [],
-            "pagination": {
-                "current_page": page,
-                "per_page": limit,
-                "total_count": HARD_LIMIT_RECORDS,
-                "total_pages": math.ceil(HARD_LIMIT_RECORDS / limit)
-            }
-        }
-
-    # 如果讀取的範圍會超過 1000，強制把 limit 縮小 (例如讀到第 950 筆時，limit 剩 50)
-    if offset + limit > HARD_LIMIT_RECORDS:
-        limit = HARD_LIMIT_RECORDS - offset
+    check_table(table_name)
+    if format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format 只能是 {' / '.join(RESPONSE_FORMATS)}")
+    # 同樣的查詢最近算過就直接回傳 (寫入時作廢，見 response_cache.py)
+    cache_key = response_cache.key(request, schema.version)
+    cached, generation = response_cache.lookup(table_name, cache_key)
+    if cached is not None:
+        return response_cache.respond(request, *cached)
 
+    # 其他 query string 是篩選條件：欄位[運算子]=值 (語法見 filters.py)
     try:
-        # --- 步驟 1: 算總筆數 (但在這裡我們最多只回報 1000) ---
-        count_query = sql.SQL("SELECT COUNT(*) as count FROM {}").format(sql.Identifier(table_name))
-        cur.execute(count_query)
-        real_count = cur.fetchone()['count']
-        
-        # 這裡取最小值：如果資料庫只有 50 筆，就顯示 50；如果有 5000 筆，只顯示 1000
-        effective_count = min(real_count, HARD_LIMIT_RECORDS)
+        filters = parse_filters(request.query_params.multi_items(), schema.column_types(table_name), PAGE_PARAMS)
+    except FilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # --- 步驟 2: 抓取資料 ---
-        query_parts = [sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name))]
-        
-        if sort_by:
-            order_sql = sql.SQL("DESC") if order.upper() == "DESC" else sql.SQL("ASC")
-            query_parts.append(sql.SQL("ORDER BY {}").format(sql.Identifier(sort_by)))
-            query_parts.append(order_sql)
-        
-        # 使用計算過後的安全 limit
-        query_parts.append(sql.SQL("LIMIT {} OFFSET {}").format(sql.Literal(limit), sql.Literal(offset)))
-        
-        final_query = sql.SQL(" ").join(query_parts)
-        
-        cur.execute(final_query)
-        rows = cur.fetchall()
-        
-        # 日期轉字串
-        for row in rows:
-            for key, value in row.items():
-                if isinstance(value, (datetime.date, datetime.datetime)):
-                    row[key] = str(value)
-        
-        # 計算總頁數 (基於截斷後的 1000 筆來算)
-        # 如果 limit 是 100，effective_count 是 1000，那 total_pages 就是 10
-        # 加上 max(1, ...) 避免除以 0 錯誤
-        current_limit = 100 if limit == 0 else limit # 防止 limit 被縮減成 0 後計算頁數錯誤，這裡僅作顯示用
-        total_pages = math.ceil(effective_count / 100) # 這裡稍微 tricky：總頁數應該基於「前端設定的每頁筆數」來算，但為了簡化，我們先用 100 或前端傳來的原始 limit
-        
-        # 更精準的總頁數計算：應該用 payload 裡的原始 limit (但這裡已經被修改了)
-        # 簡單做法：直接回傳計算結果
-        calc_limit = limit if limit > 0 else 100
-        total_pages = math.ceil(effective_count / calc_limit)
-
-        # 修正：因為我們動態調整了 limit (例如最後一頁 limit 變小)，導致計算總頁數可能怪怪的
-        # 最穩妥的方式是：前端傳來的 limit 預設是 100，我們用 effective_count / 100 來算
-        # 但為了通用性，我們回傳時統一用 effective_count
-        
-        # 重新計算標準總頁數 (假設每頁 100)
-        standard_limit = 100
-        display_total_pages = math.ceil(effective_count / standard_limit)
-
-        return {
-            "data": rows,
-            "pagination": {
-                "current_page": page,
-                "per_page": limit,
-                "total_count": effective_count,
-                "total_pages": display_total_pages 
-            }
-        }
+    # 有 cursor 用 keyset 接著讀；沒有 cursor 時用 page 換算 OFFSET (規則見 pagination.py)
+    try:
+        req = resolve_page_request(sort_by, order, page, limit, cursor, filters_signature(filters))
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    except Exception as e:
-        print(e)
-        return {"data": [], "pagination": {"current_page": 1, "total_count": 0, "total_pages": 0}}
+    check_table(table_name, [c for c, _ in req["sort"]])
+    key_info = schema.key_info(table_name)
+    # 精簡格式時條件裡的字串先換成代碼 (見 compact_schema.py)
+    encoded = schema.encoded_columns(table_name)
+    where, where_params = compile_filters(dictionary.encode_filters(filters, encoded))
+    # 查詢型態：同一個型態在每條連線上只 PREPARE 一次 (見 statement_cache.py)
+    shape = (table_name, schema.version, filters_shape(filters))
+    started = time.perf_counter()
+
+    with get_db_connection(read_only=True) as conn:
+        # 一般 cursor 拿 tuple 就好，編碼時再組成 JSON (見 serialization.py)
+        cur = conn.cursor()
+        try:
+
+            # --- 步驟 1: 算總筆數 (有快取；大表用估計值，見 row_counts.py) ---
+            if where is None:
+                real_count, count_exact = count_rows(cur, table_name)
+            else:
+                real_count, count_exact = count_filtered(cur, table_name, where, where_params, shape)
+
+            # --- 步驟 2: 抓取資料 (依排序欄位 + 主鍵排序，多抓 1 筆判斷有沒有下一頁) ---
+            query, params = page_query(table_name, key_info, req, where, where_params)
+            statements.execute(cur, ("page",) + shape + page_shape(req), query, params)
+            columns = [d.name for d in cur.description]
+            rows, next_cursor, prev_cursor = finish_page(cur.fetchall(), key_info, req, columns)
+            # cursor 記的是代碼 (下一頁照代碼比較)，算完才換回字串
+            rows = dictionary.decode_rows(columns, rows, encoded)
+            # 記下查詢型態給索引建議用 (見 index_advisor.py)
+            workload.record(table_name, "page", req["sort_by"], filter_columns(filters),
+                            (time.perf_counter() - started) * 1000)
+
+            with query_metrics.timer("serialize"):
+                rows = encode_rows(columns, rows, temporal_indexes(columns, schema.column_types(table_name)), format)
+                pagination = build_pagination(req["page"], req["limit"], real_count, next_cursor, prev_cursor, count_exact)
+                result = page_payload(columns, rows, pagination, format)
+                # 從落後的副本讀到的不存 (見 response_cache.py)
+                body, etag = response_cache.store(table_name, cache_key, result, generation, served_lsn())
+            return response_cache.respond(request, body, etag)
+
+        except CursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        except Exception as e:
+            # 完整 traceback 印出來，也會出現在 /api/debug/slow 與 app_request_errors_total
+            query_metrics.record_error(e)
+            return {"data": [], "pagination": {"current_page": 1, "total_count": 0, "total_pages": 0}}
         
-    finally:
-        cur.close()
-        conn.close()
+        finally:
+            cur.close()
 
 # 4. 通用新增功能
 @app.post("/api/data/{table_name}")
 def create_data(table_name: str, payload: CreatePayload):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     data = payload.data
     columns = list(data.keys())
-    values = list(data.values())
+    check_table(table_name, columns)
     
-    try:
-        query = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
-            sql.Identifier(table_name),
-            sql.SQL(', ').join(map(sql.Identifier, columns)),
-            sql.SQL(', ').join(sql.Placeholder() * len(values))
-        )
-        cur.execute(query, values)
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            values = list(dictionary.encode_for_write(cur, data, schema.encoded_columns(table_name)).values())
+            query = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+                sql.Identifier(table_name),
+                sql.SQL(', ').join(map(sql.Identifier, columns)),
+                sql.SQL(', ').join(sql.Placeholder() * len(values))
+            )
+            statements.execute(cur, ("insert", table_name, schema.version, tuple(columns)), query, values)
+            conn.commit()
+            row_counts.invalidate(table_name)
+            response_cache.invalidate(table_name)
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            cur.close()
     return {"message": "新增成功"}
 
 # 5. 通用更新功能
 @app.put("/api/data/{table_name}")
 def update_data(table_name: str, payload: UpdatePayload):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     new_data = payload.data      
     conditions = payload.conditions 
     
     if not conditions:
         raise HTTPException(status_code=400, detail="無法更新：找不到原始資料對應條件")
+    check_table(table_name, list(new_data) + list(conditions))
 
-    try:
-        set_clause = sql.SQL(', ').join(
-            sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
-            for k in new_data.keys()
-        )
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            encoded = schema.encoded_columns(table_name)
+            new_data = dictionary.encode_for_write(cur, new_data, encoded)
+            conditions = dictionary.encode_values(conditions, encoded)
+            set_clause = sql.SQL(', ').join(
+                sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
+                for k in new_data.keys()
+            )
         
-        where_clause = sql.SQL(' AND ').join(
-            sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
-            for k in conditions.keys()
-        )
+            where_clause = sql.SQL(' AND ').join(
+                sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
+                for k in conditions.keys()
+            )
         
-        query = sql.SQL("UPDATE {} SET {} WHERE {}").format(
-            sql.Identifier(table_name),
-            set_clause,
-            where_clause
-        )
+            query = sql.SQL("UPDATE {} SET {} WHERE {}").format(
+                sql.Identifier(table_name),
+                set_clause,
+                where_clause
+            )
         
-        params = list(new_data.values()) + list(conditions.values())
+            params = list(new_data.values()) + list(conditions.values())
         
-        cur.execute(query, params)
-        conn.commit()
+            started = time.perf_counter()
+            shape = ("update", table_name, schema.version, tuple(new_data), tuple(conditions))
+            statements.execute(cur, shape, query, params)
+            workload.record(table_name, "update", None, conditions, (time.perf_counter() - started) * 1000)
+            conn.commit()
+            row_counts.invalidate(table_name)
+            response_cache.invalidate(table_name)
         
-        if cur.rowcount == 0:
-            return {"message": "更新失敗：找不到原始資料或資料未變動", "status": "failed"}
+            if cur.rowcount == 0:
+                return {"message": "更新失敗：找不到原始資料或資料未變動", "status": "failed"}
             
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            cur.close()
     return {"message": "更新成功"}
 
 # 6. 通用刪除功能
 @app.post("/api/data/{table_name}/delete")
 def delete_data(table_name: str, payload: CreatePayload):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     conditions = payload.data
+    check_table(table_name, list(conditions))
     
-    try:
-        where_clause = sql.SQL(' AND ').join(
-            sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
-            for k in conditions.keys()
-        )
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            conditions = dictionary.encode_values(conditions, schema.encoded_columns(table_name))
+            where_clause = sql.SQL(' AND ').join(
+                sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder()])
+                for k in conditions.keys()
+            )
         
-        query = sql.SQL("DELETE FROM {} WHERE {}").format(
-            sql.Identifier(table_name),
-            where_clause
-        )
+            query = sql.SQL("DELETE FROM {} WHERE {}").format(
+                sql.Identifier(table_name),
+                where_clause
+            )
         
-        cur.execute(query, list(conditions.values()))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
+            started = time.perf_counter()
+            shape = ("delete", table_name, schema.version, tuple(conditions))
+            statements.execute(cur, shape, query, list(conditions.values()))
+            workload.record(table_name, "delete", None, conditions, (time.perf_counter() - started) * 1000)
+            conn.commit()
+            row_counts.invalidate(table_name)
+            response_cache.invalidate(table_name)
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            cur.close()
     return {"message": "刪除成功"}
 
+# 7. 連線池狀態 (除錯 / 監控用)
+@app.get("/api/pool/stats")
+def get_pool_stats():
+    return get_pool().stats()
+
+# 唯讀副本：健康狀態、落後多少、各分到幾個讀取 (見 read_replicas.py)
+@app.get("/api/pool/replicas")
+def get_replica_stats():
+    return replicas.snapshot()
+
+# Prepared statement 快取：幾個查詢型態、命中 / PREPARE 次數 (見 statement_cache.py)
+@app.get("/api/pool/statements")
+def get_statement_stats():
+    return statements.stats()
+
+# 8. 資料表結構快取：查看 / 手動重新載入 (例如沒有權限裝 DDL event trigger 時)
+@app.get("/api/schema")
+def get_schema():
+    return schema.snapshot()
+
+@app.post("/api/schema/refresh")
+def refresh_schema():
+    try:
+        schema.refresh()
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
+        raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+    return {"message": "已重新載入", "version": schema.version}
+
+# 9. 整張表匯出 (串流，見 export.py)
+app.include_router(export.router)
+
+# 10. 批次新增 / 更新 / 刪除，整批一個交易 (見 bulk.py)
+app.include_router(bulk.router)
+
+# 11. 統計 (分組計算在 SQL 裡做，重的讀彙總表，見 stats.py / summary_tables.py)
+app.include_router(stats.router)
+
+# 12. 索引建議：API 收到過的查詢型態、現有索引能不能用、建議加哪些 (量測 / 建立請用 python index_advisor.py)
+# 只讀 query_shapes 目前的內容 (各 worker 每 INDEX_WORKLOAD_FLUSH 秒在背景寫入)，GET 不寫資料庫、可以讀副本；
+# 要馬上看到剛收到的查詢型態先 POST /api/indexes/flush
+@app.get("/api/indexes/advice")
+def get_index_advice(min_calls: int = 1):
+    with get_db_connection(read_only=True) as conn:
+        return advise(conn, min_calls=min_calls, run_measure=False)
+
+@app.post("/api/indexes/flush")
+def flush_index_workload():
+    """這個 worker 累積的查詢型態計數馬上寫進 query_shapes"""
+    try:
+        workload.flush()
+    except (psycopg2.Error, PoolTimeout) as e:
+        print("⚠️ 查詢型態紀錄寫入失敗:", e)
+        raise HTTPException(status_code=503, detail="查詢型態紀錄寫入失敗，請稍後再試")
+    return {"message": "查詢型態紀錄已寫入"}
+
+# 13. /api/data 回應快取的命中率等統計 (見 response_cache.py)
+@app.get("/api/cache/stats")
+def get_cache_stats():
+    return response_cache.stats()
+
+# 14. 查詢計時 (見 query_metrics.py)：Prometheus 指標 / 最近的慢查詢 (含 EXPLAIN) 與慢請求
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    pool = get_pool().stats()
+    cache = response_cache.stats()
+    prepared = statements.stats()
+    gauges = [
+        ("app_db_pool_in_use", "借出中的連線數", pool["in_use"]),
+        ("app_db_pool_idle", "閒置的連線數", pool["idle"]),
+        ("app_db_pool_waits_total", "借連線時需要排隊的次數", pool["waits"], "counter"),
+        ("app_db_pool_timeouts_total", "借連線逾時的次數", pool["timeouts"], "counter"),
+        ("app_response_cache_hits_total", "回應快取命中次數", cache["hits"], "counter"),
+        ("app_response_cache_misses_total", "回應快取沒命中次數", cache["misses"], "counter"),
+        ("app_db_replicas_healthy", "目前可以分流讀取的唯讀副本數", sum(r.healthy for r in replicas.replicas)),
+        ("app_statement_cache_hits_total", "直接 EXECUTE 已經 PREPARE 過的查詢次數", prepared["hits"], "counter"),
+        ("app_statement_cache_prepares_total", "PREPARE 的次數", prepared["prepares"], "counter"),
+    ]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/debug/slow")
+def get_slow_queries(limit: int = 50):
+    return slow_log.snapshot(limit)
+
+# 15. 上傳 CSV 匯入：邊收邊 COPY 的背景工作，可以查進度、取消 (見 import_jobs.py)
+app.include_router(import_jobs.router)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/")
@@ -0,0 +1,27 @@
+from pydantic import BaseModel
+from typing import Dict, Any, List, Literal
+
+# 通用的更新模型
+class UpdatePayload(BaseModel):
+    data: Dict[str, Any]      
+    conditions: Dict[str, Any] 
+
+# 通用的新增模型
+class CreatePayload(BaseModel):
+    data: Dict[str, Any]
+
+# 批次寫入 (見 bulk.py)
+# on_conflict：主鍵已存在時 error = 該筆算失敗 / skip = 略過 / update = 改成更新
+# atomic：True 時只要有一筆失敗就整批 rollback；False 時只寫入成功的那些筆
+class BulkCreatePayload(BaseModel):
+    rows: List[Dict[str, Any]]
+    on_conflict: Literal["error", "skip", "update"] = "error"
+    atomic: bool = True
+
+class BulkUpdatePayload(BaseModel):
+    rows: List[UpdatePayload]
+    atomic: bool = True
+
+class BulkDeletePayload(BaseModel):
+    rows: List[Dict[str, Any]]
+    atomic: bool = True
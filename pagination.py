@@ -0,0 +1,270 @@
+"""
+分頁工具：keyset (cursor) 分頁
+
+用 OFFSET 翻頁時，第 N 頁要先掃過前面 N * limit 筆才回得來，student_vle 這種大表越翻越慢，
+所以以前只能硬性限制最多看 1000 筆。
+keyset 分頁改成記住「上一頁最後一筆的排序鍵」，下一頁直接用
+    WHERE (sort_by, 主鍵...) > (上一頁最後一筆的值...)
+從索引上接著往下讀，第 10000 頁跟第 1 頁一樣快。
+
+排序鍵 = 使用者選的 sort_by 欄位 + 資料表主鍵 (保證唯一、順序穩定)，
+例如 student_vle 依 sum_click 排序時是 (sum_click, id_student, id_site, code_module, code_presentation, date)。
+sort_by 可以有多個欄位、各自的方向 (score:desc,date_submitted)，方向不一樣時拆成幾段 UNION ALL，
+每段都是「前面的欄位相等 + 下一個欄位比大小」，一樣可以走索引。
+篩選條件 (filters.py) 加在每一段的 WHERE 裡；cursor 會記下排序與篩選條件，換了條件就不能再用。
+"""
+import base64
+import json
+import math
+
+from psycopg2 import sql
+
+# 每頁最多筆數
+MAX_PAGE_SIZE = 1000
+
+# /api/data 的分頁參數，其他 query string 都是篩選條件 (見 filters.py)
+PAGE_PARAMS = {"sort_by", "order", "page", "limit", "cursor", "format"}
+
+
+class CursorError(ValueError):
+    """cursor 無法解析，或跟這次查詢的排序條件對不上"""
+
+
+def encode_cursor(sort_spec, filters_sig, direction, key):
+    payload = {"s": sort_spec, "f": filters_sig, "d": direction, "k": key}
+    raw = json.dumps(payload, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if payload["d"] not in ("next", "prev"):
+            raise ValueError
+        return payload["s"], payload.get("f", ""), payload["d"], list(payload["k"])
+    except (ValueError, KeyError, TypeError):
+        raise CursorError("cursor 格式錯誤")
+
+
+def parse_sort(sort_by, order="ASC"):
+    """
+    sort_by 可以是多個欄位：「score:desc,date_submitted」，沒寫方向的用 order。
+    回傳 [(欄位, 是否 DESC), ...]；沒有 sort_by 時是空的 (依主鍵遞增排序)
+    """
+    sort = []
+    default_desc = order.upper() == "DESC"
+    for part in (sort_by or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        column, _, direction = part.partition(":")
+        direction = direction.strip().upper()
+        if direction not in ("", "ASC", "DESC"):
+            raise CursorError(f"排序方向只能是 asc 或 desc：{part}")
+        if any(column == c for c, _ in sort):
+            raise CursorError(f"排序欄位重複：{column}")
+        sort.append((column, direction == "DESC" if direction else default_desc))
+    return sort
+
+
+def sort_spec(sort):
+    """排序條件的固定寫法，例如 'score:desc,date_submitted:asc' (放進 cursor 比對用)"""
+    return ",".join(f"{c}:{'desc' if d else 'asc'}" for c, d in sort)
+
+
+def key_columns(key_info, sort):
+    """
+    排序鍵：[(欄位, 是否 DESC), ...] = 排序欄位 + 主鍵 (已經在排序欄位裡的不重複)，
+    主鍵的方向跟著最後一個排序欄位。
+    key_info 來自 schema_cache.schema.key_info()：{"columns", "primary_key", "nullable"}
+    """
+    pk = key_info["primary_key"]
+    if not pk:
+        raise ValueError("這張表沒有主鍵，無法使用 cursor 分頁")
+    sorted_columns = {c for c, _ in sort}
+    pk_desc = sort[-1][1] if sort else False
+    return list(sort) + [(c, pk_desc) for c in pk if c not in sorted_columns]
+
+
+def _order_by(cols):
+    return sql.SQL(", ").join(
+        sql.Composed([sql.Identifier(c), sql.SQL(" DESC" if desc else " ASC")]) for c, desc in cols
+    )
+
+
+def _row(cols):
+    return sql.SQL("({})").format(sql.SQL(", ").join(sql.Identifier(c) for c, _ in cols))
+
+
+def _placeholders(n):
+    return sql.SQL("({})").format(sql.SQL(", ").join(sql.Placeholder() * n))
+
+
+def _seek_branches(cols, key, nullable):
+    """
+    產生「排在 key 後面」的條件。回傳 [(where, params), ...]，多個 branch 時要 UNION ALL 起來，
+    每個 branch 都是「前面幾個欄位相等 + 下一個欄位比大小」，才用得到索引。
+
+    從第一個欄位開始：
+    - 後面的欄位都不會是 NULL、方向也都一樣時，一個 row comparison (a, b, ...) > (x, y, ...) 就好
+    - 否則拆成「這個欄位排在 x 後面」與「這個欄位 = x 且後面的欄位排在後面」兩種
+    PostgreSQL 預設 ASC 時 NULL 排最後、DESC 時 NULL 排最前面，而 (a, b) > (x, y) 遇到 NULL 會得到 NULL，
+    所以可為 NULL 的欄位另外處理：NULL 那一群只比後面的欄位。
+    """
+    if not cols:
+        return []
+    (column, desc), value = cols[0], key[0]
+    ident = sql.Identifier(column)
+    op = sql.SQL(" < " if desc else " > ")
+
+    def prefixed(condition, params):
+        return [(sql.Composed([condition, sql.SQL(" AND "), where]), params + branch_params)
+                for where, branch_params in _seek_branches(cols[1:], key[1:], nullable)]
+
+    if value is None:
+        branches = []
+        if desc:
+            # DESC：NULL → 非 NULL
+            branches.append((sql.SQL("{} IS NOT NULL").format(ident), []))
+        return branches + prefixed(sql.SQL("{} IS NULL").format(ident), [])
+
+    tail_uniform = all(c not in nullable and d == desc for c, d in cols[1:])
+    if tail_uniform:
+        branches = [(sql.Composed([_row(cols), op, _placeholders(len(cols))]), list(key))]
+    else:
+        branches = [(sql.Composed([ident, op, sql.Placeholder()]), [value])]
+        branches += prefixed(sql.Composed([ident, sql.SQL(" = "), sql.Placeholder()]), [value])
+    if column in nullable and not desc:
+        # ASC：非 NULL → NULL
+        branches.append((sql.SQL("{} IS NULL").format(ident), []))
+    return branches
+
+
+def build_page_query(table_name, key_info, sort, limit, key=None, offset=0, where=None, where_params=()):
+    """
+    組出一頁的查詢 (多抓 1 筆用來判斷後面還有沒有資料)。
+    sort：[(欄位, 是否 DESC), ...]；where / where_params：篩選條件 (filters.compile_filters 的結果)。
+    key 有值時用 keyset 從 key 後面接著讀；沒有 key 時用 offset (舊的 page 參數)。
+    回傳 (query, params)
+    """
+    cols = key_columns(key_info, sort)
+    table = sql.Identifier(table_name)
+    order_by = _order_by(cols)
+
+    def conditions(*parts):
+        parts = [p for p in parts if p is not None]
+        if not parts:
+            return sql.SQL("")
+        return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(
+            sql.SQL("({})").format(p) if len(parts) > 1 else p for p in parts
+        )
+
+    if key is None:
+        query = sql.SQL("SELECT * FROM {}{} ORDER BY {} LIMIT {} OFFSET {}").format(
+            table, conditions(where), order_by, sql.Placeholder(), sql.Placeholder()
+        )
+        return query, list(where_params) + [limit + 1, offset]
+
+    if len(key) != len(cols):
+        raise CursorError("cursor 跟資料表的排序鍵對不上")
+
+    branches = _seek_branches(cols, key, key_info["nullable"])
+    parts, params = [], []
+    for seek, branch_params in branches:
+        parts.append(sql.SQL("(SELECT * FROM {}{} ORDER BY {} LIMIT {})").format(
+            table, conditions(where, seek), order_by, sql.Placeholder()
+        ))
+        params += list(where_params) + branch_params + [limit + 1]
+
+    if not parts:
+        # 已經是最後一筆 (例如最後一個排序欄位是 NULL)
+        query = sql.SQL("SELECT * FROM {} WHERE false").format(table)
+        return query, []
+    if len(parts) == 1:
+        return parts[0], params
+    query = sql.SQL("SELECT * FROM ({}) AS page ORDER BY {} LIMIT {}").format(
+        sql.SQL(" UNION ALL ").join(parts), order_by, sql.Placeholder()
+    )
+    return query, params + [limit + 1]
+
+
+def resolve_page_request(sort_by, order, page, limit, cursor=None, filters_sig=""):
+    """
+    整理分頁參數 (不需要連資料庫)。
+    有 cursor 時用 keyset，page 只當作顯示用的頁碼；沒有 cursor 時用 page 換算 OFFSET。
+    filters_sig：篩選條件的指紋 (filters.filters_signature)，cursor 只能用在同樣的條件上
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    page = max(1, page)
+    # 沒選排序欄位時依主鍵遞增排序 (跟以前不帶 ORDER BY 時一樣忽略 order)
+    sort = parse_sort(sort_by, order)
+    req = {"sort": sort, "sort_by": sort[0][0] if sort else None, "filters_sig": filters_sig,
+           "page": page, "limit": limit, "direction": "next", "key": None, "offset": (page - 1) * limit}
+    if cursor:
+        cursor_sort, cursor_filters, direction, key = decode_cursor(cursor)
+        if cursor_sort != sort_spec(sort) or cursor_filters != filters_sig:
+            raise CursorError("cursor 跟目前的排序 / 篩選條件不一致，請從第一頁重新查詢")
+        req.update(direction=direction, key=key, offset=0)
+    return req
+
+
+def page_query(table_name, key_info, req, where=None, where_params=()):
+    """依 resolve_page_request 的結果組出查詢；往前翻時把每個排序欄位的方向都反過來讀"""
+    for column, _ in req["sort"]:
+        if column not in key_info["columns"]:
+            raise ValueError('column "%s" does not exist' % column)
+    sort = req["sort"]
+    if req["direction"] == "prev":
+        sort = [(c, not d) for c, d in sort] or [(c, True) for c in key_info["primary_key"][:1]]
+    return build_page_query(table_name, key_info, sort, req["limit"],
+                            key=req["key"], offset=req["offset"], where=where, where_params=where_params)
+
+
+def page_shape(req):
+    """
+    page_query 組出來的 SQL 只跟排序、方向、cursor 裡哪些值是 NULL 有關 (limit / offset / cursor 的值都是參數)，
+    這個 tuple 就是查詢的型態 (見 statement_cache.py)
+    """
+    key = req["key"]
+    return tuple(req["sort"]), req["direction"], None if key is None else tuple(v is None for v in key)
+
+
+def finish_page(rows, key_info, req, columns=None):
+    """
+    處理多抓的那 1 筆、往前翻時把順序倒回來，並產生 next / prev cursor。
+    rows 是 dict 的 list；有給 columns (查詢結果的欄位順序) 時 rows 是 tuple 的 list。
+    回傳 (rows, next_cursor, prev_cursor)
+    """
+    limit = req["limit"]
+    cols = [c for c, _ in key_columns(key_info, req["sort"])]
+    if columns is not None:
+        cols = [columns.index(c) for c in cols]
+    spec, filters_sig = sort_spec(req["sort"]), req["filters_sig"]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if req["direction"] == "prev":
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, req["key"] is not None or req["offset"] > 0
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(spec, filters_sig, "next", [rows[-1][c] for c in cols])
+    if rows and has_prev:
+        prev_cursor = encode_cursor(spec, filters_sig, "prev", [rows[0][c] for c in cols])
+    return rows, next_cursor, prev_cursor
+
+
+def build_pagination(page, limit, total_count, next_cursor=None, prev_cursor=None, count_exact=True):
+    """組出回傳給前端的 pagination 區塊 (count_exact=False 表示 total_count 是估計值)"""
+    return {
+        "current_page": page,
+        "per_page": limit,
+        "total_count": total_count,
+        "count_exact": count_exact,
+        "total_pages": math.ceil(total_count / limit) if limit else 0,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
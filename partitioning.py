@@ -0,0 +1,330 @@
+"""
+student_vle / student_assessment 依 code_presentation 分區 (declarative partitioning)
+
+student_vle 所有學期的點擊都在同一個 heap 裡：只查 / 刪某個學期 (例如 "2014J") 也要碰整張表和整個索引，
+拿掉舊學期就是一個超大的 DELETE (每筆都寫 WAL、跑 trigger，之後還要 VACUUM)。
+import.py --partition 時改成：
+- student_vle、student_assessment 建成 PARTITION BY LIST (code_presentation)，每個學期一個分區
+  (學期清單從要匯入的 courses.csv 讀)，另外有一個 DEFAULT 分區接住還沒有分區的學期
+- --partition-date-step N：student_vle 每個學期的分區再依 date 每 N 天切一段 (RANGE)
+- 主鍵一定要包含分區欄位：student_vle 原本就有；student_assessment 改成 (id_student, id_assessment, code_presentation)
+  (code_presentation 由 id_assessment 決定，唯一性跟原本一樣)。
+  所以分區後 student_assessment 新增資料時 code_module / code_presentation 一定要填 (以前可以空著)
+- student_vle 匯入時每個學期各自 GROUP BY，直接寫進那個學期的分區 (csv_import.py)，不同學期可以同時寫
+
+查詢：條件有 code_presentation (= 或 in) 時 planner 只掃那幾個分區 (partition pruning)，
+例如 /api/data/student_vle?code_presentation=2014J 的筆數與翻頁都只碰一個分區；有日期分段時 date 的範圍條件也一樣。
+
+維護 (python partitioning.py)：
+    --status                 每個分區的筆數與大小
+    --retire 2013B           那個學期的分區 DETACH 出來，搬到 archive schema (資料還在，API 看不到)
+    --retire 2013B --drop    直接 DROP，瞬間完成，不用 DELETE 幾百萬筆
+    --split-default          DEFAULT 分區裡的學期 (例如 API 新增的新學期) 搬到各自新建的分區
+DETACH / DROP 不會觸發 DELETE trigger，所以 retire 時順便刪掉 student_vle 彙總表 (rollups.py) 裡那個學期的格子，
+並重算統計用的 materialized view (summary_tables.py)。
+
+註：import.py --fast 不支援分區 (它拿 pg_catalog 跟 init.sql 逐項比對，只處理一般表)。
+autovacuum 不會 ANALYZE 分區表的父表，匯入 / 搬移後要自己 ANALYZE (analyze_partitioned)。
+"""
+import argparse
+import csv
+import os
+import re
+
+from psycopg2 import sql
+from tabulate import tabulate
+
+PARTITION_KEY = "code_presentation"
+PARTITIONED_TABLES = ("student_vle", "student_assessment")
+# 分區表的主鍵要包含分區欄位
+PRIMARY_KEYS = {"student_assessment": ["id_student", "id_assessment", "code_presentation"]}
+# 可以再依日期切段的表 → 日期欄位
+DATE_COLUMNS = {"student_vle": "date"}
+# OULAD 的 date 大約是 -25 ~ 269：MINVALUE ~ 0 一段，之後每 step 天一段，超過 DATE_MAX 的都在最後一段
+DATE_MAX = 280
+PARTITION_DATE_STEP = int(os.getenv("PARTITION_DATE_STEP", "0"))
+ARCHIVE_SCHEMA = "archive"
+
+CHILDREN_QUERY = """
+    SELECT c.relname, c.relkind, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    ORDER BY c.relname
+"""
+
+STATUS_QUERY = """
+    SELECT p.relid::regclass::text, p.level, pg_get_expr(c.relpartbound, c.oid),
+           CASE WHEN c.reltuples < 0 THEN NULL ELSE c.reltuples::bigint END,
+           pg_size_pretty(pg_total_relation_size(c.oid))
+    FROM pg_partition_tree(to_regclass(%s)) p
+    JOIN pg_class c ON c.oid = p.relid
+    WHERE p.isleaf
+    ORDER BY p.relid::regclass::text
+"""
+
+
+def partitioned_init_sql(init_sql):
+    """init.sql 裡 PARTITIONED_TABLES 的 CREATE TABLE 加上 PARTITION BY LIST (主鍵補上分區欄位)，其他表不動"""
+    def rewrite(match):
+        table, body = match.group(1), match.group(2)
+        if table not in PARTITIONED_TABLES:
+            return match.group(0)
+        if table in PRIMARY_KEYS:
+            body = re.sub(r"PRIMARY KEY\s*\([^)]*\)", f"PRIMARY KEY ({', '.join(PRIMARY_KEYS[table])})", body,
+                          count=1, flags=re.I)
+        return f"CREATE TABLE {table} ({body}\n) PARTITION BY LIST ({PARTITION_KEY});"
+    return re.sub(r"CREATE TABLE\s+(\w+)\s*\((.*?)\n\)\s*;", rewrite, init_sql, flags=re.S | re.I)
+
+
+def presentations_from_csv(data_dir="data"):
+    """要匯入的 courses.csv 裡有哪些學期"""
+    path = os.path.join(data_dir, "courses.csv")
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8") as f:
+        return sorted({row[PARTITION_KEY] for row in csv.DictReader(f) if row.get(PARTITION_KEY)})
+
+
+def partition_name(table_name, value):
+    return f"{table_name}_{re.sub(r'[^a-z0-9]+', '_', value.lower()).strip('_')}"[:63]
+
+
+def is_partitioned(cur, table_name):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table_name,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def children(cur, table_name):
+    """直接的子分區 [(名稱, relkind, 範圍)]"""
+    cur.execute(CHILDREN_QUERY, (table_name,))
+    return cur.fetchall()
+
+
+def _list_values(bound):
+    """"FOR VALUES IN ('2014J')" → ["2014J"]"""
+    return [v.replace("''", "'") for v in re.findall(r"'((?:[^']|'')*)'", bound)]
+
+
+def list_partitions(cur, table_name):
+    """回傳 ({學期: 分區名稱}, DEFAULT 分區名稱或 None)"""
+    values, default = {}, None
+    for name, _, bound in children(cur, table_name):
+        if bound == "DEFAULT":
+            default = name
+        else:
+            for value in _list_values(bound):
+                values[value] = name
+    return values, default
+
+
+def date_step(cur, table_name):
+    """現有的學期分區如果有依日期切段，回傳每段幾天 (新學期的分區照同樣的方式切)，沒有就是 0"""
+    for name, relkind, _ in children(cur, table_name):
+        if relkind != "p":
+            continue
+        lows = sorted(int(m) for _, _, bound in children(cur, name)
+                      for m in re.findall(r"FROM \((-?\d+)\)", bound))
+        if len(lows) >= 2:
+            return lows[1] - lows[0]
+    return 0
+
+
+def date_ranges(step):
+    """[(下限, 上限)]，None = MINVALUE / MAXVALUE"""
+    lows = list(range(0, DATE_MAX, step))
+    return list(zip([None] + lows, lows + [None]))
+
+
+def _bound(value, infinite):
+    return sql.SQL(infinite) if value is None else sql.Literal(value)
+
+
+def create_partition(cur, table_name, value, step=0):
+    """建立一個學期的分區 (step > 0 時再依日期切段)，回傳建立的表名稱"""
+    name = partition_name(table_name, value)
+    column = DATE_COLUMNS.get(table_name) if step else None
+    cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({}){}").format(
+        sql.Identifier(name), sql.Identifier(table_name), sql.Literal(value),
+        sql.SQL(" PARTITION BY RANGE ({})").format(sql.Identifier(column)) if column else sql.SQL("")
+    ))
+    created = [name]
+    if column:
+        for low, high in date_ranges(step):
+            child = f"{name}_pre" if low is None else f"{name}_d{low}"
+            cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(
+                sql.Identifier(child), sql.Identifier(name), _bound(low, "MINVALUE"), _bound(high, "MAXVALUE")
+            ))
+            created.append(child)
+    return created
+
+
+def create_partitions(cur, presentations, step=None):
+    """
+    每張分區表、每個學期建一個分區 (已經有的跳過)，沒有 DEFAULT 分區就補一個。
+    step=None 時沿用現有分區的日期切法。不 commit；回傳建立的表名稱
+    """
+    created = []
+    for table_name in PARTITIONED_TABLES:
+        if not is_partitioned(cur, table_name):
+            continue
+        values, default = list_partitions(cur, table_name)
+        table_step = date_step(cur, table_name) if step is None else step
+        for value in presentations:
+            if value not in values:
+                created += create_partition(cur, table_name, value, table_step)
+        if default is None:
+            name = f"{table_name}_default"
+            cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT").format(
+                sql.Identifier(name), sql.Identifier(table_name)))
+            created.append(name)
+    return created
+
+
+def load_targets(cur):
+    """匯入時直接寫進各分區用：{表: [(分區名稱, 學期), ...]}，沒分區的表不在裡面"""
+    targets = {}
+    for table_name in PARTITIONED_TABLES:
+        if is_partitioned(cur, table_name):
+            values, _ = list_partitions(cur, table_name)
+            targets[table_name] = sorted((name, value) for value, name in values.items())
+    return targets
+
+
+def analyze_partitioned(cur):
+    """父表 + 各分區一起 ANALYZE (autovacuum 不會 ANALYZE 分區表的父表，planner 估計 / row_counts 都要用)"""
+    for table_name in PARTITIONED_TABLES:
+        if is_partitioned(cur, table_name):
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+
+
+def split_default(conn, step=None):
+    """
+    DEFAULT 分區裡的學期搬到各自新建的分區，回傳 {表: [學期, ...]}。
+    經由父表 DELETE ... RETURNING → 建分區 → 再 INSERT 回父表，student_vle 彙總表的 trigger 會一減一加，結果不變；
+    每張表一個交易，搬的時候有人同時寫進同一個學期的話建分區會失敗、整個 rollback
+    """
+    moved = {}
+    for table_name in PARTITIONED_TABLES:
+        with conn.cursor() as cur:
+            if not is_partitioned(cur, table_name):
+                continue
+            _, default = list_partitions(cur, table_name)
+            if default is None:
+                continue
+            cur.execute(sql.SQL("SELECT DISTINCT {} FROM {} WHERE {} IS NOT NULL ORDER BY 1").format(
+                sql.Identifier(PARTITION_KEY), sql.Identifier(default), sql.Identifier(PARTITION_KEY)))
+            values = [row[0] for row in cur.fetchall()]
+            table_step = date_step(cur, table_name) if step is None else step
+            for value in values:
+                cur.execute(sql.SQL("""
+                    CREATE TEMP TABLE partition_moving ON COMMIT DROP AS
+                    WITH moved AS (DELETE FROM {} WHERE {} = %s RETURNING *) SELECT * FROM moved
+                """).format(sql.Identifier(table_name), sql.Identifier(PARTITION_KEY)), (value,))
+                create_partition(cur, table_name, value, table_step)
+                cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM partition_moving").format(
+                    sql.Identifier(table_name)))
+                cur.execute("DROP TABLE partition_moving")
+            if values:
+                cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+        conn.commit()
+        if values:
+            moved[table_name] = values
+    return moved
+
+
+def retire_presentation(conn, value, drop=False):
+    """
+    把一個學期從分區表拿掉：DETACH 後搬到 archive schema (drop=True 時直接 DROP)。
+    回傳 {表: 動作}；那個學期的資料在 DEFAULT 分區 (沒有自己的分區) 時先 split_default 再 retire
+    """
+    from rollups import ROLLUPS
+
+    done = {}
+    with conn.cursor() as cur:
+        for table_name in PARTITIONED_TABLES:
+            if not is_partitioned(cur, table_name):
+                continue
+            values, _ = list_partitions(cur, table_name)
+            name = values.get(value)
+            if name is None:
+                continue
+            cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                sql.Identifier(table_name), sql.Identifier(name)))
+            if drop:
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                done[table_name] = f"dropped {name}"
+            else:
+                cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(ARCHIVE_SCHEMA)))
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{ARCHIVE_SCHEMA}.{name}",))
+                if cur.fetchone()[0]:
+                    raise ValueError(f"{ARCHIVE_SCHEMA}.{name} 已經存在，請先處理舊的封存資料或改用 --drop")
+                cur.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(
+                    sql.Identifier(name), sql.Identifier(ARCHIVE_SCHEMA)))
+                done[table_name] = f"archived as {ARCHIVE_SCHEMA}.{name}"
+        # DETACH 不會觸發 DELETE trigger，彙總表裡那個學期的格子要自己刪
+        if "student_vle" in done:
+            for rollup in ROLLUPS:
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (rollup,))
+                if cur.fetchone()[0]:
+                    cur.execute(sql.SQL("DELETE FROM {} WHERE {} = %s").format(
+                        sql.Identifier(rollup), sql.Identifier(PARTITION_KEY)), (value,))
+    conn.commit()
+    return done
+
+
+def partition_status(cur):
+    """[(表, 分區, 層, 範圍, 估計筆數, 大小)]"""
+    rows = []
+    for table_name in PARTITIONED_TABLES:
+        if is_partitioned(cur, table_name):
+            cur.execute(STATUS_QUERY, (table_name,))
+            rows += [(table_name, *row) for row in cur.fetchall()]
+    return rows
+
+
+def main():
+    from db_pool import get_pool
+    from summary_tables import refresh_summaries
+
+    parser = argparse.ArgumentParser(description="student_vle / student_assessment 的分區維護")
+    parser.add_argument("--status", action="store_true", help="列出每個分區的筆數與大小")
+    parser.add_argument("--retire", metavar="CODE_PRESENTATION", help="拿掉一個學期 (DETACH 後搬到 archive schema)")
+    parser.add_argument("--drop", action="store_true", help="跟 --retire 一起用：直接 DROP，不保留")
+    parser.add_argument("--split-default", action="store_true", help="DEFAULT 分區裡的學期搬到各自的分區")
+    args = parser.parse_args()
+
+    with get_pool().connection() as conn:
+        if args.split_default:
+            moved = split_default(conn)
+            for table_name, values in moved.items():
+                print(f"📦 {table_name}：{', '.join(values)} 已搬到自己的分區")
+            if not moved:
+                print("✅ DEFAULT 分區裡沒有要搬的學期")
+        if args.retire:
+            done = retire_presentation(conn, args.retire, drop=args.drop)
+            if not done:
+                print(f"⚠️ 找不到 {args.retire} 的分區 (還在 DEFAULT 分區的話先 --split-default)")
+            for table_name, action in done.items():
+                print(f"🗄️ {table_name}：{action}")
+            if done:
+                try:
+                    refresh_summaries(conn)
+                    print("📊 統計彙總表已重算")
+                except Exception as e:
+                    conn.rollback()
+                    print(f"⚠️ 統計彙總表重算失敗 (可以之後再呼叫 POST /api/stats/refresh): {e}")
+        if args.status or not (args.retire or args.split_default):
+            with conn.cursor() as cur:
+                rows = partition_status(cur)
+            conn.rollback()
+            if not rows:
+                print("ℹ️ 沒有分區表 (用 python import.py --partition 匯入)")
+            else:
+                print(tabulate(rows, headers=["table", "partition", "level", "bound", "rows (est.)", "size"],
+                               tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    main()
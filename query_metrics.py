@@ -0,0 +1,448 @@
+"""
+查詢層級的計時：每個請求花在哪裡 (借連線、每個 SQL、筆數、JSON 編碼)、Prometheus 指標、慢查詢紀錄
+
+以前 UI 哪一頁慢完全看不出來：get_data 出錯只 print(e)，也沒記 count / 查資料 / 編碼各花多久。
+- TimingMiddleware (main.py 掛上)：每個請求一個 RequestTimings (放在 contextvar，threadpool 裡的同步 endpoint 也拿得到)，
+  結束時把總時間 / 狀態碼記成指標，並在回應加上 Server-Timing 標頭 (瀏覽器 DevTools、bench/bench_api.py 都看得到)：
+      Server-Timing: acquire;dur=0.2, db;dur=12.4;desc="2 queries", serialize;dur=1.3, app;dur=15.1
+- TimedCursor：連線池的預設 cursor (db_pool.py)，每次 execute 記下花的時間與筆數；
+  async 模式用 asyncpg 的 query logger (async_api.py) 記同樣的東西
+- GET /metrics：Prometheus 文字格式 (請求數 / 延遲分布、每個 SQL 的時間分布、筆數、借連線時間、編碼時間…)
+- 慢查詢：單一 SQL 超過 SLOW_QUERY_MS 毫秒時記下來，並在背景執行緒用另一條連線跑
+  EXPLAIN (ANALYZE, BUFFERS) 附上執行計畫 (新增 / 修改 / 刪除只跑 EXPLAIN，不會真的再寫一次)；
+  同一個型態的查詢 SLOW_QUERY_EXPLAIN_INTERVAL 秒內只 EXPLAIN 一次，避免慢的時候又多壓資料庫。
+  整個請求超過 SLOW_REQUEST_MS 毫秒時記下各段時間。GET /api/debug/slow 看最近的紀錄
+  (設定 SLOW_QUERY_LOG_FILE 時另外寫一行 JSON 到檔案)
+
+註：指標在各個 uvicorn worker 的記憶體裡 (跟 row_counts.py 一樣)；串流下載 (export) 在回應開始後跑的 SQL 不算進那個請求。
+"""
+import contextvars
+import datetime
+import json
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+QUERY_METRICS = os.getenv("QUERY_METRICS", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "30000"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "100"))
+SLOW_QUERY_LOG_FILE = os.getenv("SLOW_QUERY_LOG_FILE")
+
+# 秒；涵蓋 1 ms 的主鍵查詢到好幾秒的整表掃描
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 慢查詢紀錄裡的 SQL 最多留幾個字
+STATEMENT_MAX_CHARS = 4000
+
+# 只有這些開頭的才跑 EXPLAIN ANALYZE (真的會再執行一次)；其他只跑 EXPLAIN
+READ_ONLY_STATEMENT = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+EXPLAINABLE_STATEMENT = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+# 把值拿掉當成「查詢型態」(同型態的慢查詢只 EXPLAIN 一次)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\$\d+|\b\d+(?:\.\d+)?\b")
+# 資料修改的 CTE (WITH x AS (DELETE ...)) 不能跑 ANALYZE
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+
+
+class Histogram:
+    """Prometheus histogram：每組 label 一份累積次數"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.series = {}   # labels -> [各 bucket 次數..., 總和, 次數]
+
+    def observe(self, labels, value):
+        entry = self.series.get(labels)
+        if entry is None:
+            entry = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+
+class Metrics:
+    """counter / histogram 都放在這裡，render() 輸出 Prometheus 文字格式"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}     # name -> (說明, label 名稱, {labels: 值})
+        self._histograms = {}   # name -> (說明, label 名稱, Histogram)
+
+    def counter(self, name, help_text, label_names=()):
+        self._counters[name] = (help_text, label_names, {})
+
+    def histogram(self, name, help_text, label_names=()):
+        self._histograms[name] = (help_text, label_names, Histogram())
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            values = self._counters[name][2]
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._histograms[name][2].observe(labels, value)
+
+    def render(self, gauges=()):
+        """gauges：[(名稱, 說明, 值[, 型態])]，抓取時才從別的模組讀的數字 (連線池、回應快取…)，型態預設 gauge"""
+        lines = []
+        with self._lock:
+            for name, (help_text, label_names, values) in self._counters.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for labels, value in values.items():
+                    lines.append(f"{name}{_labels(label_names, labels)} {value}")
+            for name, (help_text, label_names, hist) in self._histograms.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for labels, entry in hist.series.items():
+                    for bound, count in zip(hist.buckets, entry):
+                        lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + (bound,))} {count}")
+                    lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + ('+Inf',))} {entry[-1]}")
+                    lines.append(f"{name}_sum{_labels(label_names, labels)} {entry[-2]:.6f}")
+                    lines.append(f"{name}_count{_labels(label_names, labels)} {entry[-1]}")
+        for name, help_text, value, *kind in gauges:
+            if value is not None:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind[0] if kind else 'gauge'}",
+                          f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+metrics = Metrics()
+metrics.counter("app_http_requests_total", "HTTP 請求數", ("method", "route", "status"))
+metrics.histogram("app_http_request_duration_seconds", "HTTP 請求處理時間", ("method", "route"))
+metrics.histogram("app_db_acquire_seconds", "從連線池借到連線花的時間", ("route",))
+metrics.histogram("app_db_statement_duration_seconds", "單一 SQL 執行時間", ("route",))
+metrics.counter("app_db_rows_total", "SQL 回傳 / 影響的筆數", ("route",))
+metrics.histogram("app_serialize_duration_seconds", "JSON 編碼時間", ("route",))
+metrics.counter("app_slow_statements_total", f"超過 SLOW_QUERY_MS ({SLOW_QUERY_MS:g} ms) 的 SQL 數", ("source",))
+metrics.counter("app_request_errors_total", "處理中發生例外的請求數", ("route",))
+
+# 不在請求裡的 SQL (背景重算、查詢型態紀錄…) 用這個 route 名稱
+BACKGROUND_ROUTE = "background"
+
+
+class RequestTimings:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.acquire = []       # 每次借連線的秒數
+        self.statements = []    # 每個 SQL 的秒數
+        self.rows = 0
+        self.serialize = 0.0
+        self.errors = []
+
+    def server_timing(self, total):
+        db = sum(self.statements)
+        parts = [
+            f"acquire;dur={sum(self.acquire) * 1000:.2f}",
+            f'db;dur={db * 1000:.2f};desc="{len(self.statements)} queries"',
+            f"serialize;dur={self.serialize * 1000:.2f}",
+            f"app;dur={total * 1000:.2f}",
+        ]
+        return ", ".join(parts)
+
+    def summary(self, route, status, total):
+        return {
+            "at": _now(),
+            "method": self.method,
+            "path": self.path,
+            "route": route,
+            "status": status,
+            "duration_ms": round(total * 1000, 2),
+            "acquire_ms": round(sum(self.acquire) * 1000, 2),
+            "db_ms": round(sum(self.statements) * 1000, 2),
+            "statements": len(self.statements),
+            "rows": self.rows,
+            "serialize_ms": round(self.serialize * 1000, 2),
+            "errors": self.errors,
+        }
+
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="milliseconds")
+
+
+def current():
+    return _current.get()
+
+
+def record_acquire(seconds):
+    """db_pool.getconn / async_api.acquire 借到連線時呼叫"""
+    if not QUERY_METRICS:
+        return
+    timings = _current.get()
+    if timings is not None:
+        timings.acquire.append(seconds)
+    else:
+        metrics.observe("app_db_acquire_seconds", (BACKGROUND_ROUTE,), seconds)
+
+
+def record_statement(statement, seconds, rows=None, args=None):
+    if not QUERY_METRICS:
+        return
+    timings = _current.get()
+    if timings is not None:
+        timings.statements.append(seconds)
+        if rows is not None and rows > 0:
+            timings.rows += rows
+    else:
+        metrics.observe("app_db_statement_duration_seconds", (BACKGROUND_ROUTE,), seconds)
+        if rows is not None and rows > 0:
+            metrics.inc("app_db_rows_total", (BACKGROUND_ROUTE,), rows)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        slow_log.statement(statement() if callable(statement) else statement, args, seconds, rows, timings)
+
+
+@contextmanager
+def timer(phase="serialize"):
+    """with timer(): ... 把這段時間算進目前請求的 JSON 編碼時間"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _current.get()
+        if timings is not None:
+            setattr(timings, phase, getattr(timings, phase) + time.perf_counter() - started)
+
+
+def record_error(error):
+    """處理請求時吞掉的例外：印出完整 traceback，並記在這個請求上 (/api/debug/slow 看得到)"""
+    traceback.print_exception(error)
+    timings = _current.get()
+    if timings is not None:
+        timings.errors.append(f"{type(error).__name__}: {error}")
+
+
+class TimedCursorMixin:
+    def execute(self, query, vars=None, statement=None):
+        """statement：慢查詢紀錄要記的 SQL (可以是函式，慢的時候才呼叫)，預設是實際送出的 SQL"""
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            if statement is None:
+                statement = self.query if self.query is not None else query
+            if isinstance(statement, bytes):
+                statement = statement.decode(errors="replace")
+            # 具名 cursor (server-side) 的 rowcount 是 -1
+            record_statement(statement, elapsed, self.rowcount if self.rowcount >= 0 else None)
+
+
+class TimedCursor(TimedCursorMixin, extensions.cursor):
+    """連線池連線的預設 cursor (db_pool.py)"""
+
+
+class TimedRealDictCursor(TimedCursorMixin, RealDictCursor):
+    """需要 dict 結果時用這個取代 RealDictCursor，一樣會計時"""
+
+
+def log_asyncpg_query(record):
+    """asyncpg 的 query logger (async_api.py 在每條連線上 add_query_logger)"""
+    record_statement(record.query, record.elapsed, args=record.args)
+
+
+class SlowLog:
+    """最近的慢查詢 / 慢請求 + 背景 EXPLAIN"""
+
+    def __init__(self, size=SLOW_QUERY_LOG_SIZE, explain=SLOW_QUERY_EXPLAIN):
+        self.explain_enabled = explain
+        self._lock = threading.Lock()
+        self.statements = deque(maxlen=size)
+        self.requests = deque(maxlen=size)
+        self._explained = {}   # 查詢型態 -> 上次 EXPLAIN 的時間
+        self._queue = queue.Queue(maxsize=size)
+        self._worker = None
+
+    def statement(self, statement, args, seconds, rows, timings):
+        entry = {
+            "at": _now(),
+            "method": timings.method if timings else None,
+            "path": timings.path if timings else None,
+            "duration_ms": round(seconds * 1000, 2),
+            "rows": rows,
+            "statement": statement[:STATEMENT_MAX_CHARS],
+            "args": [str(a) for a in args] if args else None,
+            "plan": None,
+        }
+        with self._lock:
+            self.statements.append(entry)
+        metrics.inc("app_slow_statements_total", (BACKGROUND_ROUTE if timings is None else "request",))
+        if self.explain_enabled and self._should_explain(statement):
+            try:
+                self._queue.put_nowait((entry, statement, args))
+                self._ensure_worker()
+                return
+            except queue.Full:
+                pass
+        self._log(entry)
+
+    def request(self, summary):
+        with self._lock:
+            self.requests.append(summary)
+        print(f"🐢 慢請求 {summary['duration_ms']:.0f} ms {summary['method']} {summary['path']} "
+              f"(db {summary['db_ms']:.0f} ms / {summary['statements']} 個 SQL，"
+              f"借連線 {summary['acquire_ms']:.0f} ms，編碼 {summary['serialize_ms']:.0f} ms)")
+
+    def _should_explain(self, statement):
+        if not EXPLAINABLE_STATEMENT.match(statement):
+            return False
+        shape = _LITERALS.sub("?", statement)
+        now = time.monotonic()
+        with self._lock:
+            last = self._explained.get(shape)
+            if last is not None and now - last < SLOW_QUERY_EXPLAIN_INTERVAL:
+                return False
+            self._explained[shape] = now
+            if len(self._explained) > 10 * self.statements.maxlen:
+                self._explained.clear()
+        return True
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            entry, statement, args = self._queue.get()
+            try:
+                entry["plan"] = explain(statement, args)
+            except Exception as e:
+                entry["plan"] = f"(EXPLAIN 失敗: {e})"
+            self._log(entry)
+
+    def _log(self, entry):
+        print(f"🐢 慢查詢 {entry['duration_ms']:.0f} ms {entry['method'] or ''} {entry['path'] or BACKGROUND_ROUTE}："
+              f"{' '.join(entry['statement'].split())[:300]}")
+        if entry["plan"]:
+            print(entry["plan"])
+        if SLOW_QUERY_LOG_FILE:
+            try:
+                with open(SLOW_QUERY_LOG_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                print("⚠️ 慢查詢紀錄寫入失敗:", e)
+
+    def snapshot(self, limit=50):
+        with self._lock:
+            statements = list(self.statements)[-limit:]
+            requests = list(self.requests)[-limit:]
+        return {
+            "slow_query_ms": SLOW_QUERY_MS,
+            "slow_request_ms": SLOW_REQUEST_MS,
+            "statements": statements[::-1],
+            "requests": requests[::-1],
+        }
+
+
+slow_log = SlowLog()
+
+
+def explain(statement, args=None):
+    """
+    用連線池的另一條連線跑 EXPLAIN，回傳執行計畫文字。
+    只讀的查詢跑 EXPLAIN (ANALYZE, BUFFERS)；其他只跑 EXPLAIN。不管哪種最後都 rollback。
+    args 是 asyncpg 的參數 ($1, $2…)，換成 psycopg2 的具名參數再執行
+    """
+    from db_pool import get_pool
+
+    params = None
+    if args:
+        statement = re.sub(r"\$(\d+)", lambda m: f"%(p{m.group(1)})s", statement.replace("%", "%%"))
+        params = {f"p{i}": value for i, value in enumerate(args, 1)}
+    analyze = READ_ONLY_STATEMENT.match(statement) and not _WRITES.search(statement)
+    options = "(ANALYZE, BUFFERS)" if analyze else ""
+    with get_pool().connection() as conn:
+        try:
+            # 一般 cursor：EXPLAIN 本身不要再被記成慢查詢
+            with conn.cursor(cursor_factory=extensions.cursor) as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (SLOW_QUERY_EXPLAIN_TIMEOUT_MS,))
+                cur.execute(f"EXPLAIN {options} {statement}", params)
+                return "\n".join(row[0] for row in cur.fetchall())
+        finally:
+            conn.rollback()
+
+
+def _route(scope):
+    # 用路由的樣板 (/api/data/{table_name}) 當 label，不然每個網址都是一組新的指標
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def finish(timings, route, status):
+    total = time.perf_counter() - timings.started
+    metrics.inc("app_http_requests_total", (timings.method, route, status))
+    metrics.observe("app_http_request_duration_seconds", (timings.method, route), total)
+    for seconds in timings.acquire:
+        metrics.observe("app_db_acquire_seconds", (route,), seconds)
+    for seconds in timings.statements:
+        metrics.observe("app_db_statement_duration_seconds", (route,), seconds)
+    if timings.rows:
+        metrics.inc("app_db_rows_total", (route,), timings.rows)
+    if timings.serialize:
+        metrics.observe("app_serialize_duration_seconds", (route,), timings.serialize)
+    if timings.errors:
+        metrics.inc("app_request_errors_total", (route,))
+    if total * 1000 >= SLOW_REQUEST_MS:
+        slow_log.request(timings.summary(route, status, total))
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware (不用 BaseHTTPMiddleware，少一層 task，串流回應也不會被整包讀進記憶體)。
+    回應開始時加上 Server-Timing 標頭，回應送完再記指標
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not QUERY_METRICS:
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings(scope["method"], scope["path"])
+        token = _current.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing",
+                                timings.server_timing(time.perf_counter() - timings.started).encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except Exception as e:
+            timings.errors.append(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current.reset(token)
+            finish(timings, _route(scope), status)
@@ -0,0 +1,383 @@
+"""
+讀寫分離：GET 的查詢分到唯讀副本 (streaming replication 的 standby)，寫入跟剛寫完的讀取留在主資料庫
+
+設定 (環境變數，帳號 / 密碼 / 資料庫名稱跟主資料庫一樣)：
+    DB_READ_REPLICAS = replica1:5432,replica2:5432   逗號分隔的 host:port (沒寫 port 用 DB_PORT)
+    DB_REPLICA_POOL_MAX = 10          每個副本的連線池上限
+    DB_REPLICA_POOL_TIMEOUT = 1       借副本連線最多等幾秒，等不到就改讀主資料庫
+    DB_REPLICA_CHECK_INTERVAL = 1     幾秒檢查一次副本
+    DB_REPLICA_MAX_LAG_MB = 16        落後主資料庫超過這麼多 WAL 就先不用
+    DB_REPLICA_MAX_LAG_SECONDS = 5    持續落後 (還有 WAL 沒重播) 超過這麼多秒也先不用
+沒設定 DB_READ_REPLICAS 時全部照舊走主資料庫，這裡什麼都不做。
+
+- 背景執行緒定期問主資料庫目前的 WAL 位置、問每個副本重播到哪、是不是還在 recovery；
+  連不上、已經被 promote、落後太多的副本自動排除，恢復之後自動加回來
+- 讀取時在「重播位置 >= 這個請求要求的位置」的健康副本裡挑借出連線最少的 (一樣多就輪流)，
+  一個都沒有就讀主資料庫；借副本連線失敗時把它標成不健康，這次改讀主資料庫
+- read-after-write：寫入 (GET 以外、成功的請求) 之後記下主資料庫的 WAL 位置，
+  這個 process 之後的讀取都要副本至少重播到這裡，還沒重播到就讀主資料庫；
+  同一個位置也放在 cookie (db_read_lsn) 帶給 client，之後打到其他 worker 一樣看得到自己剛寫的資料
+"""
+import contextvars
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from starlette.concurrency import run_in_threadpool
+
+from db_pool import DB_CONFIG, PoolTimeout, get_pool, new_pool
+
+READ_REPLICAS = [a.strip() for a in os.getenv("DB_READ_REPLICAS", "").split(",") if a.strip()]
+REPLICA_POOL_MAX = int(os.getenv("DB_REPLICA_POOL_MAX", "10"))
+REPLICA_POOL_TIMEOUT = float(os.getenv("DB_REPLICA_POOL_TIMEOUT", "1"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "1"))
+REPLICA_MAX_LAG_BYTES = int(float(os.getenv("DB_REPLICA_MAX_LAG_MB", "16")) * 1024 * 1024)
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+# 健康檢查連線 / 查詢的逾時 (秒)，卡住的副本不要拖慢整輪檢查
+REPLICA_CHECK_TIMEOUT = 2
+
+READ_LSN_COOKIE = "db_read_lsn"
+# cookie 只要撐到副本追上就好，不用留太久
+READ_LSN_MAX_AGE = 60
+
+# WAL 位置一律換成整數 (bytes) 比較
+CURRENT_LSN = "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::bigint"
+REPLICA_STATUS = """
+    SELECT pg_is_in_recovery(),
+           pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0')::bigint,
+           extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float8
+"""
+
+# 這個請求至少要讀到哪個 WAL 位置 (client 帶來的 cookie)
+_read_lsn = contextvars.ContextVar("read_lsn", default=0)
+# 這個請求的讀取分到副本時，副本當時至少重播到哪 (讀主資料庫時是 None，見 served_lsn)
+_served_lsn = contextvars.ContextVar("served_lsn", default=None)
+
+
+class _Monitor:
+    """健康檢查專用的一條連線 (autocommit、有逾時)，查詢失敗就關掉，下次重連"""
+
+    def __init__(self, config):
+        self.config = config
+        self.conn = None
+
+    def fetchone(self, query):
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(
+                    connect_timeout=REPLICA_CHECK_TIMEOUT,
+                    options=f"-c statement_timeout={REPLICA_CHECK_TIMEOUT * 1000}",
+                    **self.config
+                )
+                self.conn.autocommit = True
+            with self.conn.cursor() as cur:
+                cur.execute(query)
+                return cur.fetchone()
+        except psycopg2.Error:
+            self.close()
+            raise
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+
+class Replica:
+    def __init__(self, address):
+        host, sep, port = address.rpartition(":")
+        if not sep:
+            host, port = address, DB_CONFIG["port"]
+        self.name = address
+        self.overrides = {"host": host, "port": int(port)}
+        self.config = dict(DB_CONFIG, **self.overrides)
+        self.healthy = False
+        self.replay_lsn = None
+        self.lag_bytes = None
+        self.lag_seconds = None
+        self.error = "還沒檢查"
+        self.checked_at = None
+        self.served = 0
+        self._behind_since = None
+        self._monitor = _Monitor(self.config)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        """這個副本的連線池 (第一次用到才建立，不健康時會被關掉重建)"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = new_pool(0, REPLICA_POOL_MAX, REPLICA_POOL_TIMEOUT, **self.overrides)
+            return self._pool
+
+    def in_use(self):
+        pool = self._pool
+        return pool.stats()["in_use"] if pool is not None else 0
+
+    def check(self, primary_lsn):
+        try:
+            in_recovery, replay_lsn, replay_age = self._monitor.fetchone(REPLICA_STATUS)
+        except psycopg2.Error as e:
+            self.mark_down(f"連不上：{str(e).strip()}")
+            return
+        lag_bytes = max(0, primary_lsn - replay_lsn) if primary_lsn is not None and replay_lsn is not None else None
+        # 主資料庫閒置一陣子後的第一筆寫入，replay timestamp 看起來會落後很久 (其實只差幾 ms)，
+        # 所以落後秒數取「最後重播的交易多久以前」跟「連續幾次檢查都沒追上、持續了多久」比較小的那個
+        now = time.monotonic()
+        if not lag_bytes:
+            self._behind_since = None
+            lag_seconds = 0.0
+        else:
+            if self._behind_since is None:
+                self._behind_since = now
+            lag_seconds = min(replay_age if replay_age is not None else 0.0, now - self._behind_since)
+        if not in_recovery:
+            error = "不是 standby (可能已經被 promote)，不當唯讀副本用"
+        elif lag_bytes is not None and lag_bytes > REPLICA_MAX_LAG_BYTES:
+            error = f"落後 {lag_bytes / 1024 / 1024:.1f} MB WAL"
+        elif lag_seconds > REPLICA_MAX_LAG_SECONDS:
+            error = f"落後 {lag_seconds:.1f} 秒"
+        else:
+            error = None
+        with self._lock:
+            self.replay_lsn = replay_lsn
+            self.lag_bytes = lag_bytes
+            self.lag_seconds = round(lag_seconds, 3)
+            self.checked_at = time.time()
+        if error is None:
+            if not self.healthy:
+                print(f"✅ 唯讀副本 {self.name} 可以使用")
+            self.healthy, self.error = True, None
+        else:
+            # 只是落後的話連線還是好的，連線池留著
+            self.mark_down(error, drop_pool=not in_recovery)
+
+    def mark_down(self, error, drop_pool=True):
+        """排除這個副本；連不上時閒置的連線可能已經斷了，整個連線池關掉，恢復時再重建"""
+        with self._lock:
+            was_healthy = self.healthy
+            self.healthy, self.error = False, error
+            self.checked_at = time.time()
+            pool = None
+            if drop_pool:
+                pool, self._pool = self._pool, None
+        if was_healthy:
+            print(f"⚠️ 唯讀副本 {self.name} 先不用:", error)
+        if pool is not None:
+            pool.close()
+
+    def close(self):
+        self._monitor.close()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+    def snapshot(self):
+        with self._lock:
+            pool = self._pool
+            return {
+                "name": self.name,
+                "healthy": self.healthy,
+                "error": self.error,
+                "replay_lsn": self.replay_lsn,
+                "lag_bytes": self.lag_bytes,
+                "lag_seconds": self.lag_seconds,
+                "checked_at": self.checked_at,
+                "served": self.served,
+                "pool": pool.stats() if pool is not None else None,
+            }
+
+
+class ReadReplicas:
+    def __init__(self, addresses):
+        self.replicas = [Replica(a) for a in addresses]
+        self.primary_lsn = None
+        self.last_write_lsn = 0
+        self.primary_reads = 0
+        self._monitor = _Monitor(DB_CONFIG)
+        self._rotation = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    def start(self):
+        """啟動時先檢查一輪 (第一個請求就能用副本)，之後交給背景執行緒"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self.check()
+        self._thread = threading.Thread(target=self._run, name="replica-check", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=REPLICA_CHECK_TIMEOUT * 2)
+            self._thread = None
+        self._monitor.close()
+        for replica in self.replicas:
+            replica.close()
+
+    def _run(self):
+        while not self._stop.wait(REPLICA_CHECK_INTERVAL):
+            try:
+                self.check()
+            except Exception as e:
+                print("⚠️ 唯讀副本檢查失敗:", e)
+
+    def check(self):
+        try:
+            self.primary_lsn = self._monitor.fetchone(CURRENT_LSN)[0]
+        except psycopg2.Error as e:
+            # 主資料庫連不上時不知道副本落後多少，只看副本自己的狀態
+            print("⚠️ 無法取得主資料庫的 WAL 位置:", e)
+            self.primary_lsn = None
+        for replica in self.replicas:
+            replica.check(self.primary_lsn)
+
+    def required_lsn(self):
+        """這個請求至少要讀到的位置：client 的 cookie 跟這個 process 最後一次寫入，取大的"""
+        return max(_read_lsn.get(), self.last_write_lsn)
+
+    def choose(self, in_use=Replica.in_use):
+        """挑一個副本來讀，沒有可以用的回傳 None (讀主資料庫)；in_use 算副本目前借出幾條連線"""
+        if not self.enabled:
+            return None
+        required = self.required_lsn()
+        candidates = [r for r in self.replicas
+                      if r.healthy and r.replay_lsn is not None and r.replay_lsn >= required]
+        if not candidates:
+            return None
+        # 先輪一格再挑最閒的，借出數一樣時就會輪流
+        start = next(self._rotation) % len(candidates)
+        return min(candidates[start:] + candidates[:start], key=in_use)
+
+    def record_read(self, replica):
+        # 健康檢查在借連線之前量到的重播位置，之後的查詢一定至少看得到這裡
+        _served_lsn.set(None if replica is None else replica.replay_lsn)
+        with self._lock:
+            if replica is None:
+                self.primary_reads += 1
+            else:
+                replica.served += 1
+
+    def note_write(self, conn=None):
+        """寫入 commit 之後呼叫：記下主資料庫目前的 WAL 位置並回傳 (沒有設定副本時不做事，回傳 None)"""
+        if not self.enabled:
+            return None
+        if conn is None:
+            with get_pool().connection() as conn:
+                return self.note_write(conn)
+        with conn.cursor() as cur:
+            cur.execute(CURRENT_LSN)
+            lsn = cur.fetchone()[0]
+        conn.rollback()
+        with self._lock:
+            self.last_write_lsn = max(self.last_write_lsn, lsn)
+        return lsn
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "primary_lsn": self.primary_lsn,
+            "last_write_lsn": self.last_write_lsn,
+            "required_lsn": self.required_lsn(),
+            "primary_reads": self.primary_reads,
+            "max_lag_bytes": REPLICA_MAX_LAG_BYTES,
+            "max_lag_seconds": REPLICA_MAX_LAG_SECONDS,
+            "replicas": [r.snapshot() for r in self.replicas],
+        }
+
+
+replicas = ReadReplicas(READ_REPLICAS)
+
+
+def served_lsn():
+    """這個請求最近一次 acquire_read 分到副本時，副本當時至少重播到的位置；讀主資料庫回傳 None"""
+    return _served_lsn.get()
+
+
+def acquire_read():
+    """借一條讀取用的連線，回傳 (連線池, 連線)；用完 putconn 回同一個連線池"""
+    replica = replicas.choose()
+    if replica is not None:
+        try:
+            pool = replica.pool()
+            conn = pool.getconn()
+            replicas.record_read(replica)
+            return pool, conn
+        except psycopg2.OperationalError as e:
+            replica.mark_down(f"借連線失敗：{str(e).strip()}")
+        except PoolTimeout:
+            # 副本的連線都在忙：不用排隊，這次讀主資料庫
+            pass
+    pool = get_pool()
+    conn = pool.getconn()
+    replicas.record_read(None)
+    return pool, conn
+
+
+@contextmanager
+def read_connection():
+    """跟 DBPool.connection() 一樣，不過會分到唯讀副本"""
+    pool, conn = acquire_read()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def _cookie_lsn(scope):
+    for name, value in scope["headers"]:
+        if name != b"cookie":
+            continue
+        for part in value.decode("latin-1").split(";"):
+            key, _, lsn = part.strip().partition("=")
+            if key == READ_LSN_COOKIE and lsn.isdigit():
+                return int(lsn)
+    return 0
+
+
+class ReadRoutingMiddleware:
+    """
+    ASGI middleware：client 帶來的 db_read_lsn cookie 當這個請求的最低要求；
+    GET / HEAD / OPTIONS 以外的請求成功之後記下寫入位置，回應加上 Set-Cookie
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replicas.enabled:
+            await self.app(scope, receive, send)
+            return
+        token = _read_lsn.set(_cookie_lsn(scope))
+        write = scope["method"] not in ("GET", "HEAD", "OPTIONS")
+
+        async def send_with_lsn(message):
+            if write and message["type"] == "http.response.start" and message["status"] < 400:
+                try:
+                    lsn = await run_in_threadpool(replicas.note_write)
+                except (psycopg2.Error, PoolTimeout) as e:
+                    print("⚠️ 無法取得寫入後的 WAL 位置:", e)
+                    lsn = None
+                if lsn is not None:
+                    cookie = f"{READ_LSN_COOKIE}={lsn}; Max-Age={READ_LSN_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"
+                    message = dict(message, headers=list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_lsn)
+        finally:
+            _read_lsn.reset(token)
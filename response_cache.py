@@ -0,0 +1,283 @@
+"""
+/api/data/{table_name} 的回應快取 + ETag
+
+同一頁 (courses 第一頁、依某欄位排序的 student_info…) 很多人重複在看，每次都要算一次筆數再查一次資料。
+這裡把「編碼好的 JSON」(serialization.py) 整包快取起來：
+- key：資料表 + 所有 query string (排序、頁碼、cursor、篩選條件) + 資料表結構版本
+- 記憶體版 (預設)：LRU，最多 RESPONSE_CACHE_MAX_ENTRIES 個、RESPONSE_CACHE_MAX_BYTES 位元組，
+  超過 RESPONSE_CACHE_TTL 秒的不用
+- 共用版：設定 RESPONSE_CACHE_URL=redis://... 時存在 Redis，多個 uvicorn worker 共用 (需要 pip install redis)
+- 新增 / 修改 / 刪除 (含 bulk) 成功後呼叫 invalidate(table)，那張表的快取全部作廢。
+  每張表有一個版本號，invalidate 時 +1；查詢前先記下版本號，查完版本號變了 (查的同時有人寫入) 就不存
+- 有唯讀副本時 (read_replicas.py)：invalidate 同時記下寫入後主資料庫的 WAL 位置，
+  從副本讀到的頁面只有在副本當時已經重播到這個位置時才存，
+  不然落後的副本讀到的舊資料會存在新的版本號底下，所有人 (包含剛寫入的人) 都要等 TTL 才看得到新資料
+
+回應都帶 ETag (內容的 hash)，瀏覽器下次帶 If-None-Match 來，內容沒變就回 304、不傳內容。
+命中率等統計：GET /api/cache/stats
+
+註：記憶體版的快取在各個 worker 裡，其他 worker 或 import.py 改資料時要等 TTL 過期 (跟 row_counts.py 一樣)；
+Redis 版的版本號是共用的，哪個 worker 寫入都會讓全部作廢 (import.py 仍然要等 TTL)。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Response
+
+from serialization import dumps
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+REDIS_PREFIX = "respcache:"
+# 只往大的方向更新 (兩個 worker 同時寫入時，先拿到位置的不能把後面的蓋掉)
+REDIS_MAX_LSN = """
+if tonumber(redis.call('get', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1])
+end
+"""
+
+
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # W/"..." 也算 (weak 比較)
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class MemoryBackend:
+    """執行緒安全的 LRU：OrderedDict 尾端是最近用過的"""
+
+    shared = False
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (table, key) -> (body, etag, 存入時間)
+        self._generations = {}          # table -> 版本號
+        self._write_lsns = {}           # table -> 最後一次寫入後主資料庫的 WAL 位置
+        self._bytes = 0
+        self.evictions = 0
+
+    def generation(self, table_name):
+        """回傳 (版本號, 寫入位置)"""
+        with self._lock:
+            return self._generations.get(table_name, 0), self._write_lsns.get(table_name, 0)
+
+    def get(self, table_name, key):
+        with self._lock:
+            entry = self._entries.get((table_name, key))
+            if entry is None:
+                return None
+            if time.monotonic() - entry[2] > self.ttl:
+                self._remove((table_name, key))
+                return None
+            self._entries.move_to_end((table_name, key))
+            return entry[0], entry[1]
+
+    def put(self, table_name, key, body, etag, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations.get(table_name, 0) != generation[0]:
+                return
+            self._remove((table_name, key))
+            self._entries[(table_name, key)] = (body, etag, time.monotonic())
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table_name=None, lsn=None):
+        with self._lock:
+            tables = list(self._generations) if table_name is None else [table_name]
+            for table in tables:
+                if lsn is not None:
+                    self._write_lsns[table] = max(self._write_lsns.get(table, 0), lsn)
+                self._generations[table] = self._generations.get(table, 0) + 1
+            for entry_key in [k for k in self._entries if table_name is None or k[0] == table_name]:
+                self._remove(entry_key)
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "evictions": self.evictions}
+
+
+class RedisBackend:
+    """
+    存在 Redis：版本號放在 respcache:gen:{table}，內容放在 respcache:{table}:{版本號}:{key}，
+    invalidate = 版本號 +1，舊的內容不用刪，TTL 到了 Redis 自己清掉；
+    寫入位置放在 respcache:lsn:{table}，一定比版本號先更新 (看到新版本號的人一定看得到新位置)
+    (大小上限請在 Redis 設定 maxmemory + allkeys-lru)
+    """
+
+    shared = True
+
+    def __init__(self, url, ttl):
+        import redis
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+        self._redis.ping()
+        self._max_lsn = self._redis.register_script(REDIS_MAX_LSN)
+
+    def _gen_key(self, table_name):
+        return f"{REDIS_PREFIX}gen:{table_name}"
+
+    def _lsn_key(self, table_name):
+        return f"{REDIS_PREFIX}lsn:{table_name}"
+
+    def _entry_key(self, table_name, key, generation):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return f"{REDIS_PREFIX}{table_name}:{generation}:{digest}"
+
+    def generation(self, table_name):
+        """回傳 (版本號, 寫入位置)"""
+        generation, lsn = self._redis.mget(self._gen_key(table_name), self._lsn_key(table_name))
+        return int(generation or 0), int(lsn or 0)
+
+    def get(self, table_name, key):
+        body = self._redis.get(self._entry_key(table_name, key, self.generation(table_name)[0]))
+        if body is None:
+            return None
+        return body, make_etag(body)
+
+    def put(self, table_name, key, body, etag, generation):
+        # 存的時候版本號已經變了，這個 key 就不會再被讀到
+        self._redis.set(self._entry_key(table_name, key, generation[0]), body, ex=max(1, int(self.ttl)))
+
+    def invalidate(self, table_name=None, lsn=None):
+        if table_name is not None:
+            tables = [table_name]
+        else:
+            prefix = f"{REDIS_PREFIX}gen:"
+            tables = [k.decode()[len(prefix):] for k in self._redis.scan_iter(f"{prefix}*")]
+        for table in tables:
+            if lsn is not None:
+                self._max_lsn(keys=[self._lsn_key(table)], args=[lsn])
+            self._redis.incr(self._gen_key(table))
+
+    def stats(self):
+        return {"backend_keys": self._redis.dbsize()}
+
+
+class ResponseCache:
+    def __init__(self, enabled=RESPONSE_CACHE, url=RESPONSE_CACHE_URL, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.enabled = enabled
+        self.backend = None
+        if enabled and url:
+            try:
+                self.backend = RedisBackend(url, ttl)
+            except Exception as e:
+                print("⚠️ 無法使用共用回應快取，改用記憶體快取:", e)
+        if self.backend is None:
+            self.backend = MemoryBackend(ttl, max_entries, max_bytes)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "not_modified": 0, "stores": 0, "stale_skips": 0,
+                          "invalidations": 0, "errors": 0}
+        # 寫入 commit 之後取得主資料庫 WAL 位置的函式 (有唯讀副本時 main.py 設成 replicas.note_write)
+        self.write_lsn = None
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def key(self, request, version=""):
+        """query string 排序過再當 key (參數順序不同也是同一頁)"""
+        return f"{version}|{request.url.path}?" + "&".join(
+            f"{k}={v}" for k, v in sorted(request.query_params.multi_items())
+        )
+
+    def lookup(self, table_name, key):
+        """回傳 (快取的 (body, etag) 或 None, 目前的版本號)；版本號原封不動交給 store"""
+        if not self.enabled:
+            return None, None
+        try:
+            generation = self.backend.generation(table_name)
+            cached = self.backend.get(table_name, key)
+        except Exception as e:
+            self._count("errors")
+            print("⚠️ 回應快取讀取失敗:", e)
+            return None, None
+        self._count("hits" if cached is not None else "misses")
+        return cached, generation
+
+    def store(self, table_name, key, payload, generation, read_lsn=None):
+        """
+        編碼 payload 並存起來，回傳 (body, etag)；generation 是 lookup 時拿到的版本號。
+        read_lsn：從唯讀副本讀的時候，副本當時至少重播到的位置 (讀主資料庫時是 None)；
+        比這個版本號的寫入位置舊就只回傳、不存
+        """
+        body = dumps(payload)
+        etag = make_etag(body)
+        if self.enabled and generation is not None and read_lsn is not None and read_lsn < generation[1]:
+            self._count("stale_skips")
+        elif self.enabled and generation is not None:
+            try:
+                self.backend.put(table_name, key, body, etag, generation)
+                self._count("stores")
+            except Exception as e:
+                self._count("errors")
+                print("⚠️ 回應快取寫入失敗:", e)
+        return body, etag
+
+    def respond(self, request, body, etag):
+        """If-None-Match 跟 ETag 一樣時回 304 (不傳內容)"""
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            self._count("not_modified")
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def invalidate(self, table_name=None):
+        if not self.enabled:
+            return
+        lsn = None
+        if self.write_lsn is not None:
+            try:
+                lsn = self.write_lsn()
+            except Exception as e:
+                print("⚠️ 無法取得寫入後的 WAL 位置，副本讀到的頁面可能晚一點才更新:", e)
+        try:
+            self.backend.invalidate(table_name, lsn)
+            self._count("invalidations")
+        except Exception as e:
+            self._count("errors")
+            print("⚠️ 回應快取清除失敗:", e)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = round(counters["hits"] / lookups, 4) if lookups else None
+        try:
+            backend = self.backend.stats()
+        except Exception as e:
+            backend = {"error": str(e)}
+        return {"enabled": self.enabled, "backend": "redis" if self.shared else "memory",
+                "ttl": self.backend.ttl, **counters, **backend}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,245 @@
+"""
+student_vle 的彙總表 (rollup)，由 trigger 逐筆增量維護
+
+student_vle 是最大的表，實際會問的幾乎都是「每位學生每週點了多少」或「每個 id_site 每週被點了多少」，
+所以另外存兩張已經加總好的表：
+- vle_rollup_student_week：(code_module, code_presentation, id_student, week) → clicks, interactions
+- vle_rollup_site_week：   (code_module, code_presentation, id_site, week)    → clicks, interactions
+week = floor(date / 7)，clicks = SUM(sum_click)，interactions = student_vle 的筆數。
+
+維護方式：student_vle 上的 statement-level trigger (用 transition table 拿到這個指令改了哪些列)，
+新增的列加上去、刪除的列減掉、更新 = 減掉舊的再加上新的，interactions 變成 0 的那一格就刪掉。
+一個指令不管改幾筆都只跑一次加總，所以 main.py 的單筆新增 / 修改 / 刪除、bulk.py 的批次寫入、
+import.py --incremental 都會自動更新彙總表，不需要整張重算。TRUNCATE student_vle 時彙總表一起清空。
+
+import.py 匯入完 student_vle 之後呼叫 build_rollups：一次 GROUP BY 算好、再裝 trigger
+(先灌資料再裝 trigger，匯入時不用每個 COPY 都多跑一次)。
+check_rollups 拿彙總表跟 student_vle 現算的結果逐格比對 (同一個 snapshot)，repair=True 時把不一致的那張重建。
+"""
+BASE_TABLE = "student_vle"
+
+# 名稱 → 分組欄位 (week 由 date 算出來)
+ROLLUPS = {
+    "vle_rollup_student_week": ["code_module", "code_presentation", "id_student", "week"],
+    "vle_rollup_site_week": ["code_module", "code_presentation", "id_site", "week"],
+}
+
+# 預設型別；code_module / code_presentation 建表時照 student_vle 實際的型別
+# (精簡格式 compact_schema.py 時是 SMALLINT 代碼)
+COLUMN_TYPES = {
+    "code_module": "VARCHAR(45)",
+    "code_presentation": "VARCHAR(45)",
+    "id_student": "INT",
+    "id_site": "INT",
+    "week": "INT",
+}
+
+# 分組欄位在 student_vle (或 transition table) 上怎麼算
+KEY_EXPRESSIONS = {"week": "floor(date / 7.0)::int"}
+
+APPLY_FUNCTION = "vle_rollup_apply"
+TRUNCATE_FUNCTION = "vle_rollup_truncate"
+TRUNCATE_TRIGGER = "vle_rollup_truncate"
+
+# trigger 名稱 → (事件, REFERENCING)
+TRIGGERS = {
+    "vle_rollup_insert": ("INSERT", "NEW TABLE AS new_rows"),
+    "vle_rollup_update": ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    "vle_rollup_delete": ("DELETE", "OLD TABLE AS old_rows"),
+}
+
+# 一致性檢查時每張表最多列出幾格不一樣的
+CHECK_SAMPLE_ROWS = 10
+
+
+def _key_select(keys):
+    return ", ".join(f"{KEY_EXPRESSIONS[k]} AS {k}" if k in KEY_EXPRESSIONS else k for k in keys)
+
+
+def _aggregate_sql(name, source):
+    """source 裡的列加總成 name 的格式 (source = student_vle 或 transition table)"""
+    keys = ROLLUPS[name]
+    return (f"SELECT {_key_select(keys)}, COALESCE(SUM(sum_click), 0) AS clicks, COUNT(*) AS interactions "
+            f"FROM {source} GROUP BY {', '.join(str(i + 1) for i in range(len(keys)))}")
+
+
+def _delta_sql(name, sources):
+    """
+    sources：[(transition table, 正負號)]，回傳「這個指令讓每一格加減多少」的 upsert，
+    加總後沒有變化的格子不動；依主鍵排序寫入，兩個交易同時改到同幾格時不會互相 deadlock
+    """
+    keys = ", ".join(ROLLUPS[name])
+    parts = " UNION ALL ".join(
+        f"SELECT {_key_select(ROLLUPS[name])}, {sign} * COALESCE(sum_click, 0) AS clicks, {sign} AS interactions "
+        f"FROM {source}"
+        for source, sign in sources
+    )
+    return f"""
+        INSERT INTO {name} AS r ({keys}, clicks, interactions)
+        SELECT {keys}, SUM(clicks), SUM(interactions) FROM ({parts}) d
+        GROUP BY {keys}
+        HAVING SUM(clicks) <> 0 OR SUM(interactions) <> 0
+        ORDER BY {keys}
+        ON CONFLICT ({keys}) DO UPDATE
+        SET clicks = r.clicks + EXCLUDED.clicks, interactions = r.interactions + EXCLUDED.interactions;
+    """
+
+
+def _cleanup_sql(name):
+    """刪除 / 更新之後，被減到沒有任何一筆的格子拿掉"""
+    keys = ROLLUPS[name]
+    match = " AND ".join(f"r.{k} = d.{k}" for k in keys)
+    return f"""
+        DELETE FROM {name} r
+        USING (SELECT DISTINCT {_key_select(keys)} FROM old_rows) d
+        WHERE {match} AND r.interactions = 0;
+    """
+
+
+def _apply_function_sql():
+    def statements(sources):
+        body = "".join(_delta_sql(name, sources) for name in ROLLUPS)
+        if any(source == "old_rows" for source, _ in sources):
+            body += "".join(_cleanup_sql(name) for name in ROLLUPS)
+        return body
+
+    return f"""
+        CREATE OR REPLACE FUNCTION {APPLY_FUNCTION}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {statements([("new_rows", 1)])}
+            ELSIF TG_OP = 'DELETE' THEN
+                {statements([("old_rows", -1)])}
+            ELSE
+                {statements([("old_rows", -1), ("new_rows", 1)])}
+            END IF;
+            RETURN NULL;
+        END $$
+    """
+
+
+def _truncate_function_sql():
+    return f"""
+        CREATE OR REPLACE FUNCTION {TRUNCATE_FUNCTION}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            TRUNCATE {', '.join(ROLLUPS)};
+            RETURN NULL;
+        END $$
+    """
+
+
+def _column_types(cur):
+    """COLUMN_TYPES 換上 student_vle 裡同名欄位實際的型別"""
+    cur.execute("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped", (BASE_TABLE,))
+    actual = dict(cur.fetchall())
+    return {k: actual.get(k, default) if k not in KEY_EXPRESSIONS else default for k, default in COLUMN_TYPES.items()}
+
+
+def _create_table_sql(name, types=COLUMN_TYPES):
+    keys = ROLLUPS[name]
+    columns = ", ".join(f"{k} {types[k]} NOT NULL" for k in keys)
+    return (f"CREATE TABLE IF NOT EXISTS {name} ({columns}, clicks BIGINT NOT NULL, "
+            f"interactions BIGINT NOT NULL, PRIMARY KEY ({', '.join(keys)}))")
+
+
+def _fill(cur, name):
+    cur.execute(f"TRUNCATE {name}")
+    cur.execute(f"INSERT INTO {name} {_aggregate_sql(name, BASE_TABLE)}")
+    cur.execute(f"ANALYZE {name}")
+
+
+def build_rollups(conn):
+    """
+    建立 (或重建) 全部彙總表並裝好 trigger，回傳 {名稱: 格數}。
+    建的時候鎖住 student_vle 不讓別人寫 (可以讀)，確保算出來的跟裝 trigger 時的資料一致
+    """
+    counts = {}
+    with conn.cursor() as cur:
+        cur.execute(f"LOCK TABLE {BASE_TABLE} IN SHARE MODE")
+        types = _column_types(cur)
+        for name in ROLLUPS:
+            cur.execute(_create_table_sql(name, types))
+            _fill(cur, name)
+            cur.execute(f"SELECT count(*) FROM {name}")
+            counts[name] = cur.fetchone()[0]
+        cur.execute(_apply_function_sql())
+        cur.execute(_truncate_function_sql())
+        for trigger, (event, referencing) in TRIGGERS.items():
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {BASE_TABLE}")
+            cur.execute(f"CREATE TRIGGER {trigger} AFTER {event} ON {BASE_TABLE} REFERENCING {referencing} "
+                        f"FOR EACH STATEMENT EXECUTE FUNCTION {APPLY_FUNCTION}()")
+        cur.execute(f"DROP TRIGGER IF EXISTS {TRUNCATE_TRIGGER} ON {BASE_TABLE}")
+        cur.execute(f"CREATE TRIGGER {TRUNCATE_TRIGGER} AFTER TRUNCATE ON {BASE_TABLE} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION {TRUNCATE_FUNCTION}()")
+    conn.commit()
+    return counts
+
+
+def drop_rollups(conn):
+    """彙總表與 function 一起刪掉 (trigger 跟著 function CASCADE 刪除)"""
+    with conn.cursor() as cur:
+        for name in ROLLUPS:
+            cur.execute(f"DROP TABLE IF EXISTS {name}")
+        cur.execute(f"DROP FUNCTION IF EXISTS {APPLY_FUNCTION}() CASCADE")
+        cur.execute(f"DROP FUNCTION IF EXISTS {TRUNCATE_FUNCTION}() CASCADE")
+    conn.commit()
+
+
+def rollups_ready(conn):
+    """彙總表都在、trigger 也都裝好了才算數 (少一個 trigger 彙總表就會慢慢跟 student_vle 不一致)"""
+    triggers = list(TRIGGERS) + [TRUNCATE_TRIGGER]
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT count(*) FROM pg_trigger
+            WHERE tgrelid = to_regclass(%s) AND tgname = ANY(%s) AND tgenabled <> 'D'
+        """, (BASE_TABLE, triggers))
+        installed = cur.fetchone()[0]
+        cur.execute("SELECT count(*) FROM unnest(%s::text[]) AS t(name) WHERE to_regclass(name) IS NOT NULL",
+                    (list(ROLLUPS),))
+        tables = cur.fetchone()[0]
+    return installed == len(triggers) and tables == len(ROLLUPS)
+
+
+def check_rollups(conn, repair=False):
+    """
+    逐格比對彙總表與 student_vle 現算的結果，回傳
+    {名稱: {"rows": 格數, "mismatched": 不一致格數, "samples": [前幾格], "repaired": bool}}。
+    用 REPEATABLE READ，兩邊看到的是同一個 snapshot；repair=True 時不一致的表整張重建
+    """
+    report = {}
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        for name, keys in ROLLUPS.items():
+            key_list = ", ".join(keys)
+            cur.execute(f"""
+                SELECT {key_list}, r.clicks, e.clicks, r.interactions, e.interactions
+                FROM (SELECT * FROM {name}) r
+                FULL JOIN ({_aggregate_sql(name, BASE_TABLE)}) e USING ({key_list})
+                WHERE r.clicks IS DISTINCT FROM e.clicks OR r.interactions IS DISTINCT FROM e.interactions
+                ORDER BY {key_list}
+            """)
+            mismatched = cur.fetchall()
+            cur.execute(f"SELECT count(*) FROM {name}")
+            report[name] = {
+                "rows": cur.fetchone()[0],
+                "mismatched": len(mismatched),
+                "samples": [
+                    dict(zip(keys, row), clicks=row[-4], expected_clicks=row[-3],
+                         interactions=row[-2], expected_interactions=row[-1])
+                    for row in mismatched[:CHECK_SAMPLE_ROWS]
+                ],
+                "repaired": False,
+            }
+    conn.rollback()
+
+    broken = [name for name, r in report.items() if r["mismatched"]]
+    if repair and broken:
+        with conn.cursor() as cur:
+            cur.execute(f"LOCK TABLE {BASE_TABLE} IN SHARE MODE")
+            for name in broken:
+                _fill(cur, name)
+                report[name]["repaired"] = True
+        conn.commit()
+    return report
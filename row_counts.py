@@ -0,0 +1,146 @@
+"""
+資料表總筆數：快取 + 大表用估計值
+
+以前每翻一頁都要 SELECT COUNT(*)，student_vle 每點一次就整張表 seq scan 一次。
+- 小表：照樣 COUNT(*)，但結果快取 COUNT_CACHE_TTL 秒
+- 大表 (估計超過 COUNT_ESTIMATE_THRESHOLD 筆)：用 pg_class.reltuples 估計，不掃表
+- create / update / delete 成功後呼叫 invalidate() 把那張表的快取清掉
+- 有篩選條件時 (count_filtered)：最多數到 FILTERED_COUNT_LIMIT 筆，更多時用 EXPLAIN 的估計筆數，不快取
+
+回傳 (筆數, 是否為精確值)，前端可以顯示「約 N 筆」。
+註：快取在各個 uvicorn worker 的記憶體裡，其他 process (例如 import.py) 改資料時要等 TTL 過期。
+"""
+import json
+import os
+import threading
+import time
+
+from psycopg2 import sql
+
+from statement_cache import statements
+
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "60"))
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", "100000"))
+
+# 跟 planner 估計的方式一樣：上次 ANALYZE 時的「每頁幾筆」x 目前的頁數，
+# 所以 ANALYZE 之後又長大的表也估得準。分區表 (partitioning.py) 的父表本身沒有資料，改成把每個分區的估計加起來。
+# 有資料卻從來沒 ANALYZE 過 (reltuples = -1) 的表 / 分區，或是表不存在時回傳 NULL
+ESTIMATE_QUERY = sql.SQL("""
+    WITH target AS (
+        SELECT to_regclass(quote_ident({})) AS oid
+    ), leaves AS (
+        SELECT p.relid AS oid FROM target, pg_partition_tree(target.oid) p WHERE p.isleaf
+        UNION
+        SELECT c.oid FROM target JOIN pg_class c ON c.oid = target.oid WHERE c.relkind <> 'p'
+    ), estimates AS (
+        SELECT CASE
+            WHEN c.relpages = 0 AND pg_relation_size(c.oid) = 0 THEN 0
+            WHEN c.reltuples < 0 THEN NULL
+            WHEN c.relpages = 0 THEN NULL
+            ELSE (c.reltuples / c.relpages
+                  * (pg_relation_size(c.oid) / current_setting('block_size')::int))::bigint
+        END AS estimate
+        FROM leaves JOIN pg_class c ON c.oid = leaves.oid
+    )
+    SELECT CASE WHEN bool_or(estimate IS NULL) THEN NULL ELSE SUM(estimate)::bigint END AS estimate
+    FROM estimates
+""").format(sql.Placeholder())
+
+
+def exact_count_query(table_name):
+    return sql.SQL("SELECT COUNT(*) as count FROM {}").format(sql.Identifier(table_name))
+
+
+class RowCountCache:
+    def __init__(self, ttl=COUNT_CACHE_TTL, threshold=COUNT_ESTIMATE_THRESHOLD):
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = {}   # table -> (count, exact, 存入時間)
+
+    def get(self, table_name):
+        """回傳還沒過期的 (count, exact)，沒有就回傳 None"""
+        with self._lock:
+            entry = self._entries.get(table_name)
+        if entry is None or time.monotonic() - entry[2] > self.ttl:
+            return None
+        return entry[0], entry[1]
+
+    def put(self, table_name, count, exact):
+        with self._lock:
+            self._entries[table_name] = (count, exact, time.monotonic())
+
+    def invalidate(self, table_name=None):
+        with self._lock:
+            if table_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(table_name, None)
+
+    def use_estimate(self, estimate):
+        return estimate is not None and estimate >= self.threshold
+
+
+row_counts = RowCountCache()
+
+
+def count_rows(cur, table_name):
+    """取得總筆數，回傳 (count, exact)。cur 是 psycopg2 cursor"""
+    cached = row_counts.get(table_name)
+    if cached is not None:
+        return cached
+
+    cur.execute(ESTIMATE_QUERY, (table_name,))
+    row = cur.fetchone()
+    estimate = None if row is None else (row["estimate"] if isinstance(row, dict) else row[0])
+    if row_counts.use_estimate(estimate):
+        row_counts.put(table_name, estimate, False)
+        return estimate, False
+
+    cur.execute(exact_count_query(table_name))
+    row = cur.fetchone()
+    count = row["count"] if isinstance(row, dict) else row[0]
+    row_counts.put(table_name, count, True)
+    return count, True
+
+
+# 有篩選條件時最多數到幾筆，超過就改用 planner 的估計值
+FILTERED_COUNT_LIMIT = int(os.getenv("FILTERED_COUNT_LIMIT", str(COUNT_ESTIMATE_THRESHOLD)))
+
+
+def filtered_count_query(table_name, where, limit=FILTERED_COUNT_LIMIT):
+    """最多數 limit + 1 筆 (條件命中很多筆時不用整張表數完)，參數最後要再加上 limit + 1"""
+    return sql.SQL("SELECT COUNT(*) AS count FROM (SELECT 1 FROM {} WHERE {} LIMIT {}) AS matched").format(
+        sql.Identifier(table_name), where, sql.Placeholder()
+    )
+
+
+def filtered_estimate_query(table_name, where):
+    return sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 FROM {} WHERE {}").format(sql.Identifier(table_name), where)
+
+
+def plan_rows(explain_row):
+    """EXPLAIN (FORMAT JSON) 的結果 → 估計筆數"""
+    plan = explain_row["QUERY PLAN"] if isinstance(explain_row, dict) else explain_row[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def count_filtered(cur, table_name, where, params, shape=None):
+    """
+    符合篩選條件的筆數，回傳 (count, exact)。條件每次都不一樣，不快取：
+    FILTERED_COUNT_LIMIT 筆以內數精確值，超過時用 planner 的估計 (至少是 FILTERED_COUNT_LIMIT + 1)
+    shape：條件的型態，有給時數筆數的查詢用 prepared statement 跑 (見 statement_cache.py)
+    """
+    query, args = filtered_count_query(table_name, where), list(params) + [FILTERED_COUNT_LIMIT + 1]
+    if shape is None:
+        cur.execute(query, args)
+    else:
+        statements.execute(cur, ("count", table_name, shape), query, args)
+    row = cur.fetchone()
+    count = row["count"] if isinstance(row, dict) else row[0]
+    if count <= FILTERED_COUNT_LIMIT:
+        return count, True
+    cur.execute(filtered_estimate_query(table_name, where), list(params))
+    return max(plan_rows(cur.fetchone()), count), False
@@ -0,0 +1,331 @@
+"""
+資料表結構 (metadata) 快取
+
+/api/tables、/api/columns 以前每次都查 information_schema，前端每切一次表格就查一次，
+而 information_schema 是一堆 view 疊起來的，比直接查 pg_catalog 慢很多。
+這裡啟動時從 pg_catalog 一次讀進所有資料表的：
+    欄位名稱 / 型別 / 是否 NOT NULL、主鍵、外鍵
+之後都直接讀記憶體。寫入 API 也用它在組 SQL 之前先檢查表格 / 欄位名稱，
+打錯欄位名稱直接回 400，不用跑一趟資料庫。
+
+什麼時候重新載入：
+- POST /api/schema/refresh 手動重新載入
+- 資料庫有 DDL (CREATE / ALTER / DROP TABLE…) 時：啟動時會嘗試裝一個 event trigger，
+  DDL 結束時 NOTIFY schema_changed，背景執行緒 LISTEN 到就重新載入 (暫存表的 DDL 不算)
+  (需要 superuser 權限；沒權限就只能靠手動重新載入 / 查不到表格時自動重讀)
+
+精簡格式 (import.py --compact) 的資料庫：代碼表 (value_dictionary) 也一起載入，
+存成 smallint 代碼的欄位對外的型別還是 character varying，另外標上 encoded (見 compact_schema.py)。
+代碼表有變動時也會 NOTIFY schema_changed。
+"""
+import select
+import threading
+import time
+
+import psycopg2
+from fastapi import HTTPException
+
+from compact_schema import dictionary
+from db_pool import DB_CONFIG, get_pool, PoolTimeout
+
+NOTIFY_CHANNEL = "schema_changed"
+# 查不到表格時最多幾秒自動重讀一次 (可能是別人剛建了新表)
+MISS_REFRESH_INTERVAL = 5
+
+COLUMNS_QUERY = """
+    SELECT c.relname, a.attname, format_type(a.atttypid, NULL), a.attnotnull
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+    ORDER BY c.relname, a.attnum
+"""
+
+CONSTRAINTS_QUERY = """
+    SELECT cl.relname, con.contype,
+           ARRAY(SELECT a.attname
+                 FROM unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+                 JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+                 ORDER BY k.ord),
+           ref.relname,
+           ARRAY(SELECT a.attname
+                 FROM unnest(con.confkey) WITH ORDINALITY AS k(attnum, ord)
+                 JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum
+                 ORDER BY k.ord)
+    FROM pg_constraint con
+    JOIN pg_class cl ON cl.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = cl.relnamespace
+    LEFT JOIN pg_class ref ON ref.oid = con.confrelid
+    WHERE n.nspname = 'public' AND con.contype IN ('p', 'f') AND NOT cl.relispartition
+    ORDER BY cl.relname, con.conname
+"""
+
+# 暫存表 (bulk.py / csv_import.py / delta_import.py 每次請求都會建) 不算結構變動，
+# 不然每一批寫入都會讓所有 worker 重讀結構、schema.version 換掉，回應快取跟 prepared statement 全部作廢
+# (ddl_command_end 看不到 DROP 掉的物件，DROP 另外用 sql_drop 觸發)
+DDL_FUNCTION_BODY = f"""
+BEGIN
+    IF TG_EVENT = 'sql_drop' THEN
+        IF EXISTS (SELECT 1 FROM pg_event_trigger_dropped_objects() WHERE NOT is_temporary) THEN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', tg_tag);
+        END IF;
+    ELSIF EXISTS (SELECT 1 FROM pg_event_trigger_ddl_commands()
+                  WHERE schema_name IS NULL OR schema_name NOT LIKE 'pg_temp%') THEN
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', tg_tag);
+    END IF;
+END
+"""
+
+DDL_FUNCTION_SOURCE = "SELECT prosrc FROM pg_proc WHERE proname = 'notify_schema_changed'"
+DDL_TRIGGERS = "SELECT evtname FROM pg_event_trigger WHERE evtname LIKE 'schema_changed_notify%'"
+
+INSTALL_DDL_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION notify_schema_changed() RETURNS event_trigger
+    LANGUAGE plpgsql AS $${DDL_FUNCTION_BODY}$$;
+"""
+INSTALL_DDL_TRIGGERS = {
+    "schema_changed_notify": "CREATE EVENT TRIGGER schema_changed_notify ON ddl_command_end "
+                             "EXECUTE FUNCTION notify_schema_changed()",
+    "schema_changed_notify_drop": "CREATE EVENT TRIGGER schema_changed_notify_drop ON sql_drop "
+                                  "EXECUTE FUNCTION notify_schema_changed()",
+}
+
+
+class UnknownTable(LookupError):
+    pass
+
+
+class UnknownColumn(ValueError):
+    pass
+
+
+class SchemaCache:
+    def __init__(self):
+        self._tables = None
+        self._lock = threading.Lock()
+        self._last_miss_refresh = 0.0
+        self.version = 0
+        self.loaded_at = None
+        # 代碼表裡找不到代碼時 (別的 worker 剛新增的值) 重新載入
+        dictionary.reload = self.refresh
+
+    # ---------- 載入 ----------
+    def load(self, conn):
+        """從 pg_catalog 讀出所有資料表結構，整份換掉 (讀取端不需要加鎖)"""
+        with conn.cursor() as cur:
+            cur.execute(COLUMNS_QUERY)
+            column_rows = cur.fetchall()
+            cur.execute(CONSTRAINTS_QUERY)
+            constraint_rows = cur.fetchall()
+            dictionary.load(cur)
+        conn.rollback()
+
+        tables = {}
+        for table, column, data_type, not_null in column_rows:
+            info = tables.setdefault(table, {"columns": {}, "primary_key": [], "foreign_keys": []})
+            info["columns"][column] = {"data_type": data_type, "not_null": not_null}
+            if data_type == "smallint" and dictionary.covers(column):
+                info["columns"][column].update(data_type="character varying", storage_type=data_type, encoded=True)
+
+        for table, contype, columns, ref_table, ref_columns in constraint_rows:
+            if table not in tables:
+                continue
+            if contype == "p":
+                tables[table]["primary_key"] = list(columns)
+            else:
+                tables[table]["foreign_keys"].append({
+                    "columns": list(columns),
+                    "ref_table": ref_table,
+                    "ref_columns": list(ref_columns),
+                })
+
+        with self._lock:
+            self._tables = tables
+            self.version += 1
+            self.loaded_at = time.time()
+        return tables
+
+    def refresh(self):
+        with get_pool().connection() as conn:
+            return self.load(conn)
+
+    def _get_tables(self):
+        tables = self._tables
+        if tables is None:
+            tables = self.refresh()
+        return tables
+
+    # ---------- 查詢 ----------
+    def table_names(self):
+        return sorted(self._get_tables())
+
+    def table(self, table_name):
+        tables = self._get_tables()
+        if table_name not in tables:
+            # 可能是別人剛建的表，最多每 MISS_REFRESH_INTERVAL 秒重讀一次
+            now = time.monotonic()
+            if now - self._last_miss_refresh > MISS_REFRESH_INTERVAL:
+                self._last_miss_refresh = now
+                tables = self.refresh()
+            if table_name not in tables:
+                raise UnknownTable(f"找不到資料表：{table_name}")
+        return tables[table_name]
+
+    def has_table(self, table_name):
+        try:
+            self.table(table_name)
+            return True
+        except UnknownTable:
+            return False
+
+    def columns_info(self, table_name):
+        """給 /api/columns 用，格式跟以前查 information_schema 時一樣"""
+        try:
+            columns = self.table(table_name)["columns"]
+        except UnknownTable:
+            return []
+        return [{"column_name": name, "data_type": c["data_type"]} for name, c in columns.items()]
+
+    def column_types(self, table_name):
+        return {name: c["data_type"] for name, c in self.table(table_name)["columns"].items()}
+
+    def storage_types(self, table_name):
+        """資料庫裡實際的型別 (精簡格式的代碼欄位是 smallint，column_types 則是對外的 character varying)"""
+        return {name: c.get("storage_type", c["data_type"]) for name, c in self.table(table_name)["columns"].items()}
+
+    def encoded_columns(self, table_name):
+        """存成代碼的欄位 (精簡格式才有)"""
+        return {name for name, c in self.table(table_name)["columns"].items() if c.get("encoded")}
+
+    def key_info(self, table_name):
+        """pagination.py 需要的欄位 / 主鍵 / 可為 NULL 欄位資訊"""
+        info = self.table(table_name)
+        return {
+            "columns": list(info["columns"]),
+            "primary_key": list(info["primary_key"]),
+            "nullable": {name for name, c in info["columns"].items() if not c["not_null"]},
+        }
+
+    def referenced_by(self, table_name):
+        """哪些資料表的外鍵指向 table_name，回傳 [(子表, 外鍵資訊), ...]"""
+        return [
+            (child, fk)
+            for child, info in self._get_tables().items()
+            for fk in info["foreign_keys"]
+            if fk["ref_table"] == table_name
+        ]
+
+    def validate_columns(self, table_name, columns):
+        """表格不存在丟 UnknownTable，欄位不存在丟 UnknownColumn"""
+        known = self.table(table_name)["columns"]
+        unknown = [c for c in columns if c not in known]
+        if unknown:
+            raise UnknownColumn(f"{table_name} 沒有這些欄位：{', '.join(unknown)}")
+
+    def snapshot(self):
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "tables": self._get_tables(),
+        }
+
+
+schema = SchemaCache()
+
+
+def check_table(table_name, columns=()):
+    """
+    API 用：組 SQL 之前先用快取檢查表格 / 欄位名稱，
+    不存在就直接回 404 / 400，不用跑一趟資料庫
+    """
+    try:
+        schema.validate_columns(table_name, columns)
+    except UnknownTable as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except UnknownColumn as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (psycopg2.OperationalError, PoolTimeout) as e:
+        print("DB Connection Error:", e)
+        raise HTTPException(status_code=503, detail="資料庫連線失敗，請稍後再試")
+
+
+# ---------- DDL 自動重新載入 ----------
+def install_ddl_trigger(conn):
+    """裝 event trigger (需要 superuser)，成功回傳 True"""
+    try:
+        with conn.cursor() as cur:
+            # 舊版的 function 每個 DDL (包含 CREATE TEMP TABLE) 都通知，內容不一樣就換掉
+            cur.execute(DDL_FUNCTION_SOURCE)
+            row = cur.fetchone()
+            if row is None or row[0] != DDL_FUNCTION_BODY:
+                cur.execute(INSTALL_DDL_FUNCTION)
+            cur.execute(DDL_TRIGGERS)
+            installed = {name for (name,) in cur.fetchall()}
+            for name, ddl in INSTALL_DDL_TRIGGERS.items():
+                if name not in installed:
+                    cur.execute(ddl)
+        conn.commit()
+        return True
+    except psycopg2.Error as e:
+        conn.rollback()
+        print("⚠️ 無法安裝 schema_changed event trigger，DDL 後請手動呼叫 /api/schema/refresh:", e)
+        return False
+
+
+class SchemaListener(threading.Thread):
+    """背景執行緒：LISTEN schema_changed，收到通知就重新載入 (一批通知只重讀一次)"""
+
+    def __init__(self, cache):
+        super().__init__(name="schema-listener", daemon=True)
+        self.cache = cache
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        # DROP + CREATE 會連發好幾個通知，稍等一下一起處理
+                        time.sleep(0.2)
+                        conn.poll()
+                        conn.notifies.clear()
+                        self.cache.load(conn)
+            except psycopg2.Error as e:
+                print("⚠️ schema listener 連線中斷，稍後重試:", e)
+                self._stop_event.wait(5)
+            except Exception as e:
+                # 不是資料庫的錯誤 (例如載入時資料不對) 也不能讓執行緒默默結束，之後就再也不會重新載入
+                print("⚠️ schema listener 發生錯誤，稍後重試:", repr(e))
+                self._stop_event.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+_listener = None
+
+
+def start_schema_listener():
+    global _listener
+    with get_pool().connection() as conn:
+        schema.load(conn)
+        if not install_ddl_trigger(conn):
+            return
+    _listener = SchemaListener(schema)
+    _listener.start()
+
+
+def stop_schema_listener():
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,75 @@
+"""
+/api/data 回應的 JSON 編碼
+
+以前一頁資料要經過：RealDictCursor 每筆建一個 dict (每個值一次 Python 呼叫) →
+stringify_dates 再逐格檢查是不是日期 → FastAPI 的 jsonable_encoder 整包再走一遍 → json.dumps。
+一頁 100 ~ 1000 筆時這些 Python 迴圈比查詢本身還慢。現在改成：
+- 用一般 cursor 拿 tuple，dict(zip(欄位, tuple)) 一次建好 (或 format=columns 時連 dict 都不建)
+- 只有型別是日期 / 時間的欄位 (看 schema_cache 的欄位型別) 才轉字串，其他欄位不逐格檢查
+- 有裝 orjson 就用 orjson 編碼 (C 實作)，沒裝用標準 json；編好的 bytes 直接當 Response 回傳
+
+format=columns (選用) 的精簡格式，欄位名稱只出現一次：
+    {"columns": ["id_student", ...], "rows": [[11391, ...], ...], "pagination": {...}}
+"""
+import datetime
+import decimal
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 這些型別的欄位轉成字串 (跟以前 str(value) 的格式一樣，例如 "2013-10-01 12:00:00")
+TEMPORAL_TYPES = {
+    "date", "time without time zone", "time with time zone",
+    "timestamp without time zone", "timestamp with time zone", "interval",
+}
+
+RESPONSE_FORMATS = ("rows", "columns")
+
+
+def _default(value):
+    """JSON 原生不支援的型別，轉法跟 FastAPI 的 jsonable_encoder 一樣"""
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).decode(errors="replace")
+    raise TypeError(f"無法轉成 JSON: {type(value).__name__}")
+
+
+def dumps(payload):
+    """編成 JSON bytes (跟 FastAPI 預設的 JSONResponse 一樣不跳脫中文、不加空白)"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":"),
+                      default=_default).encode()
+
+
+def temporal_indexes(columns, column_types):
+    """columns 裡哪幾個位置是日期 / 時間欄位"""
+    return [i for i, name in enumerate(columns) if column_types.get(name) in TEMPORAL_TYPES]
+
+
+def encode_rows(columns, rows, temporal=(), fmt="rows"):
+    """
+    rows 是 tuple 的 list (asyncpg 的 Record 要先轉成 tuple)。
+    fmt="rows" 回傳 [{欄位: 值}, ...]，fmt="columns" 回傳 [[值, ...], ...] (欄位名稱另外放)
+    """
+    if temporal:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i in temporal:
+                if row[i] is not None:
+                    row[i] = str(row[i])
+    if fmt == "columns":
+        return rows
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def page_payload(columns, rows, pagination, fmt="rows"):
+    if fmt == "columns":
+        return {"columns": columns, "rows": rows, "pagination": pagination}
+    return {"data": rows, "pagination": pagination}
@@ -0,0 +1,183 @@
+"""
+Prepared statement 快取 (同步版 API 用；asyncpg 本來就會自動 prepare，不經過這裡)
+
+main.py 的查詢每次都用 psycopg2.sql 組好、以文字送出，PostgreSQL 每次都要重新 parse / 分析 / 規劃。
+但查詢的型態其實不多：讀取是 (表, 排序, 方向, 條件的欄位與運算子)，寫入是 (表, 欄位組合)，
+值 (包含 LIMIT / OFFSET) 都是參數。所以：
+- 型態 → PREPARE 用的 SQL (佔位符換成 $1, $2 ...) 與參數型別，整個 process 共用，LRU 最多 STATEMENT_CACHE_SIZE 個
+- 每條連線第一次遇到某個型態時 PREPARE，之後都用 EXECUTE 帶參數跑；
+  每條連線也是 LRU，PREPARE 過的超過 STATEMENT_CACHE_SIZE 個就 DEALLOCATE 最舊的
+- psycopg2 把參數轉成字面值送出 (例如 '5')，EXECUTE 時依 PREPARE 推出來的型別明確轉型
+- PREPARE 失敗 (例如推不出參數型別) 的型態記下來，之後照舊每次送 SQL
+- 資料表結構變了 (schema.version 換了) 就是新的型態，舊的靠 LRU 淘汰
+
+PostgreSQL 對 prepared statement 前 5 次用 custom plan (每次還是會規劃，但不用 parse)，
+之後 generic plan 不比較差時就整個跳過規劃。
+(選填) STATEMENT_CACHE = 0 關掉；經過 pgbouncer 的 transaction 模式時要關掉 (prepared statement 綁在連線上)
+"""
+import itertools
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2 import sql
+
+from query_metrics import TimedCursorMixin
+
+STATEMENT_CACHE = os.getenv("STATEMENT_CACHE", "1") == "1"
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "256"))
+
+PARAMETER_TYPES = "SELECT parameter_types::text[] AS types FROM pg_prepared_statements WHERE name = %s"
+
+_MISSING = object()
+# statement 名稱整個 process 不重複 (同一條連線可能被好幾個 StatementCache 用到)
+_names = itertools.count(1)
+# %% 或 %s (其他寫法例如 %(name)s 不支援，留著讓 PREPARE 失敗、改回每次送 SQL)
+_PERCENT = re.compile(r"%([%s])")
+
+
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def render(composable):
+    """psycopg2.sql 組好的查詢 → PREPARE 用的文字 (%s 佔位符改成 $1, $2 ...)；不支援的寫法丟 TypeError"""
+    counter = itertools.count(1)
+
+    def walk(obj):
+        if isinstance(obj, sql.Composed):
+            return "".join(walk(part) for part in obj.seq)
+        if isinstance(obj, sql.Identifier):
+            return ".".join(_quote_ident(s) for s in obj.strings)
+        if isinstance(obj, sql.Placeholder) and obj.name is None:
+            return f"${next(counter)}"
+        if isinstance(obj, sql.SQL):
+            # 直接寫在 SQL 裡的 %s 也是參數；PREPARE 不帶參數送出，psycopg2 不會把 %% 換回 %
+            return _PERCENT.sub(lambda m: "%" if m.group(1) == "%" else f"${next(counter)}", obj.string)
+        raise TypeError(f"不支援的 SQL 物件: {obj!r}")
+
+    return walk(composable)
+
+
+class _Statement:
+    __slots__ = ("name", "text", "execute_sql", "preparable")
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.execute_sql = None   # 第一次 PREPARE 之後才知道參數型別
+        self.preparable = True
+
+
+class StatementCache:
+    def __init__(self, size=STATEMENT_CACHE_SIZE, enabled=STATEMENT_CACHE):
+        self.size = size
+        self.enabled = enabled
+        self._shapes = OrderedDict()                    # 型態 -> _Statement (None = 組不成 PREPARE)
+        self._prepared = weakref.WeakKeyDictionary()    # 連線 -> OrderedDict(已經 PREPARE 的名稱)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "prepares": 0, "fallbacks": 0, "evictions": 0, "deallocates": 0}
+
+    def execute(self, cur, shape, query, params=()):
+        """
+        跟 cur.execute(query, params) 一樣，不過同一個型態在同一條連線上只 PREPARE 一次。
+        shape：查詢型態 (可以當 dict key、不含參數值)，同一個 shape 組出來的 query 必須一樣；
+        query 只有這個型態第一次出現時才會用到 (轉成 PREPARE 的文字)
+        """
+        if not self.enabled:
+            cur.execute(query, params)
+            return
+        stmt = self._statement(shape, query)
+        if stmt is None or not stmt.preparable:
+            self._count("fallbacks")
+            cur.execute(query, params)
+            return
+
+        conn = cur.connection
+        with self._lock:
+            prepared = self._prepared.get(conn)
+            if prepared is None:
+                prepared = self._prepared[conn] = OrderedDict()
+            hit = stmt.name in prepared
+            if hit:
+                prepared.move_to_end(stmt.name)
+                self._stats["hits"] += 1
+        if not hit:
+            if not self._prepare(cur, stmt):
+                self._count("fallbacks")
+                cur.execute(query, params)
+                return
+            with self._lock:
+                prepared[stmt.name] = None
+                evicted = [prepared.popitem(last=False)[0] for _ in range(len(prepared) - self.size)]
+                self._stats["deallocates"] += len(evicted)
+            for name in evicted:
+                cur.execute(f"DEALLOCATE {name}")
+
+        if isinstance(cur, TimedCursorMixin):
+            # 慢查詢紀錄記原本的 SQL (EXPLAIN 才跑得動)，不是 EXECUTE stmt_N(...)
+            cur.execute(stmt.execute_sql, params, statement=lambda: cur.mogrify(query, params).decode())
+        else:
+            cur.execute(stmt.execute_sql, params)
+
+    def _statement(self, shape, query):
+        with self._lock:
+            stmt = self._shapes.get(shape, _MISSING)
+            if stmt is not _MISSING:
+                self._shapes.move_to_end(shape)
+                return stmt
+        try:
+            stmt = _Statement(f"stmt_{next(_names)}", render(query))
+        except TypeError:
+            stmt = None
+        with self._lock:
+            stmt = self._shapes.setdefault(shape, stmt)
+            while len(self._shapes) > self.size:
+                self._shapes.popitem(last=False)
+                self._stats["evictions"] += 1
+        return stmt
+
+    def _prepare(self, cur, stmt):
+        """在這條連線上 PREPARE；失敗時只 rollback 到 savepoint，不影響同一個交易裡前面做的事"""
+        savepoint = not cur.connection.autocommit
+        try:
+            if savepoint:
+                cur.execute("SAVEPOINT statement_cache")
+            cur.execute(f"PREPARE {stmt.name} AS {stmt.text}")
+            if stmt.execute_sql is None:
+                cur.execute(PARAMETER_TYPES, (stmt.name,))
+                row = cur.fetchone()
+                types = row["types"] if isinstance(row, dict) else row[0]
+                args = ", ".join(f"%s::{t}" for t in types)
+                stmt.execute_sql = f"EXECUTE {stmt.name}({args})" if types else f"EXECUTE {stmt.name}"
+            if savepoint:
+                cur.execute("RELEASE SAVEPOINT statement_cache")
+        except psycopg2.Error as e:
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT statement_cache")
+            stmt.preparable = False
+            print(f"⚠️ 無法 PREPARE，這個型態改回每次送 SQL: {str(e).strip()}")
+            return False
+        self._count("prepares")
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "max_size": self.size,
+                "shapes": len(self._shapes),
+                "connections": len(self._prepared),
+            })
+        return stats
+
+
+statements = StatementCache()
@@ -0,0 +1,267 @@
+"""
+統計 API：GET /api/stats/...，分組計算都在 SQL 裡做，只把算好的結果傳回來
+
+- /api/stats/scores?group_by=student|module     依 assessments.weight 加權的成績
+- /api/stats/results?by=imd_band|age_band|...    各族群的通過率 (Pass + Distinction) / 退選率 (Withdrawn)
+- /api/stats/clicks?by=activity_type|week|module|site 點擊數分布
+- POST /api/stats/refresh                        手動重算彙總表
+- GET  /api/stats/rollups/check?repair=false     檢查 student_vle 彙總表跟 student_vle 是否一致
+
+篩選：query string 裡的 code_module、code_presentation 等 (每個端點能用哪些見 *_FILTERS)，
+clicks 另外可以用 week_from / week_to。
+
+scores 要掃 student_assessment 整張表，改讀事先算好的彙總表 (materialized view，見 summary_tables.py)；
+回傳的 summary 裡有彙總表上次重算的時間與是否過期。
+clicks 讀 trigger 即時維護的 student_vle 彙總表 (見 rollups.py)，指定 id_student 時讀每位學生每週的那張；
+要看某位學生的 activity_type / id_site 分布時彙總表沒有這個維度，改成現算。
+彙總表還沒建立時都改成現算 (source = "live")。results 只掃 student_info，直接現算。
+精簡格式 (compact_schema.py) 時篩選值先換成代碼，結果裡的代碼再換回字串。
+"""
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from psycopg2 import sql
+
+from db_pool import get_pool
+# 跟 RealDictCursor 一樣，另外記下每個 SQL 的時間 (見 query_metrics.py)
+from query_metrics import TimedRealDictCursor
+from read_replicas import read_connection, replicas
+from schema_cache import check_table, schema
+from compact_schema import decode_sql, dictionary
+from rollups import check_rollups, rollups_ready
+from summary_tables import SUMMARIES, BackgroundRefresher, create_summaries, refresh_summaries, summary_status
+
+router = APIRouter()
+
+STATS_MAX_ROWS = 1000
+
+# 各端點可以當篩選條件的欄位
+SCORE_FILTERS = ["code_module", "code_presentation", "id_student"]
+RESULT_FILTERS = ["code_module", "code_presentation", "gender", "region", "highest_education",
+                  "imd_band", "age_band", "disability"]
+CLICK_FILTERS = ["code_module", "code_presentation", "activity_type", "id_student"]
+
+# results 可以分組的欄位 (student_info 裡的人口統計欄位)
+RESULT_GROUPS = ["imd_band", "age_band", "gender", "region", "highest_education", "disability",
+                 "num_of_prev_attempts", "code_module", "code_presentation"]
+
+CLICK_GROUPS = {
+    "activity_type": ["activity_type"],
+    "week": ["week"],
+    "module": ["code_module", "code_presentation"],
+    "site": ["id_site"],
+}
+
+# clicks 的三種來源，欄位都一樣 (student 那張沒有 id_site / activity_type)
+SITE_ROLLUP_CLICKS = """
+    SELECT r.code_module, r.code_presentation, r.id_site,
+           COALESCE({activity_type}, 'unknown') AS activity_type,
+           r.week, r.clicks, r.interactions
+    FROM vle_rollup_site_week r
+    LEFT JOIN vle v ON v.id_site = r.id_site
+"""
+STUDENT_ROLLUP_CLICKS = """
+    SELECT code_module, code_presentation, week, clicks, interactions
+    FROM vle_rollup_student_week
+    WHERE id_student = %s
+"""
+# 彙總表還沒建好，或要看某位學生的 activity_type / id_site 分布時現算
+LIVE_CLICKS = """
+    SELECT sv.code_module, sv.code_presentation, sv.id_site,
+           COALESCE({activity_type}, 'unknown') AS activity_type,
+           floor(sv.date / 7.0)::int AS week,
+           sv.sum_click AS clicks, 1 AS interactions
+    FROM student_vle sv
+    LEFT JOIN vle v ON v.id_site = sv.id_site
+"""
+
+refresher = BackgroundRefresher(lambda: get_pool().getconn(), lambda conn: get_pool().putconn(conn))
+
+
+def _filters(request: Request, allowed, encoded=()):
+    """query string 裡是篩選欄位的那些 → {欄位: 值} (encoded 欄位的值換成代碼)"""
+    return dictionary.encode_values({k: v for k, v in request.query_params.items() if k in allowed}, encoded)
+
+
+def _activity_type():
+    """clicks 的 activity_type：精簡格式時在 SQL 裡就換回字串 (才能跟 'unknown' 放在同一欄)"""
+    if "activity_type" in schema.encoded_columns("vle"):
+        return decode_sql("activity_type", sql.SQL("v.activity_type"))
+    return sql.SQL("v.activity_type")
+
+
+def _where(filters, extra=None):
+    parts = [sql.SQL("{} = {}").format(sql.Identifier(col), sql.Placeholder()) for col in filters]
+    params = list(filters.values())
+    for condition, value in extra or []:
+        parts.append(sql.SQL(condition))
+        params.append(value)
+    if not parts:
+        return sql.SQL(""), params
+    return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(parts), params
+
+
+def _summary_source(cur, name):
+    """
+    決定要讀彙總表還是現算，回傳 (FROM 的對象, summary 資訊)。
+    彙總表過期太久就丟到背景重算，這次還是先讀舊的
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL AS ready", (name,))
+    if not cur.fetchone()["ready"]:
+        definition = SUMMARIES[name][0]
+        return sql.SQL("({}) AS s").format(sql.SQL(definition)), {"source": "live"}
+    if replicas.enabled:
+        # 副本的 pg_stat_user_tables 不會把重播進來的異動算進 n_tup_ins / upd / del，
+        # 跟 stats_refresh 記下的主資料庫次數永遠對不上，過期與否一定要在主資料庫比對
+        with get_pool().connection() as conn:
+            refreshed_at, stale, due = summary_status(conn, name)
+    else:
+        refreshed_at, stale, due = summary_status(cur.connection, name)
+    if due:
+        refresher.request(name)
+    return sql.Identifier(name), {"source": name, "refreshed_at": refreshed_at, "stale": stale}
+
+
+def _limit(limit):
+    if not 1 <= limit <= STATS_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"limit 必須介於 1 到 {STATS_MAX_ROWS}")
+    return limit
+
+
+def _run(query, params):
+    with read_connection() as conn:
+        with conn.cursor(cursor_factory=TimedRealDictCursor) as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+
+
+@router.get("/api/stats/scores")
+def score_stats(request: Request, group_by: str = "student", limit: int = 100, offset: int = 0):
+    """
+    group_by=student：每位學生在每門課的加權成績 (SUM(score * weight) / 有分數的評量 weight 總和)
+    group_by=module：每門課的學生人數、加權成績平均 / 最低 / 最高
+    """
+    if group_by not in ("student", "module"):
+        raise HTTPException(status_code=400, detail="group_by 只能是 student 或 module")
+    limit = _limit(limit)
+    encoded = schema.encoded_columns("assessments")
+    filters = _filters(request, SCORE_FILTERS, encoded)
+    where, params = _where(filters)
+
+    with read_connection() as conn:
+        with conn.cursor(cursor_factory=TimedRealDictCursor) as cur:
+            source, summary = _summary_source(cur, "stats_student_scores")
+            if group_by == "student":
+                query = sql.SQL("""
+                    SELECT id_student, code_module, code_presentation, assessments_taken, scored,
+                           avg_score, weighted_score, weight_covered
+                    FROM {}{}
+                    ORDER BY code_module, code_presentation, id_student
+                    LIMIT %s OFFSET %s
+                """).format(source, where)
+                params += [limit, max(offset, 0)]
+            else:
+                query = sql.SQL("""
+                    SELECT code_module, code_presentation,
+                           COUNT(*) AS students,
+                           COUNT(weighted_score) AS scored_students,
+                           ROUND(AVG(weighted_score), 2) AS avg_weighted_score,
+                           MIN(weighted_score) AS min_weighted_score,
+                           MAX(weighted_score) AS max_weighted_score
+                    FROM {}{}
+                    GROUP BY code_module, code_presentation
+                    ORDER BY code_module, code_presentation
+                """).format(source, where)
+            cur.execute(query, params)
+            return {"data": dictionary.decode_dicts(cur.fetchall(), encoded), "summary": summary}
+
+
+@router.get("/api/stats/results")
+def result_stats(request: Request, by: str = "imd_band"):
+    """依 by 分組的人數、通過率 (Pass + Distinction)、退選率 (Withdrawn)，百分比"""
+    if by not in RESULT_GROUPS:
+        raise HTTPException(status_code=400, detail=f"by 只能是 {', '.join(RESULT_GROUPS)}")
+    check_table("student_info", [by])
+    encoded = schema.encoded_columns("student_info")
+    filters = _filters(request, RESULT_FILTERS, encoded)
+    where, params = _where(filters)
+    group = sql.Identifier(by)
+    query = sql.SQL("""
+        SELECT {group},
+               COUNT(*) AS students,
+               COUNT(*) FILTER (WHERE final_result IN ('Pass', 'Distinction')) AS passed,
+               COUNT(*) FILTER (WHERE final_result = 'Withdrawn') AS withdrawn,
+               ROUND(100.0 * COUNT(*) FILTER (WHERE final_result IN ('Pass', 'Distinction')) / COUNT(*), 2) AS pass_rate,
+               ROUND(100.0 * COUNT(*) FILTER (WHERE final_result = 'Withdrawn') / COUNT(*), 2) AS withdraw_rate
+        FROM student_info{where}
+        GROUP BY {group}
+        ORDER BY {group} NULLS LAST
+    """).format(group=group, where=where)
+    return {"data": dictionary.decode_dicts(_run(query, params), encoded), "summary": {"source": "live"}}
+
+
+@router.get("/api/stats/clicks")
+def click_stats(request: Request, by: str = "activity_type",
+                week_from: Optional[int] = None, week_to: Optional[int] = None):
+    """依 by 分組的點擊數 (clicks) 與紀錄筆數 (interactions)"""
+    if by not in CLICK_GROUPS:
+        raise HTTPException(status_code=400, detail=f"by 只能是 {', '.join(CLICK_GROUPS)}")
+    # activity_type 在 SQL 裡就換回字串了，只有 code_module / code_presentation 要換
+    encoded = schema.encoded_columns("student_vle")
+    filters = _filters(request, CLICK_FILTERS, encoded)
+    id_student = filters.pop("id_student", None)
+    extra = []
+    if week_from is not None:
+        extra.append(("week >= %s", week_from))
+    if week_to is not None:
+        extra.append(("week <= %s", week_to))
+    where, params = _where(filters, extra)
+    columns = sql.SQL(", ").join(map(sql.Identifier, CLICK_GROUPS[by]))
+
+    if id_student is not None:
+        try:
+            id_student = int(id_student)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="id_student 必須是整數")
+
+    with read_connection() as conn:
+        with conn.cursor(cursor_factory=TimedRealDictCursor) as cur:
+            # 彙總表由 trigger 即時維護 (見 rollups.py)，不會過期
+            ready = rollups_ready(conn)
+            if id_student is None:
+                source, name = (SITE_ROLLUP_CLICKS, "vle_rollup_site_week") if ready else (LIVE_CLICKS, "live")
+                source_params = []
+            elif ready and by in ("week", "module") and "activity_type" not in filters:
+                source, source_params, name = STUDENT_ROLLUP_CLICKS, [id_student], "vle_rollup_student_week"
+            else:
+                source, source_params, name = LIVE_CLICKS + " WHERE sv.id_student = %s", [id_student], "live"
+            source = sql.SQL("({}) AS s").format(sql.SQL(source).format(activity_type=_activity_type()))
+            params = source_params + params
+            query = sql.SQL("""
+                SELECT {columns}, SUM(clicks)::bigint AS clicks, SUM(interactions)::bigint AS interactions
+                FROM {source}{where}
+                GROUP BY {columns}
+                ORDER BY {columns}
+            """).format(columns=columns, source=source, where=where)
+            cur.execute(query, params)
+            return {"data": dictionary.decode_dicts(cur.fetchall(), encoded), "summary": {"source": name}}
+
+
+@router.post("/api/stats/refresh")
+def refresh_stats():
+    """建立還沒有的彙總表、重算全部彙總表 (同步執行，大表要等一下)"""
+    with get_pool().connection() as conn:
+        created = create_summaries(conn)
+        refreshed = [name for name in SUMMARIES if name not in created]
+        refresh_summaries(conn, refreshed)
+    return {"message": "彙總表已更新", "created": created, "refreshed": refreshed}
+
+
+@router.get("/api/stats/rollups/check")
+def check_click_rollups(repair: bool = False):
+    """student_vle 彙總表跟 student_vle 現算的結果逐格比對；repair=true 時重建不一致的表"""
+    with get_pool().connection() as conn:
+        if not rollups_ready(conn):
+            raise HTTPException(status_code=404, detail="彙總表或 trigger 不存在，請先執行 import.py")
+        report = check_rollups(conn, repair=repair)
+    return {"consistent": not any(r["mismatched"] for r in report.values()), "rollups": report}
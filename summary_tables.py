@@ -0,0 +1,175 @@
+"""
+統計用的彙總表 (materialized view)
+
+/api/stats 裡比較重的統計 (要掃 student_assessment 整張表的) 不每次現算，
+而是事先算好存成 materialized view，查詢時只讀彙總結果：
+- stats_student_scores：每位學生在每門課 (code_module + code_presentation) 的加權成績 (依 assessments.weight)
+student_vle 的點擊數改由 trigger 逐筆維護的彙總表負責 (見 rollups.py)，不在這裡。
+
+什麼時候重算：
+- import.py 匯入完會建立 / 重算
+- 每次查詢時比對 pg_stat_user_tables 裡基礎表 (分區表是各個分區) 的異動次數 (新增 + 更新 + 刪除)，
+  跟上次重算時不一樣就算過期；過期超過 STATS_REFRESH_INTERVAL 秒就在背景
+  REFRESH MATERIALIZED VIEW CONCURRENTLY (重算期間照樣可以查舊的結果)
+- POST /api/stats/refresh 手動重算
+
+重算時間與當時的異動次數記在 stats_refresh 表 (多個 uvicorn worker / import.py 共用)。
+"""
+import os
+import threading
+import time
+
+from psycopg2 import sql
+
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", "60"))
+
+REFRESH_TABLE = "stats_refresh"
+
+# 名稱 → (定義, 唯一索引欄位, 基礎表)
+SUMMARIES = {
+    "stats_student_scores": (
+        """
+        SELECT sa.id_student, a.code_module, a.code_presentation,
+               COUNT(*) AS assessments_taken,
+               COUNT(sa.score) AS scored,
+               ROUND(AVG(sa.score)::numeric, 2) AS avg_score,
+               ROUND((SUM(sa.score * a.weight)
+                      / NULLIF(SUM(a.weight) FILTER (WHERE sa.score IS NOT NULL), 0))::numeric, 2) AS weighted_score,
+               SUM(a.weight) FILTER (WHERE sa.score IS NOT NULL) AS weight_covered
+        FROM student_assessment sa
+        JOIN assessments a ON a.id_assessment = sa.id_assessment
+        GROUP BY sa.id_student, a.code_module, a.code_presentation
+        """,
+        ["code_module", "code_presentation", "id_student"],
+        ["student_assessment", "assessments"],
+    ),
+}
+
+# 以前有、後來被取代的彙總表，create_summaries 時順便刪掉 (stats_clicks → rollups.py)
+RETIRED = ["stats_clicks"]
+
+CREATE_REFRESH_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {REFRESH_TABLE} (
+        view_name VARCHAR(64) PRIMARY KEY,
+        refreshed_at TIMESTAMPTZ NOT NULL,
+        changes BIGINT NOT NULL
+    )
+"""
+
+# 分區表 (import.py --partition) 的異動次數記在各個分區上，父表自己永遠是 0，要加總所有末端分區
+CHANGES_QUERY = """
+    WITH target AS (
+        SELECT to_regclass(quote_ident(t.name)) AS oid FROM unnest(%s::text[]) AS t(name)
+    ), leaves AS (
+        SELECT p.relid AS oid FROM target, pg_partition_tree(target.oid) p WHERE p.isleaf
+        UNION
+        SELECT c.oid FROM target JOIN pg_class c ON c.oid = target.oid WHERE c.relkind <> 'p'
+    )
+    SELECT COALESCE(SUM(s.n_tup_ins + s.n_tup_upd + s.n_tup_del), 0)
+    FROM leaves JOIN pg_stat_user_tables s ON s.relid = leaves.oid
+"""
+
+
+def table_changes(cur, tables):
+    """基礎表累計被新增 / 更新 / 刪除幾筆 (統計數字，只拿來比對有沒有變)"""
+    cur.execute(CHANGES_QUERY, (list(tables),))
+    return cur.fetchone()[0]
+
+
+def _record_refresh(cur, name):
+    cur.execute(f"""
+        INSERT INTO {REFRESH_TABLE} (view_name, refreshed_at, changes) VALUES (%s, now(), %s)
+        ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at, changes = EXCLUDED.changes
+    """, (name, table_changes(cur, SUMMARIES[name][2])))
+
+
+def create_summaries(conn):
+    """建立所有彙總表 (已經存在的不動)，回傳新建立的名稱"""
+    created = []
+    with conn.cursor() as cur:
+        cur.execute(CREATE_REFRESH_TABLE)
+        for name in RETIRED:
+            cur.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(sql.Identifier(name)))
+            cur.execute(f"DELETE FROM {REFRESH_TABLE} WHERE view_name = %s", (name,))
+        for name, (definition, key, _) in SUMMARIES.items():
+            cur.execute("SELECT to_regclass(%s)", (name,))
+            if cur.fetchone()[0] is not None:
+                continue
+            cur.execute(sql.SQL("CREATE MATERIALIZED VIEW {} AS {}").format(
+                sql.Identifier(name), sql.SQL(definition)))
+            # REFRESH ... CONCURRENTLY 需要唯一索引；查詢也靠它依課程篩選
+            cur.execute(sql.SQL("CREATE UNIQUE INDEX {} ON {} ({})").format(
+                sql.Identifier(f"{name}_key"), sql.Identifier(name),
+                sql.SQL(", ").join(map(sql.Identifier, key))))
+            _record_refresh(cur, name)
+            created.append(name)
+    conn.commit()
+    return created
+
+
+def refresh_summaries(conn, names=None, concurrently=True):
+    """重算彙總表，每張重算完就 commit；concurrently=True 時重算期間還是可以查舊的結果"""
+    with conn.cursor() as cur:
+        for name in SUMMARIES if names is None else names:
+            cur.execute(sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(
+                sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(name)))
+            _record_refresh(cur, name)
+            conn.commit()
+
+
+def summary_status(conn, name):
+    """回傳 (上次重算時間, 是否過期, 過期多久該重算了)"""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT refreshed_at, changes, now() - refreshed_at FROM {REFRESH_TABLE} WHERE view_name = %s",
+                    (name,))
+        row = cur.fetchone()
+        if row is None:
+            return None, True, True
+        refreshed_at, changes, age = row
+        stale = table_changes(cur, SUMMARIES[name][2]) != changes
+    return refreshed_at, stale, stale and age.total_seconds() > STATS_REFRESH_INTERVAL
+
+
+class BackgroundRefresher:
+    """過期的彙總表丟到背景執行緒重算；同一個 process 同時只會有一個在重算"""
+
+    def __init__(self, get_conn, put_conn):
+        self._get_conn = get_conn
+        self._put_conn = put_conn
+        self._running = set()
+        self._lock = threading.Lock()
+        self.last_error = None
+
+    def request(self, name):
+        with self._lock:
+            if name in self._running:
+                return
+            self._running.add(name)
+        threading.Thread(target=self._refresh, args=(name,), name=f"refresh-{name}", daemon=True).start()
+
+    def _refresh(self, name):
+        started = time.monotonic()
+        conn = None
+        try:
+            conn = self._get_conn()
+            with conn.cursor() as cur:
+                # 多個 worker 同時發現過期時只讓一個去重算
+                cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (name,))
+                got_lock = cur.fetchone()[0]
+            conn.commit()
+            if got_lock:
+                try:
+                    refresh_summaries(conn, [name])
+                finally:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+                    conn.commit()
+                print(f"🔄 {name} 已重算 ({time.monotonic() - started:.1f}s)")
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"⚠️ {name} 重算失敗:", e)
+        finally:
+            if conn is not None:
+                self._put_conn(conn)
+            with self._lock:
+                self._running.discard(name)